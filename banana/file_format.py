@@ -10,6 +10,7 @@ from banana.interfaces.mrtrix import MRConvert
 from banana.requirement import (
     dcm2niix_req, mrtrix_req, matlab_req)
 from banana.interfaces.converters import Dcm2niix, TwixReader
+from banana.interfaces.motion_correction import MotionMatsToStack
 from banana.exceptions import BananaUsageError
 import nibabel
 # Import base file formats from Arcana for convenience
@@ -49,6 +50,13 @@ class TwixConverter(Converter):
     interface = TwixReader()
 
 
+class MotionMatsStackConverter(Converter):
+
+    input = 'in_dir'
+    output = 'out_file'
+    interface = MotionMatsToStack()
+
+
 # =====================================================================
 # Custom loader functions for different image types
 # =====================================================================
@@ -379,6 +387,22 @@ motion_mats_format = FileFormat(
     name='motion_mats', directory=True, within_dir_exts=['.mat'],
     desc=("Format used for storing motion matrices produced during "
           "motion detection pipeline"))
+motion_mats_stack_format = FileFormat(
+    name='motion_mats_stack', extension='.npy',
+    aux_files={'json': '.json'},
+    desc=("Stack of N motion matrices saved in a single (N, 4, 4) numpy "
+          "array, which can be memory-mapped, with a JSON side car containing"
+          " the 'volume_names' and 'start_times' of the volumes the matrices "
+          "correspond to"))
+motion_mats_stack_format.set_converter(motion_mats_format,
+                                       MotionMatsStackConverter)
+motion_mats_index_format = FileFormat(
+    name='motion_mats_index', extension='.npz',
+    desc=("Numpy archive with the cumulative sums of a stack of motion "
+          "matrices ('cum_mats'), of its non-identity matrices "
+          "('cum_non_identity') and their counts ('non_identity_counts'), "
+          "used to average the matrices within any interval in constant "
+          "time"))
 
 
 # PET formats
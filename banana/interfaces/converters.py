@@ -9,6 +9,7 @@ from arcana.utils import split_extension
 import re
 from arcana.exceptions import ArcanaError
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from nipype.utils.filemanip import split_filename
 from .matlab import BaseMatlab, BaseMatlabInputSpec, BaseMatlabOutputSpec
 
@@ -100,6 +101,8 @@ class Dcm2niix(CommandLine):
 class Nii2DicomInputSpec(TraitedSpec):
     in_file = File(mandatory=True, desc='input nifti file')
     reference_dicom = traits.List(mandatory=True, desc='original umap')
+    num_threads = traits.Int(1, usedefault=True, desc='Number of slices to '
+                             'write in parallel')
 #     out_file = Directory(genfile=True, desc='the output dicom file')
 
 
@@ -115,42 +118,41 @@ class Nii2Dicom(BaseInterface):
 
     Attenuation Correction pipeline
 
+    The volume is cast to uint16 once and the PixelData of each slice is
+    written straight from it, the (deferred) pixel data of the reference
+    dicoms never being read.
     """
 
     input_spec = Nii2DicomInputSpec
     output_spec = Nii2DicomOutputSpec
 
     def _run_interface(self, runtime):
-        dcms = self.inputs.reference_dicom
-        to_remove = [x for x in dcms if '.dcm' not in x]
-        if to_remove:
-            for f in to_remove:
-                dcms.remove(f)
-#         dcms = glob.glob(self.inputs.reference_dicom+'/*.dcm')
-#         if not dcms:
-#             dcms = glob.glob(self.inputs.reference_dicom+'/*.IMA')
-#         if not dcms:
-#             raise Exception('No DICOM files found in {}'
-#                             .format(self.inputs.reference_dicom))
+        dcms = [x for x in self.inputs.reference_dicom if '.dcm' in x]
         nifti_image = nib.load(self.inputs.in_file)
-        nii_data = nifti_image.get_data()
-        if len(dcms) != nii_data.shape[2]:
+        if len(dcms) != nifti_image.shape[2]:
             raise Exception('Different number of nifti and dicom files '
                             'provided. Dicom to nifti conversion require the '
                             'same number of files in order to run. Please '
                             'check.')
+        # DICOM pixel data is stored row by row, i.e. with the nifti x axis
+        # varying fastest, so each slice of this array is contiguous and
+        # already in the byte order of the PixelData element
+        slices = np.ascontiguousarray(
+            np.asarray(nifti_image.dataobj).astype(
+                np.uint16).transpose(2, 1, 0))
         os.mkdir('nifti2dicom')
         _, basename, _ = split_filename(self.inputs.in_file)
-        for i in range(nii_data.shape[2]):
-            dcm = pydicom.read_file(dcms[i])
-            nifti = nii_data[:, :, i]
-            nifti = nifti.astype('uint16')
-            dcm.pixel_array.setflags(write=True)
-            dcm.pixel_array.flat[:] = nifti.flat[:]
-            dcm.PixelData = dcm.pixel_array.T.tostring()
+
+        def write_slice(i):
+            dcm = pydicom.read_file(dcms[i], defer_size='64 KB')
+            dcm.PixelData = slices[i].tobytes()
             dcm.save_as('nifti2dicom/{0}_vol{1}.dcm'
                         .format(basename, str(i).zfill(4)))
 
+        with ThreadPoolExecutor(
+                max_workers=max(self.inputs.num_threads, 1)) as executor:
+            list(executor.map(write_slice, range(len(dcms))))
+
         return runtime
 
     def _list_outputs(self):
@@ -2,22 +2,26 @@ import numpy as np
 import glob
 import json
 import pydicom
-import datetime as dt
 import os.path
-import warnings
 import nibabel as nib
-from nipype.utils.filemanip import split_filename
 from nipype.interfaces.base import (BaseInterface, BaseInterfaceInputSpec,
                                     traits, TraitedSpec, Directory, File,
                                     isdefined)
 from arcana.utils import split_extension
 from logging import getLogger
 from banana.exceptions import BananaMissingHeaderValue
-
-with warnings.catch_warnings():
-    warnings.simplefilter("ignore")
-    import nibabel.nicom.csareader as csareader
-
+# Nii2Dicom used to be defined here too, so it is re-exported for backwards
+# compatibility with code that imports it from this module
+from banana.interfaces.converters import (  # noqa: F401
+    Nii2Dicom, Nii2DicomInputSpec, Nii2DicomOutputSpec)
+from banana.utils.dicom_index import (
+    DicomHeaderIndex, header_fields, read_header_fields)
+from banana.utils.list_mode import (
+    find_list_mode_file, read_list_mode_header)
+from banana.utils.csa import (
+    read_ascconv, read_csa_header, CSA_IMAGE_HEADER_TAG)
+from banana.utils.timeline import (
+    AcquisitionTimeline, parse_hhmmss, format_hhmmss, unwrap_midnight)
 
 logger = getLogger('banana')
 
@@ -33,6 +37,9 @@ class DicomHeaderInfoExtractionInputSpec(BaseInterfaceInputSpec):
                            default=False)
     reference = traits.Bool(desc='Specify whether the input scan is the motion'
                             ' correction reference.')
+    header_index = File(desc='DICOM header index (see banana.utils.'
+                        'dicom_index.DicomHeaderIndex) to read the header '
+                        'fields from instead of parsing the files.')
 
 
 class DicomHeaderInfoExtractionOutputSpec(TraitedSpec):
@@ -64,98 +71,90 @@ class DicomHeaderInfoExtraction(BaseInterface):
         list_dicom = sorted(glob.glob(self.inputs.dicom_folder + '/*'))
         self.outpt = {}
 
-        # Read header from first DICOM file in list
-        hd = pydicom.read_file(list_dicom[0])
+        # Read the header of the first DICOM file in list (once), taking the
+        # standard fields from the index if provided
+        dcm = pydicom.read_file(list_dicom[0], stop_before_pixels=True)
+        if isdefined(self.inputs.header_index):
+            with DicomHeaderIndex(self.inputs.header_index) as index:
+                headers = index.headers(list_dicom)
+            hd = headers[0]
+        else:
+            headers = None
+            hd = header_fields(dcm)
+        # Siemens protocol parameters that are not read by pydicom
+        ascconv = read_ascconv(dcm)
 
         # Get acquisition start time
-        try:
-            self.outpt['start_time'] = float(hd.AcquisitionTime)
-        except AttributeError:
-            try:
-                self.outpt['start_time'] = float(
-                    str(hd.AcquisitionDateTime)[8:])
-            except AttributeError:
-                raise BananaMissingHeaderValue(
-                    'No acquisition time found for this scan.')
-
-        # Get echo times
+        if 'AcquisitionTime' in hd:
+            self.outpt['start_time'] = float(hd['AcquisitionTime'])
+        elif 'AcquisitionDateTime' in hd:
+            self.outpt['start_time'] = float(
+                str(hd['AcquisitionDateTime'])[8:])
+        else:
+            raise BananaMissingHeaderValue(
+                'No acquisition time found for this scan.')
+
+        # Get echo times, stopping as soon as all the contrasts in the
+        # protocol have been found
+        n_contrasts = ascconv.get('lContrasts')
         echo_times = set()
         try:
-            for f in list_dicom:
-                hdr = pydicom.read_file(f, specific_tags=['EchoTime'])
-                echo_time = hdr.EchoTime
+            for i, f in enumerate(list_dicom):
+                hdr = (headers[i] if headers is not None
+                       else read_header_fields(f, ['EchoTime']))
+                echo_time = hdr['EchoTime']
                 if echo_time in echo_times:
                     # Assumes that consequetive echos are in sequence. Maybe
                     # a bit dangerous but otherwise very expensive
                     break
-                echo_times.add(hdr.EchoTime)
-        except AttributeError:
+                echo_times.add(echo_time)
+                if len(echo_times) == n_contrasts:
+                    break
+        except KeyError:
             pass
         else:
             # Convert to secs
             self.outpt['echo_times'] = [float(t) / 1000.0 for t in echo_times]
 
         # Get the orientation of the main magnetic field as a vector
-        try:
-            img_orient = np.reshape(np.asarray(hd.ImageOrientationPatient),
-                                    newshape=(2, 3))
-        except AttributeError:
-            pass
-        else:
+        if 'ImageOrientationPatient' in hd:
+            img_orient = np.reshape(
+                np.asarray(hd['ImageOrientationPatient'], dtype=float),
+                (2, 3))
             self.outpt['H'] = list(np.cross(img_orient[0],
                                             img_orient[1]))
-            # Get voxel sizes
-        try:
-            vox_sizes = list(hd.PixelSpacing)
-        except AttributeError:
-            pass
-        else:
-            try:
-                vox_sizes.append(hd.SliceThickness)
-            except AttributeError:
-                pass
+        # Get voxel sizes
+        if 'PixelSpacing' in hd:
+            vox_sizes = list(hd['PixelSpacing'])
+            if 'SliceThickness' in hd:
+                vox_sizes.append(hd['SliceThickness'])
             self.outpt['voxel_sizes'] = vox_sizes
 
-        try:
-            self.outpt['B0'] = hd.MagneticFieldStrength
-        except AttributeError:
-            pass
+        if 'MagneticFieldStrength' in hd:
+            self.outpt['B0'] = hd['MagneticFieldStrength']
 
-        # Extract fields that are not read by pydicom
-        dwi_directions = total_duration = phase_offset = tr = ped = None
-
-        with open(list_dicom[0], 'rb') as f:
-            for line in f:
-                try:
-                    line = line[:-1].decode('utf-8')
-                except UnicodeDecodeError:
-                    continue
-                if 'TotalScan' in line:
-                    total_duration = line.split('=')[-1].strip()
-                    if not self.inputs.multivol:
-                        real_duration = total_duration
-                elif 'alTR[0]' in line:
-                    tr = float(line.split('=')[-1].strip()) / 1000000
-                elif ('SliceArray.asSlice[0].dInPlaneRot' in line and
-                        (not phase_offset or not ped)):
-                    if len(line.split('=')) > 1:
-                        phase_offset = float(line.split('=')[-1].strip())
-                        if (np.abs(phase_offset) > 1 and
-                                np.abs(phase_offset) < 3):
-                            ped = 'ROW'
-                        elif (np.abs(phase_offset) < 1 or
-                                np.abs(phase_offset) > 3):
-                            ped = 'COL'
-                            if np.abs(phase_offset) > 3:
-                                phase_offset = -1
-                            else:
-                                phase_offset = 1
-                elif 'lDiffDirections' in line:
-                    dwi_directions = float(line.split('=')[-1].strip())
+        # Extract fields from the ASCCONV protocol
+        total_duration = ascconv.get('lTotalScanTimeSec')
+        real_duration = None if self.inputs.multivol else total_duration
+        tr = ascconv.get('alTR[0]')
+        if tr is not None:
+            tr = float(tr) / 1000000
+        dwi_directions = ascconv.get('sDiffusion.lDiffDirections')
+        ped = None
+        phase_offset = ascconv.get('sSliceArray.asSlice[0].dInPlaneRot')
+        if phase_offset is not None:
+            phase_offset = float(phase_offset)
+            if np.abs(phase_offset) > 1 and np.abs(phase_offset) < 3:
+                ped = 'ROW'
+            elif np.abs(phase_offset) < 1 or np.abs(phase_offset) > 3:
+                ped = 'COL'
+                if np.abs(phase_offset) > 3:
+                    phase_offset = -1
+                else:
+                    phase_offset = 1
 
         try:
-            phase_offset, ped = self.get_phase_encoding_direction(
-                list_dicom[0])
+            phase_offset, ped = self.get_phase_encoding_direction(dcm)
         except KeyError:
             pass  # image does not have ped info in the header
 
@@ -200,12 +199,12 @@ class DicomHeaderInfoExtraction(BaseInterface):
 
         return outputs
 
-    def get_phase_encoding_direction(self, dicom_path):
+    def get_phase_encoding_direction(self, dcm):
 
-        dcm = pydicom.read_file(dicom_path)
         inplane_pe_dir = dcm[int('00181312', 16)].value
-        csa_str = dcm[int('00291010', 16)].value
-        csa_tr = csareader.read(csa_str)
+        csa_tr = read_csa_header(dcm, CSA_IMAGE_HEADER_TAG)
+        if csa_tr is None:
+            raise KeyError(CSA_IMAGE_HEADER_TAG)
         pedp = csa_tr['tags']['PhaseEncodingDirectionPositive']['items'][0]
         sign = PEDP_TO_SIGN[pedp]
         return sign, inplane_pe_dir
@@ -340,6 +339,8 @@ class ScanTimesInfoOutputSpec(TraitedSpec):
 
     scan_time_infos = File(exists=True, desc='Text file with scan time '
                            'information')
+    timeline = File(exists=True, desc='Acquisition timeline of the scans (see '
+                    'banana.utils.timeline.AcquisitionTimeline)')
 
 
 class ScanTimesInfo(BaseInterface):
@@ -348,31 +349,32 @@ class ScanTimesInfo(BaseInterface):
     output_spec = ScanTimesInfoOutputSpec
 
     def _run_interface(self, runtime):
+        names = []
         start_times = []
+        real_durations = []
         for dcm in self.inputs.dicom_infos:
             dcm_info = []
             with open(dcm, 'r') as f:
                 for line in f:
                     dcm_info.append(line.strip())
                 f.close()
-            start_times.append((dcm_info[0], dcm_info[1].split()[-1],
-                                dcm_info[4].split()[-1]))
-        start_times = sorted(start_times, key=lambda k: k[1])
-        time_info = {}
-        for i in range(1, len(start_times)):
-            time_info[start_times[i-1][0]] = {}
-            start = dt.datetime.strptime(start_times[i-1][1], '%H%M%S.%f')
-            end = dt.datetime.strptime(start_times[i][1], '%H%M%S.%f')
-            duration = float((end-start).total_seconds())
-            time_info[start_times[i-1][0]]['scan_duration'] = duration
-            time_offset = duration - float(start_times[i-1][2])
-            if time_offset < 0:
-                time_offset = 0
-            time_info[start_times[i-1][0]]['time_offset'] = time_offset
+            names.append(dcm_info[0])
+            start_times.append(dcm_info[1].split()[-1])
+            real_durations.append(float(dcm_info[4].split()[-1]))
+        starts = unwrap_midnight(parse_hhmmss(start_times))
+        real_durations = np.asarray(real_durations)
+        timeline = AcquisitionTimeline(
+            starts.min(), starts - starts.min(),
+            starts - starts.min() + real_durations, labels=names).sorted()
+        timeline.save('scan_timeline.json')
+        # The scan duration includes the idle time before the next scan
+        scan_durations = np.diff(timeline.starts)
+        time_offsets = np.maximum(
+            scan_durations - timeline.durations[:-1], 0)
         with open('scan_time_info.txt', 'w') as f:
-            for k in list(time_info.keys()):
-                f.write(k+' '+str(time_info[k]['scan_duration'])+' ' +
-                        str(time_info[k]['time_offset'])+'\n')
+            for name, duration, offset in zip(timeline.labels, scan_durations,
+                                              time_offsets):
+                f.write(name + ' ' + str(duration) + ' ' + str(offset) + '\n')
             f.close()
 
         return runtime
@@ -381,6 +383,7 @@ class ScanTimesInfo(BaseInterface):
         outputs = self._outputs().get()
 
         outputs["scan_time_infos"] = os.getcwd()+'/scan_time_info.txt'
+        outputs["timeline"] = os.getcwd()+'/scan_timeline.json'
 
         return outputs
 
@@ -395,6 +398,12 @@ class PetTimeInfoOutputSpec(TraitedSpec):
     pet_end_time = traits.Str(desc='PET end time.')
     pet_start_time = traits.Str(desc='PET start time.')
     pet_duration = traits.Int(desc='PET temporal duration in seconds.')
+    frame_times = File(desc='Text file with the start time (relative to the '
+                       'start of the acquisition) and duration of each frame '
+                       'listed in the list-mode header in seconds (only '
+                       'produced if the header defines the acquisition '
+                       'duration or frames). These describe the acquisition, '
+                       'not the frames of any reconstruction.')
 
 
 class PetTimeInfo(BaseInterface):
@@ -403,53 +412,33 @@ class PetTimeInfo(BaseInterface):
     output_spec = PetTimeInfoOutputSpec
 
     def _run_interface(self, runtime):
-        pet_data_dir = self.inputs.pet_data_dir
         self.dict_output = {}
         pet_duration = None
-        for root, dirs, files in os.walk(pet_data_dir):
-            bf_files = [f for f in files if not f[0] == '.' and '.bf' in f]
-            dirs[:] = [d for d in dirs if not d[0] == '.']
+        frame_times = None
+        list_mode_file = find_list_mode_file(self.inputs.pet_data_dir)
 
-        if not bf_files:
+        if list_mode_file is None:
             pet_start_time = None
             pet_endtime = None
             logger.warning(
                 'No .bf file found in {}. If you want to perform motion '
                 'correction please provide the right pet data. ')
         else:
-            max_size = 0
-            for bf in bf_files:
-                size = os.path.getsize(os.path.join(root, bf))
-                if size > max_size:
-                    max_size = size
-                    list_mode_file = os.path.join(root, bf)
-
-            pet_image = list_mode_file.split('.bf')[0] + '.dcm'
-            try:
-                hd = pydicom.read_file(pet_image)
-                pet_start_time = hd.AcquisitionTime
-            except AttributeError:
-                pet_start_time = None
-            with open(pet_image, 'rb') as f:
-                for line in f:
-                    try:
-                        line = line[:-1].decode('utf-8')
-                    except UnicodeDecodeError:
-                        continue
-                    if 'image duration' in line:
-                        pet_duration = line.strip()
-                        pet_duration = int(pet_duration.split(':=')[-1])
+            header = read_list_mode_header(list_mode_file)
+            pet_start_time = header.start_time
+            pet_duration = header.duration
+            if len(header.frames):
+                frame_times = os.path.abspath('frame_times.txt')
+                np.savetxt(frame_times, header.frames)
             if pet_duration:
-                pet_endtime = ((
-                    dt.datetime.strptime(pet_start_time, '%H%M%S.%f') +
-                    dt.timedelta(seconds=pet_duration))
-                    .strftime('%H%M%S.%f'))
-                pet_duration = pet_duration
+                pet_endtime = format_hhmmss(
+                    parse_hhmmss(pet_start_time) + pet_duration)
             else:
                 pet_endtime = None
         self.dict_output['pet_endtime'] = pet_endtime
         self.dict_output['pet_duration'] = pet_duration
         self.dict_output['pet_start_time'] = pet_start_time
+        self.dict_output['frame_times'] = frame_times
 
         return runtime
 
@@ -459,79 +448,7 @@ class PetTimeInfo(BaseInterface):
         outputs["pet_end_time"] = self.dict_output['pet_endtime']
         outputs["pet_start_time"] = self.dict_output['pet_start_time']
         outputs["pet_duration"] = self.dict_output['pet_duration']
+        if self.dict_output['frame_times'] is not None:
+            outputs["frame_times"] = self.dict_output['frame_times']
 
         return outputs
-
-
-class Nii2DicomInputSpec(TraitedSpec):
-    in_file = File(mandatory=True, desc='input nifti file')
-    reference_dicom = traits.List(mandatory=True, desc='original umap')
-#     out_file = Directory(genfile=True, desc='the output dicom file')
-
-
-class Nii2DicomOutputSpec(TraitedSpec):
-    out_file = Directory(exists=True, desc='the output dicom file')
-
-
-class Nii2Dicom(BaseInterface):
-    """
-    Creates two umaps in dicom format
-
-    fully compatible with the UTE study:
-
-    Attenuation Correction pipeline
-
-    """
-
-    input_spec = Nii2DicomInputSpec
-    output_spec = Nii2DicomOutputSpec
-
-    def _run_interface(self, runtime):
-        dcms = self.inputs.reference_dicom
-        to_remove = [x for x in dcms if '.dcm' not in x]
-        if to_remove:
-            for f in to_remove:
-                dcms.remove(f)
-        nifti_image = nib.load(self.inputs.in_file)
-        nii_data = nifti_image.get_data()
-        if len(dcms) != nii_data.shape[2]:
-            raise Exception('Different number of nifti and dicom files '
-                            'provided. Dicom to nifti conversion require the '
-                            'same number of files in order to run. Please '
-                            'check.')
-        os.mkdir('nifti2dicom')
-        _, basename, _ = split_filename(self.inputs.in_file)
-        for i in range(nii_data.shape[2]):
-            dcm = pydicom.read_file(dcms[i])
-            nifti = nii_data[:, :, i]
-            nifti = nifti.astype('uint16')
-            dcm.pixel_array.setflags(write=True)
-            dcm.pixel_array.flat[:] = nifti.flat[:]
-            dcm.PixelData = dcm.pixel_array.T.tostring()
-            dcm.save_as('nifti2dicom/{0}_vol{1}.dcm'
-                        .format(basename, str(i).zfill(4)))
-
-        return runtime
-
-    def _list_outputs(self):
-        outputs = self._outputs().get()
-        outputs['out_file'] = (
-            os.getcwd()+'/nifti2dicom')
-        return outputs
-
-    def _gen_filename(self, name):
-        if name == 'out_file':
-            fname = self._gen_outfilename()
-        else:
-            assert False
-        return fname
-
-    def _gen_outfilename(self):
-        if isdefined(self.inputs.out_file):
-            fpath = self.inputs.out_file
-        else:
-            fname = (
-                split_extension(os.path.basename(self.inputs.in_file))[0] +
-                '_dicom')
-            fpath = os.path.join(os.getcwd(), fname)
-        return fpath
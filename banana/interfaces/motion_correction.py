@@ -8,9 +8,13 @@ import os
 import os.path as op
 import glob
 import shutil
+import copy
 import nibabel as nib
 from nipype.interfaces.base import isdefined
 import scipy.ndimage.measurements as snm
+from scipy import ndimage
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 import datetime as dt
 try:
     import matplotlib
@@ -21,7 +25,295 @@ except ImportError:
 from nipype.interfaces import fsl
 import pydicom
 import math
+import json
 import subprocess as sp
+from banana.utils.timeline import (
+    IntervalTimeline, AcquisitionTimeline, parse_hhmmss, format_hhmmss,
+    unwrap_midnight)
+
+
+def load_motion_mats(mat_files):
+    """Loads a list of 4x4 text matrices into a single (N, 4, 4) array"""
+    return np.array([np.loadtxt(m) for m in mat_files]).reshape(-1, 4, 4)
+
+
+def save_motion_mats_stack(fname, mats, volume_names=None, start_times=None):
+    """
+    Saves a stack of motion matrices in 'motion_mats_stack' format, i.e. a
+    single (N, 4, 4) .npy file with a JSON side car containing the name and
+    start time of each volume
+
+    Parameters
+    ----------
+    fname : str
+        Path of the .npy file to save
+    mats : array-like
+        The motion matrices
+    volume_names : list[str]
+        Names of the volumes the matrices correspond to
+    start_times : list[str]
+        Start times (HHMMSS.ffffff) of the volumes
+
+    Returns
+    -------
+    fname : str
+        The absolute path to the saved file
+    """
+    fname = op.abspath(fname)
+    mats = np.asarray(mats, dtype=float).reshape(-1, 4, 4)
+    np.save(fname, mats)
+    sidecar = {'volume_names': (list(volume_names)
+                                if volume_names is not None else []),
+               'start_times': (list(start_times)
+                               if start_times is not None else [])}
+    with open(op.splitext(fname)[0] + '.json', 'w') as f:
+        json.dump(sidecar, f)
+    return fname
+
+
+def load_motion_mats_stack(fname, mmap_mode='r'):
+    """
+    Loads a stack of motion matrices saved in 'motion_mats_stack' format.
+    The matrices are memory mapped by default.
+
+    Returns
+    -------
+    mats : np.ndarray
+        The (N, 4, 4) stack of motion matrices
+    sidecar : dict
+        The contents of the JSON side car (empty if it is not present)
+    """
+    mats = np.load(fname, mmap_mode=mmap_mode)
+    sidecar_path = op.splitext(fname)[0] + '.json'
+    if op.exists(sidecar_path):
+        with open(sidecar_path) as f:
+            sidecar = json.load(f)
+    else:
+        sidecar = {}
+    return mats, sidecar
+
+
+def read_motion_mats(path, pattern='*mat.mat'):
+    """
+    Reads motion matrices from either a 'motion_mats_stack' file, a legacy
+    directory with one text file per matrix (selected by the glob pattern) or
+    a text file listing the paths to the matrices. Returns a (N, 4, 4) array
+    """
+    if op.isdir(path):
+        mats = sorted(glob.glob(op.join(path, pattern)))
+        if not mats:
+            raise Exception('No motion matrices matching {} found in {}'
+                            .format(pattern, path))
+        return load_motion_mats(mats)
+    elif path.endswith('.npy'):
+        return np.array(load_motion_mats_stack(path)[0])
+    return load_motion_mats(np.loadtxt(path, dtype=str, ndmin=1))
+
+
+def batch_rmsdiff(cog, T1=None, T2=None, T1_inv=None, R=80):
+    """Vectorised version of MeanDisplacementCalculation.rmsdiff, which
+    calculates the RMS deviation between stacks of (N, 4, 4) matrices
+
+    Parameters
+    ----------
+    cog : array-like
+        Centre of gravity of the reference image
+    T1 : np.ndarray
+        Stack of matrices to invert (not required if T1_inv is provided)
+    T2 : np.ndarray
+        Stack of matrices to compare to. Identity if not provided
+    T1_inv : np.ndarray
+        The inverses of T1, if already available
+    R : float
+        Radius of the sphere used to calculate the RMS deviation
+
+    Returns
+    -------
+    rms : np.ndarray
+        The (N,) RMS deviations
+    """
+    if T1_inv is None:
+        T1_inv = np.linalg.inv(T1)
+    if T2 is None:
+        M = T1_inv - np.identity(4)
+    else:
+        M = np.matmul(T2, T1_inv) - np.identity(4)
+    A = M[..., :3, :3]
+    t = M[..., :3, 3] + np.matmul(A, np.asarray(cog, dtype=float))
+    cost = np.sum(A ** 2, axis=(-2, -1)) * R ** 2 / 5
+    return np.sqrt(cost + np.sum(t ** 2, axis=-1))
+
+
+def rotation_matrices_to_euler_angles(R):
+    """Vectorised version of
+    MeanDisplacementCalculation.rotationMatrixToEulerAngles for a stack of
+    (N, 3, 3) rotation matrices. Returns a (N, 3) array of angles"""
+    should_be_identity = np.matmul(np.swapaxes(R, -1, -2), R)
+    assert np.all(np.linalg.norm(np.identity(3) - should_be_identity,
+                                 axis=(-2, -1)) < 1e-4)
+    cy = np.sqrt(R[..., 0, 0] ** 2 + R[..., 0, 1] ** 2)
+    singular = cy < 1e-4
+    x = np.where(singular, np.arctan2(-R[..., 2, 1], R[..., 1, 1]),
+                 np.arctan2(R[..., 1, 2], R[..., 2, 2]))
+    y = np.arctan2(-R[..., 0, 2], cy)
+    z = np.where(singular, 0.0, np.arctan2(R[..., 0, 1], R[..., 0, 0]))
+    return np.stack((x, y, z), axis=-1)
+
+
+def batch_avscale(mats, com, res=(1, 1, 1)):
+    """Vectorised version of MeanDisplacementCalculation.avscale for a stack
+    of (N, 4, 4) rigid-body matrices. Returns a (N, 6) array with the 3
+    rotations followed by the 3 translations"""
+    centre = np.asarray(com, dtype=float) * np.asarray(res, dtype=float)
+    rot_mats = mats[..., :3, :3]
+    rots = rotation_matrices_to_euler_angles(rot_mats)
+    trans = np.matmul(rot_mats, centre) + mats[..., :3, -1] - centre
+    return np.concatenate((rots, trans), axis=-1)
+
+
+def motion_mats_prefix_sums(mats):
+    """
+    Builds the cumulative sums over a stack of motion matrices, from which
+    the sum (or average) of the matrices in any [v1, v2) interval of volumes
+    can be obtained in constant time.
+
+    Parameters
+    ----------
+    mats : np.ndarray
+        (N, 4, 4) stack of motion matrices
+
+    Returns
+    -------
+    index : dict[str, np.ndarray]
+        'cum_mats' : (N + 1, 4, 4) cumulative sum of all the matrices
+        'cum_non_identity' : (N + 1, 4, 4) cumulative sum of the matrices
+            that are not the identity
+        'non_identity_counts' : (N + 1,) cumulative count of the matrices
+            that are not the identity
+    """
+    mats = np.asarray(mats, dtype=float)
+    zero = np.zeros((1, 4, 4))
+    non_identity = ~np.all(mats == np.eye(4), axis=(1, 2))
+    return {
+        'cum_mats': np.concatenate((zero, np.cumsum(mats, axis=0))),
+        'cum_non_identity': np.concatenate((zero, np.cumsum(
+            mats * non_identity[:, np.newaxis, np.newaxis], axis=0))),
+        'non_identity_counts': np.concatenate(
+            ([0], np.cumsum(non_identity)))}
+
+
+def save_motion_mats_index(fname, mats):
+    """Saves the prefix sums of a stack of motion matrices (see
+    motion_mats_prefix_sums) in a .npz file and returns its absolute path"""
+    fname = op.abspath(fname)
+    np.savez(fname, **motion_mats_prefix_sums(mats))
+    return fname
+
+
+def load_motion_mats_index(fname):
+    with np.load(fname) as index:
+        return {k: index[k] for k in index.files}
+
+
+def average_motion_mats(index, starts, ends):
+    """
+    Averages the motion matrices within the [start, end) intervals of
+    volumes, skipping the identity matrices. Intervals that only contain
+    identity matrices average to the identity.
+
+    Parameters
+    ----------
+    index : dict[str, np.ndarray]
+        The prefix sums returned by motion_mats_prefix_sums
+    starts : array-like
+        First volume of each interval
+    ends : array-like
+        Volume after the last one of each interval
+
+    Returns
+    -------
+    average_mats : np.ndarray
+        (len(starts), 4, 4) average matrix of each interval
+    """
+    starts = np.asarray(starts, dtype=int)
+    ends = np.asarray(ends, dtype=int)
+    sums = (index['cum_non_identity'][ends] -
+            index['cum_non_identity'][starts])
+    counts = (index['non_identity_counts'][ends] -
+              index['non_identity_counts'][starts])
+    average_mats = np.tile(np.eye(4), (len(starts), 1, 1))
+    valid = counts > 0
+    average_mats[valid] = sums[valid] / counts[valid, np.newaxis, np.newaxis]
+    return average_mats
+
+
+def interpolate_motion_mats(mats, vol_times, times):
+    """
+    Linearly interpolates a stack of motion matrices, each assigned to the
+    time of its volume, at the requested times. Times before the first or
+    after the last volume take the first/last matrix.
+
+    Parameters
+    ----------
+    mats : np.ndarray
+        (N, 4, 4) stack of motion matrices
+    vol_times : np.ndarray
+        (N,) sorted times (in seconds) the matrices correspond to
+    times : np.ndarray
+        (M,) times (in seconds) to interpolate the matrices at
+
+    Returns
+    -------
+    interp : np.ndarray
+        (M, 4, 4) interpolated matrices
+    lower : np.ndarray
+        (M,) indices of the lower bracketing volume of each time
+    """
+    vol_times = np.asarray(vol_times, dtype=float)
+    times = np.asarray(times, dtype=float)
+    if len(mats) == 1:
+        return (np.repeat(np.asarray(mats), len(times), axis=0),
+                np.zeros(len(times), dtype=int))
+    lower = np.clip(np.searchsorted(vol_times, times, side='right') - 1,
+                    0, len(vol_times) - 2)
+    w = ((times - vol_times[lower]) /
+         (vol_times[lower + 1] - vol_times[lower]))
+    w = np.clip(w, 0.0, 1.0)[:, np.newaxis, np.newaxis]
+    interp = (1 - w) * mats[lower] + w * mats[lower + 1]
+    return interp, lower
+
+
+def bin_motion_mats(mats, vol_times, bin_edges):
+    """
+    Averages a stack of motion matrices within each of the bins delimited by
+    bin_edges. The average of each bin is the mean of the matrices
+    interpolated at the two bin edges and of the matrices of the volumes that
+    are not used for the interpolation at either edge.
+
+    Parameters
+    ----------
+    mats : np.ndarray
+        (N, 4, 4) stack of motion matrices
+    vol_times : np.ndarray
+        (N,) sorted times (in seconds) the matrices correspond to
+    bin_edges : np.ndarray
+        (B + 1,) sorted times (in seconds) of the bin edges
+
+    Returns
+    -------
+    bin_mats : np.ndarray
+        (B, 4, 4) average matrix for each bin
+    """
+    mats = np.asarray(mats, dtype=float)
+    interp, lower = interpolate_motion_mats(mats, vol_times, bin_edges)
+    # The sum of the volumes within each bin is looked up in constant time
+    # from the cumulative sum of the matrices
+    cum_mats = motion_mats_prefix_sums(mats)['cum_mats']
+    first = np.minimum(lower[:-1] + 2, len(mats))
+    last = np.maximum(lower[1:], first)
+    inner_sum = cum_mats[last] - cum_mats[first]
+    n_inner = (last - first)[:, np.newaxis, np.newaxis]
+    return (interp[:-1] + interp[1:] + inner_sum) / (n_inner + 2)
 
 
 class MotionMatCalculationInputSpec(BaseInterfaceInputSpec):
@@ -39,8 +331,8 @@ class MotionMatCalculationInputSpec(BaseInterfaceInputSpec):
 
 class MotionMatCalculationOutputSpec(TraitedSpec):
 
-    motion_mats = Directory(exists=True, desc='Directory with resulting motion'
-                            ' matrices')
+    motion_mats = File(exists=True, desc='Stack of the resulting motion '
+                       'matrices (motion_mats_stack format)')
 
 
 class MotionMatCalculation(BaseInterface):
@@ -51,12 +343,10 @@ class MotionMatCalculation(BaseInterface):
     def _run_interface(self, runtime):
 
         reference = self.inputs.reference
-        dummy = self.inputs.dummy_input
         if reference:
-            np.savetxt('reference_motion_mat.mat', np.eye(4))
-            np.savetxt('reference_motion_mat_inv.mat', np.eye(4))
             out_name = 'ref_motion_mats'
-            mm = glob.glob('*motion_mat*.mat')
+            motion_mats = [np.eye(4)]
+            volume_names = ['reference']
         else:
             reg_mat = np.loadtxt(self.inputs.reg_mat)
             qform_mat = np.loadtxt(self.inputs.qform_mat)
@@ -70,32 +360,24 @@ class MotionMatCalculation(BaseInterface):
                         raise Exception(
                             'Folder {} is empty!'.format(
                                 self.inputs.align_mats))
-                for mat in list_mats:
-                    m = np.loadtxt(mat)
-                    concat = np.dot(reg_mat, m)
-                    self.gen_motion_mat(concat, qform_mat, mat.split('.')[0])
-                mat_path, _, _ = split_filename(mat)
-                mm = glob.glob(mat_path + '/*motion_mat*.mat')
+                motion_mats = [
+                    self.gen_motion_mat(np.dot(reg_mat, np.loadtxt(mat)),
+                                        qform_mat)
+                    for mat in list_mats]
+                volume_names = [split_filename(m)[1] for m in list_mats]
             else:
-                concat = reg_mat[:]
-                self.gen_motion_mat(concat, qform_mat, out_name)
-                mm = glob.glob('*motion_mat*.mat')
-        os.mkdir(out_name)
-
-        for f in mm:
-            shutil.move(f, out_name)
+                motion_mats = [self.gen_motion_mat(reg_mat, qform_mat)]
+                volume_names = [out_name]
+        save_motion_mats_stack(out_name + '.npy', motion_mats,
+                               volume_names=volume_names)
 
         return runtime
 
-    def gen_motion_mat(self, concat, qform, out_name):
-
+    def gen_motion_mat(self, concat, qform):
+        """Returns the motion matrix (the inverse is computed on demand by
+        the consumers of the stack)"""
         concat_inv = np.linalg.inv(concat)
-        concat_inv_qform = np.dot(qform, concat_inv)
-        concat_inv_qform_inv = np.linalg.inv(concat_inv_qform)
-        np.savetxt('{0}_motion_mat_inv.mat'.format(out_name),
-                   concat_inv_qform_inv)
-        np.savetxt('{0}_motion_mat.mat'.format(out_name),
-                   concat_inv_qform)
+        return np.dot(qform, concat_inv)
 
     def _list_outputs(self):
         outputs = self._outputs().get()
@@ -105,11 +387,53 @@ class MotionMatCalculation(BaseInterface):
         else:
             _, out_name, _ = split_filename(self.inputs.reg_mat)
 
-        outputs["motion_mats"] = os.path.abspath(out_name)
+        outputs["motion_mats"] = os.path.abspath(out_name + '.npy')
 
         return outputs
 
 
+class MotionMatsToStackInputSpec(BaseInterfaceInputSpec):
+
+    in_dir = Directory(exists=True, mandatory=True, desc='Legacy motion_mats '
+                       'directory with one text file per motion matrix')
+    pattern = traits.Str('*mat.mat', usedefault=True, desc='Glob pattern used '
+                         'to select the motion matrices within the directory')
+
+
+class MotionMatsToStackOutputSpec(TraitedSpec):
+
+    out_file = File(exists=True, desc='Stack of the motion matrices '
+                    '(motion_mats_stack format)')
+
+
+class MotionMatsToStack(BaseInterface):
+    """Converts a legacy directory of motion matrices, saved as one text file
+    per volume, into a single motion_mats_stack file"""
+
+    input_spec = MotionMatsToStackInputSpec
+    output_spec = MotionMatsToStackOutputSpec
+
+    def _run_interface(self, runtime):
+        mats = sorted(glob.glob(op.join(self.inputs.in_dir,
+                                        self.inputs.pattern)))
+        if not mats:
+            raise Exception('No motion matrices matching {} found in {}'
+                            .format(self.inputs.pattern, self.inputs.in_dir))
+        save_motion_mats_stack(
+            self._out_fname, load_motion_mats(mats),
+            volume_names=[split_filename(m)[1] for m in mats])
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['out_file'] = op.abspath(self._out_fname)
+        return outputs
+
+    @property
+    def _out_fname(self):
+        return op.basename(op.normpath(self.inputs.in_dir)) + '.npy'
+
+
 class MergeListMotionMatInputSpec(BaseInterfaceInputSpec):
 
     file_list = InputMultiPath(
@@ -457,7 +781,8 @@ class AffineMatrixGeneration(BaseInterface):
 
 class MeanDisplacementCalculationInputSpec(BaseInterfaceInputSpec):
 
-    motion_mats = traits.List(desc='List of motion mats.')
+    motion_mats = traits.List(desc='List of motion mats stacks (or legacy '
+                              'motion mats directories).')
     trs = traits.List(desc='List of repetition times.')
     start_times = traits.List(desc='List of start times.')
     real_durations = traits.List(desc='List of real durations.')
@@ -472,30 +797,33 @@ class MeanDisplacementCalculationOutputSpec(TraitedSpec):
 
     mean_displacement = File(exists=True, desc='mean displacement between each'
                              ' scan/volume and the reference.')
-    mean_displacement_rc = File(exists=True, desc='mean displacement values '
-                                'used in the generate the plot. Essentially it'
-                                ' contains one mean displacement value per '
-                                'millisecond. If, for example, a study lasts '
-                                'for 60 minutes, this file will contain '
-                                '3600000 values. I created this file to be '
-                                'able to plot the entire scan time, including '
-                                'both real scan time and MR idling time.')
+    mean_displacement_rc = File(exists=True, desc='mean displacement real '
+                                'clock used to generate the plot. It is an '
+                                'interval timeline (see banana.utils.timeline'
+                                '.IntervalTimeline) with one (start, end, '
+                                'value) row per scan/volume, so it covers the '
+                                'entire study time, the MR idling time being '
+                                'the gaps between the intervals.')
     mean_displacement_consecutive = File(exists=True, desc='mean displacement '
                                          'between each pair of consecutive '
                                          'scans/volumes.')
     start_times = File(exists=True, desc='start times for each scan/volume.')
+    timeline = File(exists=True, desc='acquisition timeline of all the '
+                    'scans/volumes (see banana.utils.timeline'
+                    '.AcquisitionTimeline).')
     motion_parameters_rc = File(
         exists=True, desc='Same as mean_displacement_rc but for motion '
         'parameters.')
     motion_parameters = File(exists=True, desc='6 motion parameters (3 '
                              'rotation and 3 translation) per scan/volume.')
-    offset_indexes = File(exists=True, desc='indexes where the '
-                          'mean_displacement_rc values reflect MR idling '
-                          'times. Used in the plot.')
-    mats4average = File(exists=True, desc='location of all the motion matrices'
-                        ' used to calculate the mean displacement. This will '
-                        'be used to create an average motion mat per detected '
-                        'frame.')
+    mats4average = File(exists=True, desc='stack (motion_mats_stack format) '
+                        'of all the motion matrices used to calculate the mean'
+                        ' displacement. This will be used to create an average'
+                        ' motion mat per detected frame.')
+    mats4average_index = File(exists=True, desc='prefix sums of mats4average '
+                              '(motion_mats_index format), used to average '
+                              'the motion mats within any frame in constant '
+                              'time.')
     corrupted_volumes = File(exists=True, desc='report of any unusually severe'
                              ' motion detected.')
 
@@ -515,23 +843,17 @@ class MeanDisplacementCalculation(BaseInterface):
         ref_data = ref.get_data()
         # centre of gravity
         ref_cog = np.asarray(snm.center_of_mass(ref_data))
-        list_inputs = sorted(list_inputs, key=lambda k: k[1])
-        study_start_time = list_inputs[0][1]
-        list_inputs = [
-            (x[0], (dt.datetime.strptime(str(x[1]), '%H%M%S.%f') -
-                    dt.datetime.strptime(str(list_inputs[0][1]), '%H%M%S.%f'))
-             .total_seconds(), x[2], x[3], x[4]) for x in list_inputs]
-        study_len = int((list_inputs[-1][1] + float(list_inputs[-1][2])) *
-                        1000)
-        mean_displacement_rc = np.zeros(study_len) - 1
-        motion_par_rc = np.zeros((6, study_len)) - 1
-        mean_displacement = []
-        motion_par = []
-        idt_mat = np.eye(4)
+        # Sort the scans by acquisition time (allowing for sessions that cross
+        # midnight) and express all times in seconds since the first one
+        scan_starts = unwrap_midnight(
+            parse_hhmmss([str(x[1]) for x in list_inputs]))
+        order = np.argsort(scan_starts, kind='stable')
+        list_inputs = [list_inputs[i] for i in order]
+        session_start = scan_starts[order[0]]
+        scan_starts = scan_starts[order] - session_start
         all_mats = []
-        all_mats4average = []
-        start_times = []
         volume_names = []
+        scan_names = []
         corrupted_volume_names = [
             'No volume showed rotation greater than 8 degrees and/or '
             'translation greater than 20mm respect to the reference.\nHowever,'
@@ -539,62 +861,57 @@ class MeanDisplacementCalculation(BaseInterface):
             ' are scans with very different mean displacement with respect '
             'to the others.\nIn that case please check the registration of '
             'that particular scan.']
-        for f in list_inputs:
-            mats = sorted(glob.glob(f[0] + '/*inv.mat'))
-            mats4averge = sorted(glob.glob(f[0] + '/*mat.mat'))
-            all_mats = all_mats + mats
-            all_mats4average = all_mats4average + mats4averge
-            start_scan = f[1]
+        vol_starts = []
+        vol_ends = []
+        for f, start_scan in zip(list_inputs, scan_starts):
+            mats = read_motion_mats(f[0])
+            all_mats.append(mats)
             tr = f[3]
             if len(mats) > 1:  # for 4D files
-                for i, mat in enumerate(mats):
+                for i in range(len(mats)):
                     volume_names.append(f[-1] + '_vol_{}'
                                         .format(str(i + 1).zfill(4)))
-                    start_times.append((
-                        dt.datetime.strptime(
-                            str(study_start_time), '%H%M%S.%f') +
-                        dt.timedelta(seconds=start_scan)).strftime(
-                            '%H%M%S.%f'))
+                    scan_names.append(f[-1])
                     end_scan = start_scan + tr
-                    m = np.loadtxt(mat)
-                    md = self.rmsdiff(ref_cog, m, idt_mat)
-                    mean_displacement_rc[
-                        int(start_scan * 1000):int(end_scan * 1000)] = md
-                    mean_displacement.append(md)
-                    mp = self.avscale(m, ref_cog)
-                    motion_par.append(mp)
-                    duration = int(end_scan * 1000) - int(start_scan * 1000)
-                    motion_par_rc[:, int(start_scan * 1000):
-                                  int(end_scan * 1000)] = np.array(
-                                      [mp, ] * duration).T
+                    vol_starts.append(start_scan)
+                    vol_ends.append(end_scan)
                     start_scan = end_scan
             elif len(mats) == 1:  # for 3D files
                 volume_names.append(f[-1])
-                start_times.append((
-                    dt.datetime.strptime(str(study_start_time),
-                                         '%H%M%S.%f') +
-                    dt.timedelta(seconds=start_scan)).strftime('%H%M%S.%f'))
+                scan_names.append(f[-1])
                 end_scan = start_scan + float(f[2])
-                m = np.loadtxt(mats[0])
-                md = self.rmsdiff(ref_cog, m, idt_mat)
-                mean_displacement_rc[
-                    int(start_scan * 1000):int(end_scan * 1000)] = md
-                mean_displacement.append(md)
-                mp = self.avscale(m, ref_cog)
-                motion_par.append(mp)
-                duration = int(end_scan * 1000) - int(start_scan * 1000)
-                motion_par_rc[:, int(start_scan * 1000):
-                              int(end_scan * 1000)] = np.array(
-                                  [mp, ] * duration).T
-        start_times.append((
-            dt.datetime.strptime(str(study_start_time), '%H%M%S.%f') +
-            dt.timedelta(seconds=end_scan)).strftime('%H%M%S.%f'))
-        mean_displacement_consecutive = []
-        for i in range(len(all_mats) - 1):
-            m1 = np.loadtxt(all_mats[i])
-            m2 = np.loadtxt(all_mats[i + 1])
-            md_consecutive = self.rmsdiff(ref_cog, m1, m2)
-            mean_displacement_consecutive.append(md_consecutive)
+                vol_starts.append(start_scan)
+                vol_ends.append(end_scan)
+        timeline = AcquisitionTimeline(session_start, vol_starts, vol_ends,
+                                       labels=volume_names, scans=scan_names)
+        timeline.save('timeline.json')
+        study_start_time = format_hhmmss(session_start)
+        start_times = timeline.to_clock_times(np.append(vol_starts, end_scan))
+
+        # Compute all the displacements and motion parameters in one go from
+        # the stacked motion matrices and their inverses
+        all_mats = np.concatenate(all_mats)
+        all_mats_inv = np.linalg.inv(all_mats)
+        mean_displacement = batch_rmsdiff(ref_cog, T1_inv=all_mats)
+        motion_par = batch_avscale(all_mats_inv, ref_cog)
+        mean_displacement_consecutive = batch_rmsdiff(
+            ref_cog, T1_inv=all_mats[:-1], T2=all_mats_inv[1:])
+        save_motion_mats_stack('mats4average.npy', all_mats,
+                               volume_names=volume_names,
+                               start_times=start_times[:-1])
+        save_motion_mats_index('mats4average_index.npz', all_mats)
+
+        # The real clock values are stored as one interval per volume, the
+        # MR idling periods being the gaps between them
+        IntervalTimeline(
+            vol_starts, vol_ends, mean_displacement,
+            study_start_time=study_start_time).save('mean_displacement_rc.txt')
+        IntervalTimeline(
+            vol_starts, vol_ends, motion_par,
+            study_start_time=study_start_time).save('motion_par_rc.txt')
+        mean_displacement = mean_displacement.tolist()
+        mean_displacement_consecutive = mean_displacement_consecutive.tolist()
+        motion_par = motion_par.tolist()
 
         corrupted_volumes = self.check_max_motion(motion_par)
         if corrupted_volumes:
@@ -607,22 +924,11 @@ class MeanDisplacementCalculation(BaseInterface):
             corrupted_volume_names = (
                 corrupted_volume_names + [volume_names[x]
                                           for x in corrupted_volumes])
-        offset_indexes = np.where(mean_displacement_rc == -1)
-        for i in range(len(mean_displacement_rc)):
-            if (mean_displacement_rc[i] == -1 and
-                    mean_displacement_rc[i - 1] != -1):
-                mean_displacement_rc[i] = mean_displacement_rc[i - 1]
-        for i in range(motion_par_rc.shape[1]):
-            if (motion_par_rc[0, i] == -1 and motion_par_rc[0, i - 1] != -1):
-                motion_par_rc[:, i] = motion_par_rc[:, i - 1]
 
         to_save = [mean_displacement, mean_displacement_consecutive,
-                   mean_displacement_rc, motion_par_rc, start_times,
-                   offset_indexes, all_mats4average, motion_par,
-                   corrupted_volume_names]
+                   start_times, motion_par, corrupted_volume_names]
         to_save_name = ['mean_displacement', 'mean_displacement_consecutive',
-                        'mean_displacement_rc', 'motion_par_rc', 'start_times',
-                        'offset_indexes', 'mats4average', 'motion_par',
+                        'start_times', 'motion_par',
                         'severe_motion_detection_report']
         for i in range(len(to_save)):
             np.savetxt(to_save_name[i] + '.txt', np.asarray(to_save[i]),
@@ -722,21 +1028,137 @@ class MeanDisplacementCalculation(BaseInterface):
         outputs["mean_displacement_consecutive"] = (
             os.getcwd() + '/mean_displacement_consecutive.txt')
         outputs["start_times"] = os.getcwd() + '/start_times.txt'
+        outputs["timeline"] = os.getcwd() + '/timeline.json'
         outputs["motion_parameters"] = os.getcwd() + '/motion_par.txt'
         outputs["motion_parameters_rc"] = os.getcwd() + '/motion_par_rc.txt'
-        outputs["offset_indexes"] = os.getcwd() + '/offset_indexes.txt'
-        outputs["mats4average"] = os.getcwd() + '/mats4average.txt'
+        outputs["mats4average"] = os.getcwd() + '/mats4average.npy'
+        outputs["mats4average_index"] = (
+            os.getcwd() + '/mats4average_index.npz')
         outputs["corrupted_volumes"] = (
             os.getcwd() + '/severe_motion_detection_report.txt')
 
         return outputs
 
 
+def detect_motion_frames(mean_displacement, mean_displacement_consecutive,
+                         scan_duration, motion_threshold, temporal_threshold):
+    """
+    Detects the volumes where a new motion frame starts, i.e. where the mean
+    displacement changes by more than motion_threshold, discarding frames
+    shorter than temporal_threshold.
+
+    Parameters
+    ----------
+    mean_displacement : np.ndarray
+        (N,) mean displacement of each volume with respect to the reference
+    mean_displacement_consecutive : np.ndarray
+        (N - 1,) mean displacement between consecutive volumes
+    scan_duration : np.ndarray
+        (N,) duration in seconds of each volume (including the idling time
+        before the next one)
+    motion_threshold : float
+        Motion threshold in mm
+    temporal_threshold : float
+        Minimum frame duration in seconds
+
+    Returns
+    -------
+    frame_vol : list[int]
+        The sorted volume numbers where each frame starts, the last one being
+        the end of the last frame
+    """
+    th = motion_threshold
+    # Frame durations are looked up from the cumulative scan durations
+    cum_duration = np.concatenate(([0.0], np.cumsum(scan_duration)))
+    md_0 = mean_displacement[0]
+    max_md = mean_displacement[0]
+    frame_vol = [0]
+
+    for i, current_md in enumerate(mean_displacement[1:]):
+
+        if (abs(md_0 - current_md) > th or
+                abs(max_md - current_md) > th):
+            duration = cum_duration[i + 1] - cum_duration[frame_vol[-1]]
+            if duration > temporal_threshold:
+                if i + 1 not in frame_vol:
+                    frame_vol.append(i + 1)
+
+                md_0 = current_md
+                max_md = current_md
+            else:
+                prev_md = mean_displacement[frame_vol[-1]]
+                if (prev_md - current_md) > th * 2:
+                    frame_vol.pop()
+                elif (current_md - prev_md) > th:
+                    frame_vol.pop()
+                    frame_vol.append(i)
+        elif mean_displacement_consecutive[i] > th:
+            duration = cum_duration[i + 1] - cum_duration[frame_vol[-1]]
+            if duration > temporal_threshold:
+                if i + 1 not in frame_vol:
+                    frame_vol.append(i + 1)
+                md_0 = current_md
+                max_md = current_md
+        elif current_md > max_md:
+            max_md = current_md
+        elif current_md < md_0:
+            md_0 = current_md
+
+    end = len(mean_displacement)
+    duration = cum_duration[end] - cum_duration[frame_vol[-1]]
+    if duration > temporal_threshold:
+        if end not in frame_vol:
+            frame_vol.append(end)
+    else:
+        frame_vol.pop()
+        frame_vol.append(end)
+
+    return sorted(frame_vol)
+
+
+def sweep_motion_framing(mean_displacement, mean_displacement_consecutive,
+                         scan_duration, motion_thresholds,
+                         temporal_thresholds):
+    """
+    Runs detect_motion_frames for every combination of the motion and
+    temporal thresholds provided, so they can be tuned without rerunning the
+    framing pipeline.
+
+    Returns
+    -------
+    results : list[dict]
+        For each combination, the 'motion_threshold', 'temporal_threshold',
+        'frame_vol_numbers', 'frame_start_secs' (seconds from the start of
+        the first volume) and 'n_frames'
+    """
+    mean_displacement = np.asarray(mean_displacement, dtype=float)
+    mean_displacement_consecutive = np.asarray(
+        mean_displacement_consecutive, dtype=float)
+    cum_duration = np.concatenate(([0.0], np.cumsum(scan_duration)))
+    results = []
+    for th in motion_thresholds:
+        for temporal_th in temporal_thresholds:
+            frame_vol = detect_motion_frames(
+                mean_displacement, mean_displacement_consecutive,
+                scan_duration, th, temporal_th)
+            results.append({
+                'motion_threshold': float(th),
+                'temporal_threshold': float(temporal_th),
+                'frame_vol_numbers': [int(v) for v in frame_vol],
+                'frame_start_secs': cum_duration[frame_vol].tolist(),
+                'n_frames': len(frame_vol) - 1})
+    return results
+
+
 class MotionFramingInputSpec(BaseInterfaceInputSpec):
 
     mean_displacement = File(exists=True)
     mean_displacement_consec = File(exists=True)
     start_times = File(exists=True)
+    timeline = File(exists=True, desc='Acquisition timeline of all the '
+                    'scans/volumes (see banana.utils.timeline'
+                    '.AcquisitionTimeline). If provided it is used instead '
+                    'of the start times.')
     motion_threshold = traits.Float(desc='Everytime the mean displacement is '
                                     'greater than this value (in mm), a new '
                                     'frame will be initialised. Default 2mm',
@@ -753,6 +1175,14 @@ class MotionFramingInputSpec(BaseInterfaceInputSpec):
     pet_duration = traits.Int(desc='Time, in seconds, the static PET '
                               'reconstruction lasts. Default is from '
                               'pet_start_time+pet_offest to the pet_end_time')
+    sweep_motion_thresholds = traits.List(
+        traits.Float(), desc='Grid of motion thresholds (in mm) to run the '
+        'framing with, the results being saved in the framing_sweep output. '
+        'Defaults to motion_threshold.')
+    sweep_temporal_thresholds = traits.List(
+        traits.Float(), desc='Grid of temporal thresholds (in sec) to run the'
+        ' framing with, the results being saved in the framing_sweep output. '
+        'Defaults to temporal_threshold.')
 
 
 class MotionFramingOutputSpec(TraitedSpec):
@@ -763,6 +1193,9 @@ class MotionFramingOutputSpec(TraitedSpec):
                              'volume where the motion occurred.')
     timestamps_dir = Directory(desc='Directory with the timestamps for all'
                                ' the detected frames')
+    framing_sweep = File(exists=True, desc='JSON file with the frame '
+                         'boundaries and number of frames detected for each '
+                         'combination of the sweep thresholds.')
 
 
 class MotionFraming(BaseInterface):
@@ -777,122 +1210,78 @@ class MotionFraming(BaseInterface):
         mean_displacement_consecutive = np.loadtxt(
             self.inputs.mean_displacement_consec, dtype=float)
         th = self.inputs.motion_threshold
-        start_times = np.loadtxt(self.inputs.start_times, dtype=str)
         temporal_th = self.inputs.temporal_threshold
+        if isdefined(self.inputs.timeline):
+            timeline = AcquisitionTimeline.load(self.inputs.timeline)
+        else:
+            timeline = AcquisitionTimeline.from_start_times(
+                np.loadtxt(self.inputs.start_times, dtype=str))
+        # Start of each volume followed by the end of the last one, both in
+        # seconds since the start of the study and as clock times
+        bounds = timeline.bounds
+        start_times = timeline.to_clock_times(bounds)
         pet_st = self.inputs.pet_start_time
         pet_endtime = self.inputs.pet_end_time
-        if not pet_st and not pet_endtime:
-            pet_st = None
-            pet_endtime = None
-        else:
+        pet_st_sec = pet_end_sec = None
+        if pet_st or pet_endtime:
+            pet_st_sec = timeline.to_seconds(pet_st)
             if isdefined(self.inputs.pet_offset):
-                offset = self.inputs.pet_offset
-                pet_st = (dt.datetime.strptime(str(pet_st), '%H%M%S.%f') +
-                          dt.timedelta(seconds=offset)).strftime('%H%M%S.%f')
+                pet_st_sec += self.inputs.pet_offset
             if (isdefined(self.inputs.pet_duration) and
                     self.inputs.pet_duration > 0):
-                pet_len = self.inputs.pet_duration
-                pet_endtime = ((dt.datetime.strptime(str(pet_st), '%H%M%S.%f') +
-                                dt.timedelta(seconds=pet_len))
-                               .strftime('%H%M%S.%f'))
-
-        md_0 = mean_displacement[0]
-        max_md = mean_displacement[0]
-        frame_vol = [0]
-        frame_st4pet = []
+                pet_end_sec = pet_st_sec + self.inputs.pet_duration
+            elif pet_endtime:
+                pet_end_sec = timeline.to_seconds(pet_endtime)
 
-        scan_duration = [
-            (dt.datetime.strptime(str(start_times[i]), '%H%M%S.%f') -
-             dt.datetime.strptime(str(start_times[i - 1]), '%H%M%S.%f')
-             ).total_seconds() for i in range(1, len(start_times))]
-
-        for i, md in enumerate(mean_displacement[1:]):
+        frame_st4pet = []
 
-            current_md = md
-            if (np.abs(md_0 - current_md) > th or
-                    np.abs(max_md - current_md) > th):
-                duration = np.sum(scan_duration[frame_vol[-1]:i + 1])
-                if duration > temporal_th:
-                    if i + 1 not in frame_vol:
-                        frame_vol.append(i + 1)
+        scan_duration = np.diff(bounds)
 
-                    md_0 = current_md
-                    max_md = current_md
-                else:
-                    prev_md = mean_displacement[frame_vol[-1]]
-                    if (prev_md - current_md) > th * 2:
-                        frame_vol.remove(frame_vol[-1])
-                    elif (current_md - prev_md) > th:
-                        frame_vol.remove(frame_vol[-1])
-                        frame_vol.append(i)
-            elif mean_displacement_consecutive[i] > th:
-                duration = np.sum(scan_duration[frame_vol[-1]:i + 1])
-                if duration > temporal_th:
-                    if i + 1 not in frame_vol:
-                        frame_vol.append(i + 1)
-                    md_0 = current_md
-                    max_md = current_md
-            elif current_md > max_md:
-                max_md = current_md
-            elif current_md < md_0:
-                md_0 = current_md
+        frame_vol = detect_motion_frames(
+            mean_displacement, mean_displacement_consecutive, scan_duration,
+            th, temporal_th)
 
-        duration = np.sum(scan_duration[frame_vol[-1]:i + 2])
-        if duration > temporal_th:
-            if (i + 2) not in frame_vol:
-                frame_vol.append(i + 2)
+        if isdefined(self.inputs.sweep_motion_thresholds):
+            sweep_th = self.inputs.sweep_motion_thresholds
         else:
-            frame_vol.remove(frame_vol[-1])
-            frame_vol.append(i + 2)
+            sweep_th = [th]
+        if isdefined(self.inputs.sweep_temporal_thresholds):
+            sweep_temporal_th = self.inputs.sweep_temporal_thresholds
+        else:
+            sweep_temporal_th = [temporal_th]
+        with open('framing_sweep.json', 'w') as f:
+            json.dump(sweep_motion_framing(
+                mean_displacement, mean_displacement_consecutive,
+                scan_duration, sweep_th, sweep_temporal_th), f, indent=2)
 
         frame_vol = sorted(frame_vol)
         frame_start_times = [start_times[x] for x in frame_vol]
-        if pet_st and pet_endtime:
-            frame_st4pet = [
-                x for x in frame_start_times if
-                (dt.datetime.strptime(str(x), '%H%M%S.%f') >
-                 dt.datetime.strptime(str(pet_st), '%H%M%S.%f') and
-                 dt.datetime.strptime(str(x), '%H%M%S.%f') <
-                 dt.datetime.strptime(str(pet_endtime), '%H%M%S.%f'))]
-            if frame_start_times[0] in frame_st4pet:
-                frame_st4pet.remove(frame_start_times[0])
-            if frame_start_times[-1] in frame_st4pet:
-                frame_st4pet.remove(frame_start_times[-1])
-            frame_st4pet.append(pet_st)
-            frame_st4pet.append(pet_endtime)
-            frame_st4pet = sorted(frame_st4pet)
-            if ((dt.datetime.strptime(str(frame_st4pet[1]), '%H%M%S.%f') -
-                    dt.datetime.strptime(str(frame_st4pet[0]), '%H%M%S.%f'))
-                    .total_seconds() < 30):
-                frame_st4pet.remove(frame_st4pet[1])
-            if ((dt.datetime.strptime(str(frame_st4pet[-1]), '%H%M%S.%f') -
-                    dt.datetime.strptime(str(frame_st4pet[-2]), '%H%M%S.%f'))
-                    .total_seconds() < 30):
-                frame_st4pet.remove(frame_st4pet[-2])
-            frame_vol = [i for i in range(len(start_times)) for j in
-                         range(len(frame_st4pet)) if start_times[i] ==
-                         frame_st4pet[j]]
-            if (dt.datetime.strptime(start_times[0], '%H%M%S.%f') >
-                    dt.datetime.strptime(pet_st, '%H%M%S.%f')):
+        if pet_st_sec is not None and pet_end_sec is not None:
+            # Frame boundaries within the PET acquisition (apart from the
+            # first and last ones) plus the PET start and end
+            frame_secs = bounds[frame_vol]
+            within_pet = (frame_secs > pet_st_sec) & (frame_secs < pet_end_sec)
+            within_pet[[0, -1]] = False
+            st4pet = np.sort(np.concatenate((frame_secs[within_pet],
+                                             [pet_st_sec, pet_end_sec])))
+            if st4pet[1] - st4pet[0] < 30:
+                st4pet = np.delete(st4pet, 1)
+            if st4pet[-1] - st4pet[-2] < 30:
+                st4pet = np.delete(st4pet, -2)
+            frame_vol = np.nonzero(np.isin(bounds, st4pet))[0].tolist()
+            # Volumes acquired during the PET start and end
+            if bounds[0] > pet_st_sec:
                 frame_vol.append(0)
             else:
-                vol = [i for i in range(len(start_times)) if
-                       (dt.datetime.strptime(start_times[i], '%H%M%S.%f') <
-                        dt.datetime.strptime(frame_st4pet[0], '%H%M%S.%f') and
-                        dt.datetime.strptime(start_times[i + 1], '%H%M%S.%f') >
-                        dt.datetime.strptime(frame_st4pet[0], '%H%M%S.%f'))]
-                frame_vol.append(vol[0])
-            if (dt.datetime.strptime(start_times[-1], '%H%M%S.%f') <
-                    dt.datetime.strptime(pet_endtime, '%H%M%S.%f')):
-                frame_vol.append(len(start_times) - 1)
+                frame_vol.append(
+                    int(np.searchsorted(bounds, st4pet[0])) - 1)
+            if bounds[-1] < pet_end_sec:
+                frame_vol.append(len(bounds) - 1)
             else:
-                vol = [i for i in range(len(start_times)) if
-                       (dt.datetime.strptime(start_times[i], '%H%M%S.%f') <
-                        dt.datetime.strptime(frame_st4pet[-1], '%H%M%S.%f') and
-                        dt.datetime.strptime(start_times[i + 1], '%H%M%S.%f') >
-                        dt.datetime.strptime(frame_st4pet[-1], '%H%M%S.%f'))]
-                frame_vol.append(vol[0])
+                frame_vol.append(
+                    int(np.searchsorted(bounds, st4pet[-1])) - 1)
             frame_vol = sorted(frame_vol)
+            frame_st4pet = timeline.to_clock_times(st4pet)
         np.savetxt('frame_start_times.txt', np.asarray(frame_start_times),
                    fmt='%s')
         os.mkdir('timestamps')
@@ -917,6 +1306,7 @@ class MotionFraming(BaseInterface):
         outputs["frame_start_times"] = os.getcwd() + '/frame_start_times.txt'
         outputs["frame_vol_numbers"] = os.getcwd() + '/frame_vol_numbers.txt'
         outputs["timestamps_dir"] = os.getcwd() + '/timestamps'
+        outputs["framing_sweep"] = os.getcwd() + '/framing_sweep.json'
 
         return outputs
 
@@ -924,15 +1314,16 @@ class MotionFraming(BaseInterface):
 class PlotMeanDisplacementRCInputSpec(BaseInterfaceInputSpec):
 
     mean_disp_rc = File(exists=True, desc='Text file containing the mean '
-                        'displacement real clock.')
+                        'displacement real clock timeline.')
     motion_par_rc = File(exists=True, desc='Text file containing the motion '
-                         'parameters real clock.')
+                         'parameters real clock timeline.')
     frame_start_times = File(exists=True, desc='Frame start times as detected'
                              'by the motion framing pipeline')
-    false_indexes = File(exists=True, desc='Time indexes were the scanner was '
-                         'idling, i.e. there is no motion information.')
     framing = traits.Bool(desc='If true, the frame start times will be plotted'
                           'in the final image.')
+    resolution = traits.Float(
+        1.0, usedefault=True, desc='Resolution (in seconds) the real clock '
+        'timelines are sampled at to generate the plots.')
 
 
 class PlotMeanDisplacementRCOutputSpec(TraitedSpec):
@@ -949,48 +1340,36 @@ class PlotMeanDisplacementRC(BaseInterface):
 
     def _run_interface(self, runtime):
 
-        mean_disp_rc = np.loadtxt(self.inputs.mean_disp_rc)
-        false_indexes = np.loadtxt(self.inputs.false_indexes, dtype=int)
+        res = self.inputs.resolution
+        dates, mean_disp_rc, active = IntervalTimeline.load(
+            self.inputs.mean_disp_rc).expand(res)
+        mean_disp_rc = mean_disp_rc[:, 0]
 
         if isdefined(self.inputs.motion_par_rc):
-            motion_par_rc = np.loadtxt(self.inputs.motion_par_rc)
+            _, motion_par_rc, _ = IntervalTimeline.load(
+                self.inputs.motion_par_rc).expand(res)
+            motion_par_rc = motion_par_rc.T
             plot_mp = True
         else:
             plot_mp = False
-        plot_offset = True
-        dates = np.arange(0, len(mean_disp_rc), 1)
-        indxs = np.zeros(len(mean_disp_rc), int) + 1
-        indxs[false_indexes] = 0
-        start_true_period = [
-            x for x in range(1, len(indxs)) if indxs[x] == 1 and
-            indxs[x - 1] == 0]
-        end_true_period = [
-            x for x in range(len(indxs) - 1) if indxs[x] == 0 and
-            indxs[x - 1] == 1]
-        start_true_period.append(1)
-        end_true_period.append(len(dates))
-        start_true_period = sorted(start_true_period)
-        end_true_period = sorted(end_true_period)
-        if len(start_true_period) == len(end_true_period) - 1:
-            end_true_period.remove(end_true_period[-1])
-        elif len(start_true_period) != len(end_true_period):
-            print('Something went wrong in the identification of the MR '
-                  'idling time. It will not be plotted.')
-            plot_offset = False
-
-        self.gen_plot(dates, mean_disp_rc, plot_offset, start_true_period,
-                      end_true_period)
+        # Sample indices where the scanning (i.e. not idling) periods start
+        # and end
+        edges = np.diff(np.concatenate(([0], active.astype(int), [0])))
+        start_true_period = np.where(edges == 1)[0]
+        end_true_period = np.where(edges == -1)[0]
+
+        self.gen_plot(dates, mean_disp_rc, start_true_period, end_true_period)
         if plot_mp:
             for i in range(2):
                 mp = motion_par_rc[i * 3:(i + 1) * 3, :]
                 self.gen_plot(
-                    dates, mp, plot_offset, start_true_period, end_true_period,
+                    dates, mp, start_true_period, end_true_period,
                     plot_mp=plot_mp, mp_ind=i)
 
         return runtime
 
-    def gen_plot(self, dates, to_plot, plot_offset, start_true_period,
-                 end_true_period, plot_mp=False, mp_ind=None):
+    def gen_plot(self, dates, to_plot, start_true_period, end_true_period,
+                 plot_mp=False, mp_ind=None):
 
         frame_start_times = np.loadtxt(self.inputs.frame_start_times)
         framing = self.inputs.framing
@@ -1002,38 +1381,21 @@ class PlotMeanDisplacementRC(BaseInterface):
         ax.set_ylim(25, 60)
         if plot_mp:
             col = ['b', 'g', 'r']
-        if plot_offset:
-            for i in range(0, len(start_true_period)):
-                if plot_mp:
-                    for ii in range(3):
-                        ax.plot(
-                            dates[start_true_period[i] -
-                                  1:end_true_period[i] + 1],
-                            to_plot[ii, start_true_period[i] - 1:
-                                    end_true_period[i] + 1],
-                            c=col[ii], linewidth=2)
-                else:
-                    ax.plot(dates[start_true_period[i] -
-                                  1:end_true_period[i] + 1],
-                            to_plot[start_true_period[i] - 1:
-                                    end_true_period[i] + 1], c='b',
-                            linewidth=2)
-            for i in range(0, len(end_true_period) - 1):
-                if plot_mp:
-                    for ii in range(3):
-                        ax.plot(
-                            dates[end_true_period[i] - 1:
-                                  start_true_period[i + 1] + 1],
-                            to_plot[ii, end_true_period[i] - 1:
-                                    start_true_period[i + 1] + 1],
-                            c=col[ii], linewidth=2, ls='--', dashes=(2, 3))
-                else:
-                    ax.plot(
-                        dates[end_true_period[i] -
-                              1:start_true_period[i + 1] + 1],
-                        to_plot[end_true_period[i] -
-                                1:start_true_period[i + 1] + 1],
-                        c='b', linewidth=2, ls='--', dashes=(2, 3))
+        # Scanning periods are plotted as solid lines, idling periods as
+        # dashed lines joining them
+        periods = [(s, e + 1, {}) for s, e in zip(start_true_period,
+                                                   end_true_period)]
+        periods += [(max(e - 1, 0), s + 1, {'ls': '--', 'dashes': (2, 3)})
+                    for e, s in zip(end_true_period[:-1],
+                                    start_true_period[1:])]
+        for start, end, style in periods:
+            if plot_mp:
+                for ii in range(3):
+                    ax.plot(dates[start:end], to_plot[ii, start:end],
+                            c=col[ii], linewidth=2, **style)
+            else:
+                ax.plot(dates[start:end], to_plot[start:end], c='b',
+                        linewidth=2, **style)
 
         if framing:
             cl = 'yellow'
@@ -1044,30 +1406,25 @@ class PlotMeanDisplacementRC(BaseInterface):
                                           '%H%M%S.%f') -
                      dt.datetime.strptime(str(frame_start_times[0]),
                                           '%H%M%S.%f'))
-                    .total_seconds() * 1000)
-                if tt >= len(dates):
-                    tt = len(dates) - 1
-                plot.axvline(dates[int(tt)], c='b', alpha=0.3, ls='--')
+                    .total_seconds())
+                tt = min(tt, dates[-1])
+                plot.axvline(tt, c='b', alpha=0.3, ls='--')
 
                 tt1 = ((dt.datetime.strptime(str(frame_start_times[i + 1]),
                                              '%H%M%S.%f') -
                         dt.datetime.strptime(str(frame_start_times[0]),
                                              '%H%M%S.%f'))
-                       .total_seconds() * 1000)
-                if tt1 >= len(dates):
-                    tt1 = len(dates) - 1
-                plot.axvspan(dates[int(tt)], dates[int(tt1)], facecolor=cl,
-                             alpha=0.4, linewidth=0)
+                       .total_seconds())
+                tt1 = min(tt1, dates[-1])
+                plot.axvspan(tt, tt1, facecolor=cl, alpha=0.4, linewidth=0)
 
                 if i % 2 == 0:
                     cl = 'w'
                 else:
                     cl = 'yellow'
 
-        indx = np.arange(0, len(dates), 300000)
-        my_thick = [str(i) for i in np.arange(0, len(dates) / 60000, 5,
-                                              dtype=int)]
-        plot.xticks(dates[indx], my_thick)
+        my_thick = np.arange(0, dates[-1] / 60, 5, dtype=int)
+        plot.xticks(my_thick * 60, [str(i) for i in my_thick])
 #         ax.set_yscale('log')
 #         ax.set_yticks([10, 30, 50])
 #         ax.get_yaxis().set_major_formatter(matplotlib.ticker.ScalarFormatter())
@@ -1107,14 +1464,18 @@ class PlotMeanDisplacementRC(BaseInterface):
 class AffineMatAveragingInputSpec(BaseInterfaceInputSpec):
 
     frame_vol_numbers = File(exists=True)
-    all_mats4average = File(exists=True)
+    all_mats4average = File(exists=True, desc='Stack of all the motion '
+                            'matrices (motion_mats_stack format)')
+    mats_index = File(exists=True, desc='Prefix sums of all the motion '
+                      'matrices (motion_mats_index format). If provided, it '
+                      'is used instead of all_mats4average.')
 
 
 class AffineMatAveragingOutputSpec(TraitedSpec):
 
-    average_mats = Directory(exists=True, desc='directory with all the average'
-                             ' transformation matrices for each detected '
-                             'frame.')
+    average_mats = File(exists=True, desc='stack (motion_mats_stack format) '
+                        'with all the average transformation matrices for '
+                        'each detected frame.')
 
 
 class AffineMatAveraging(BaseInterface):
@@ -1125,38 +1486,24 @@ class AffineMatAveraging(BaseInterface):
     def _run_interface(self, runtime):
 
         frame_vol = np.loadtxt(self.inputs.frame_vol_numbers, dtype=int)
-        all_mats = np.loadtxt(self.inputs.all_mats4average, dtype=str)
-        idt = np.eye(4)
-
-        for v in range(len(frame_vol) - 1):
-
-            v1 = frame_vol[v]
-            v2 = frame_vol[v + 1]
-            mat_tot = np.zeros((4, 4, (v2 - v1)))
-            n_vol = 0
-
-            for j, m in enumerate(all_mats[v1:v2]):
-                mat = np.loadtxt(m)
-                if (mat == idt).all():
-                    mat_tot[:, :, j] = np.zeros((4, 4))
-                else:
-                    mat_tot[:, :, j] = mat
-                    n_vol += 1
-            if n_vol > 0:
-                average_mat = np.sum(mat_tot, axis=2) / n_vol
-            else:
-                average_mat = idt
-
-            np.savetxt(
-                'average_matrix_vol_{0}-{1}.txt'
-                .format(str(v1).zfill(4), str(v2).zfill(4)), average_mat)
-
-        if os.path.isdir('frame_mean_transformation_mats') is False:
-            os.mkdir('frame_mean_transformation_mats')
-
-        mats = glob.glob('average_matrix_vol*')
-        for m in mats:
-            shutil.move(m, 'frame_mean_transformation_mats')
+        if isdefined(self.inputs.mats_index):
+            index = load_motion_mats_index(self.inputs.mats_index)
+        elif isdefined(self.inputs.all_mats4average):
+            index = motion_mats_prefix_sums(
+                read_motion_mats(self.inputs.all_mats4average))
+        else:
+            raise Exception('Either all_mats4average or mats_index must be '
+                            'provided.')
+        # Identity matrices are excluded from the average
+        average_mats = average_motion_mats(index, frame_vol[:-1],
+                                           frame_vol[1:])
+        frame_names = [
+            'average_matrix_vol_{0}-{1}'.format(str(v1).zfill(4),
+                                                str(v2).zfill(4))
+            for v1, v2 in zip(frame_vol[:-1], frame_vol[1:])]
+
+        save_motion_mats_stack('frame_mean_transformation_mats.npy',
+                               average_mats, volume_names=frame_names)
 
         return runtime
 
@@ -1164,7 +1511,7 @@ class AffineMatAveraging(BaseInterface):
         outputs = self._outputs().get()
 
         outputs["average_mats"] = (
-            os.getcwd() + '/frame_mean_transformation_mats')
+            os.getcwd() + '/frame_mean_transformation_mats.npy')
 
         return outputs
 
@@ -1215,11 +1562,104 @@ class PetCorrectionFactor(BaseInterface):
         return outputs
 
 
+def flirt_coords_mat(img):
+    """
+    Returns the matrix mapping the voxel indices of an image to the "scaled
+    mm" coordinates FLIRT matrices are defined in, i.e. the voxel indices
+    scaled by the voxel sizes, with the x axis flipped if the image is stored
+    in neurological order (positive determinant of the affine).
+
+    Parameters
+    ----------
+    img : nibabel.Nifti1Image
+        The image the FLIRT matrices refer to
+    """
+    mat = np.diag(list(img.header.get_zooms()[:3]) + [1.0])
+    if np.linalg.det(img.affine) > 0:
+        flip = np.eye(4)
+        flip[0, 0] = -1
+        flip[0, 3] = img.shape[0] - 1
+        mat = mat.dot(flip)
+    return mat
+
+
+def flirt_to_voxel_mats(flirt_mats, in_img, ref_img=None):
+    """
+    Converts FLIRT matrices, which map input to reference coordinates, into
+    the reference voxel to input voxel mappings expected by
+    scipy.ndimage.affine_transform
+
+    Parameters
+    ----------
+    flirt_mats : np.ndarray
+        (4, 4) or (N, 4, 4) FLIRT matrices
+    in_img : nibabel.Nifti1Image
+        The image being resampled
+    ref_img : nibabel.Nifti1Image
+        The image defining the output grid. Defaults to in_img
+    """
+    if ref_img is None:
+        ref_img = in_img
+    return np.matmul(np.matmul(np.linalg.inv(flirt_coords_mat(in_img)),
+                               np.linalg.inv(flirt_mats)),
+                     flirt_coords_mat(ref_img))
+
+
+def apply_flirt_mats(img, flirt_mats, order=0, num_threads=1):
+    """
+    In-process equivalent of 'flirt -applyxfm' with the same image as input
+    and reference, resampling the image once for each of the given matrices
+
+    Parameters
+    ----------
+    img : nibabel.Nifti1Image
+        The image to resample
+    flirt_mats : np.ndarray
+        (N, 4, 4) FLIRT matrices to apply
+    order : int
+        Interpolation order (0 for nearest neighbour, 1 for trilinear)
+    num_threads : int
+        Number of frames to resample in parallel
+
+    Returns
+    -------
+    resampled : generator of np.ndarray
+        The resampled image data of each frame, in order
+    """
+    resample = _flirt_resampler(img, order)
+    vox_mats = iter(flirt_to_voxel_mats(flirt_mats, img))
+    num_threads = max(num_threads, 1)
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        # Resample the frames in batches so that at most num_threads of them
+        # are held in memory at once
+        while True:
+            batch = list(islice(vox_mats, num_threads))
+            if not batch:
+                break
+            for resampled in executor.map(resample, batch):
+                yield resampled
+
+
+def _flirt_resampler(img, order):
+    # Function resampling the image with a voxel-to-voxel matrix
+    data = np.asanyarray(img.dataobj)
+    in_data = data if order == 0 else data.astype(np.float32)
+
+    def resample(vox_mat):
+        resampled = ndimage.affine_transform(
+            in_data, vox_mat, order=order, mode='constant', cval=0.0)
+        if np.issubdtype(data.dtype, np.integer) and order:
+            resampled = np.rint(resampled)
+        return resampled.astype(data.dtype)
+
+    return resample
+
+
 class UmapAlign2ReferenceInputSpec(BaseInterfaceInputSpec):
 
-    average_mats = Directory(exists=True, desc='directory with all the average'
-                             ' transformation matrices for each detected '
-                             'frame.')
+    average_mats = File(exists=True, desc='stack (motion_mats_stack format) '
+                        'with all the average transformation matrices for '
+                        'each detected frame.')
     ute_regmat = File(exists=True, desc='registration mat between ute image '
                       'and reference.')
     ute_qform_mat = File(exists=True, desc='qform mat between ute and '
@@ -1231,6 +1671,13 @@ class UmapAlign2ReferenceInputSpec(BaseInterfaceInputSpec):
                       'provided umap is continuos values, as the pseudo CT '
                       'umap. Otherwise, it will assume that the values are '
                       'discrete. Default is False.')
+    backend = traits.Enum('scipy', 'flirt', usedefault=True,
+                          desc='Whether to resample the umap in-process with '
+                          'scipy (default) or by running FLIRT for each '
+                          'frame.')
+    num_threads = traits.Int(1, usedefault=True,
+                             desc='Number of frames to resample in parallel '
+                             '(scipy backend only).')
 
 
 class UmapAlign2ReferenceOutputSpec(TraitedSpec):
@@ -1246,13 +1693,35 @@ class UmapAlign2Reference(BaseInterface):
 
     def _run_interface(self, runtime):
 
-        average_mats = sorted(glob.glob(self.inputs.average_mats + '/*.txt'))
+        average_mats = read_motion_mats(self.inputs.average_mats,
+                                        pattern='*.txt')
         umap = self.inputs.umap
         pct = self.inputs.pct
         ute_regmat = self.inputs.ute_regmat
         ute_qform_mat = self.inputs.ute_qform_mat
         outname = 'Frame'
 
+        if self.inputs.backend == 'scipy':
+            if os.path.isdir('umaps_align2ref') is False:
+                os.mkdir('umaps_align2ref')
+            umap_img = nib.load(umap)
+            vox_mats = flirt_to_voxel_mats(self.ute2frame_qform_mats(
+                average_mats, ute_regmat, ute_qform_mat), umap_img)
+            resample = _flirt_resampler(umap_img, order=int(bool(pct)))
+
+            # Each frame is saved by the task that resampled it, so that at
+            # most num_threads frames are held in memory at once
+            def align_frame(i):
+                nib.save(nib.Nifti1Image(resample(vox_mats[i]),
+                                         umap_img.affine, umap_img.header),
+                         'umaps_align2ref/{0}_{1}_umap.nii.gz'.format(
+                             outname, str(i).zfill(3)))
+
+            with ThreadPoolExecutor(
+                    max_workers=max(self.inputs.num_threads, 1)) as executor:
+                list(executor.map(align_frame, range(len(vox_mats))))
+            return runtime
+
         for i, mat in enumerate(average_mats):
             self.UmapAlign2Reference_calc(mat, i, ute_regmat, ute_qform_mat,
                                           outname, umap, pct=pct)
@@ -1265,15 +1734,18 @@ class UmapAlign2Reference(BaseInterface):
 
         return runtime
 
+    @classmethod
+    def ute2frame_qform_mats(cls, mats, ute_regmat, ute_qform_mat):
+        """Matrices mapping the umap to the head position in each frame"""
+        utemat = np.loadtxt(ute_regmat)
+        utemat_qform_inv = np.linalg.inv(np.loadtxt(ute_qform_mat))
+        return np.matmul(utemat_qform_inv, np.matmul(mats, utemat))
+
     def UmapAlign2Reference_calc(self, mat, i, ute_regmat, ute_qform_mat,
                                  outname, umap, pct=False):
 
-        mat = np.loadtxt(mat)
-        utemat = np.loadtxt(ute_regmat)
-        utemat_qform = np.loadtxt(ute_qform_mat)
-        utemat_qform_inv = np.linalg.inv(utemat_qform)
-        ute2frame = np.dot(mat, utemat)
-        ute2frame_qform = np.dot(utemat_qform_inv, ute2frame)
+        ute2frame_qform = self.ute2frame_qform_mats(mat, ute_regmat,
+                                                    ute_qform_mat)
         ute2frame_qform_inv = np.linalg.inv(ute2frame_qform)
 
         np.savetxt('{0}_{1}_ref_to_ute.mat'.format(outname, str(i).zfill(3)),
@@ -1314,10 +1786,16 @@ class CreateMocoSeriesInputSpec(BaseInterfaceInputSpec):
     motion_par = File(exists=True, mandatory=True, desc='Text file with the '
                       'motion parameters extracted by the mean displacement '
                       'calculation pipeline.')
-    start_times = File(exists=True, mandatory=True, desc='start times of all '
-                       'the sequences (or volumes) acquired in the study ('
-                       'this is the output of the mean displacement calculatio'
-                       'n pipeline).')
+    start_times = File(exists=True, mandatory=True, xor=['timeline'],
+                       desc='start times of all the sequences (or volumes) '
+                       'acquired in the study (this is the output of the mean '
+                       'displacement calculation pipeline).')
+    timeline = File(exists=True, mandatory=True, xor=['start_times'],
+                    desc='acquisition timeline of all the sequences (or '
+                    'volumes) acquired in the study (see banana.utils.timeline'
+                    '.AcquisitionTimeline).')
+    num_threads = traits.Int(1, usedefault=True, desc='Number of instances '
+                             'to write in parallel.')
 
 
 class CreateMocoSeriesOutputSpec(TraitedSpec):
@@ -1335,45 +1813,50 @@ class CreateMocoSeries(BaseInterface):
 
         moco_template = self.inputs.moco_template
         motion_par = np.loadtxt(self.inputs.motion_par)
-        start_times = np.loadtxt(self.inputs.start_times, dtype=str)
-        start_times = start_times[:-1]
+        if isdefined(self.inputs.timeline):
+            timeline = AcquisitionTimeline.load(self.inputs.timeline)
+        else:
+            timeline = AcquisitionTimeline.from_start_times(
+                np.loadtxt(self.inputs.start_times, dtype=str))
+        start_times = timeline.to_clock_times(timeline.starts)
 
         if len(motion_par) != len(start_times):
             raise Exception('Detected a different number of motion parameters '
                             'and start times. This number must be the same in '
                             'order to create a new moco series. Please check.')
-        motion_par_moco = [self.fsl2moco(x) for x in motion_par]
+        motion_par_moco = self.fsl2moco(motion_par)
         new_uid = pydicom.uid.generate_uid()
-        for i in range(len(start_times)):
-            hd = pydicom.read_file(moco_template)
-            for n in range(3):
-                hd[0x19, 0x1025].value[n] = motion_par_moco[i][n]
+        template = pydicom.read_file(moco_template)
+        os.mkdir('new_moco_series')
+
+        def write_instance(i):
+            hd = copy.deepcopy(template)
             for n in range(3):
-                hd[0x19, 0x1026].value[n] = motion_par_moco[i][n + 3]
+                hd[0x19, 0x1025].value[n] = float(motion_par_moco[i, n])
+                hd[0x19, 0x1026].value[n] = float(motion_par_moco[i, n + 3])
             hd.AcquisitionTime = start_times[i]
             hd.InstanceNumber = pydicom.valuerep.IS(i + 1)
             hd.AcquisitionNumber = pydicom.valuerep.IS(i + 1)
             hd.SeriesInstanceUID = new_uid
             hd.SeriesDescription = 'MoCoSeries'
             hd.SeriesNumber = '150'
-            hd.save_as('{}.IMA'.format(str(i).zfill(6)))
+            hd.save_as('new_moco_series/{}.IMA'.format(str(i).zfill(6)))
 
-        os.mkdir('new_moco_series')
-        dicoms = sorted(glob.glob('*.IMA'))
-        for dcm in dicoms:
-            shutil.move(dcm, 'new_moco_series')
+        with ThreadPoolExecutor(
+                max_workers=max(self.inputs.num_threads, 1)) as executor:
+            list(executor.map(write_instance, range(len(start_times))))
 
         return runtime
 
     def fsl2moco(self, mp):
-        rot_x_moco = -self.rad2degree(mp[1])
-        rot_y_moco = self.rad2degree(mp[0])
-        rot_z_moco = -self.rad2degree(mp[2])
-        trans_x_moco = -mp[4]
-        trans_y_moco = mp[3]
-        trans_z_moco = -mp[5]
-        return [trans_x_moco, trans_y_moco, trans_z_moco, rot_x_moco,
-                rot_y_moco, rot_z_moco]
+        """Converts (N, 6) FSL motion parameters (rotations in radians first)
+        into the Siemens moco convention (translations first, rotations in
+        degrees)"""
+        mp = np.asarray(mp, dtype=float)
+        return np.stack((-mp[..., 4], mp[..., 3], -mp[..., 5],
+                         -self.rad2degree(mp[..., 1]),
+                         self.rad2degree(mp[..., 0]),
+                         -self.rad2degree(mp[..., 2])), axis=-1)
 
     def rad2degree(self, alpha_rad):
         return alpha_rad * 180 / np.pi
@@ -1392,21 +1875,25 @@ class FixedBinningInputSpec(BaseInterfaceInputSpec):
                           'realignment matrices for.')
     pet_offset = traits.Int(desc='seconds from the start of the PET you want '
                             'to discard before starting the data binning.')
-    bin_len = traits.Int(desc='Temporal length in seconds for each bin.')
+    bin_len = traits.Float(desc='Temporal length in seconds for each bin.')
     start_times = File(desc='Start times of all the scans in the study. This '
                        'is generated by mean displacement calculation '
                        'pipeline.')
+    timeline = File(exists=True, desc='Acquisition timeline of all the scans '
+                    'in the study (see banana.utils.timeline'
+                    '.AcquisitionTimeline). If provided it is used instead of '
+                    'the start times.')
     pet_duration = traits.Int(desc='PET temporal duration in seconds.')
     pet_start_time = traits.Str(desc='PET start time')
-    motion_mats = File(exists=True, desc='Text file with the list of all the '
-                       'motion matrices.')
+    motion_mats = File(exists=True, desc='Stack of all the motion matrices '
+                       '(motion_mats_stack format).')
 
 
 class FixedBinningOutputSpec(TraitedSpec):
 
-    average_bin_mats = Directory(desc='Directory with all the matrices to be '
-                                 'used to realign the reconstructed '
-                                 'fixed-binning PET images.')
+    average_bin_mats = File(desc='Stack (motion_mats_stack format) with all '
+                            'the matrices to be used to realign the '
+                            'reconstructed fixed-binning PET images.')
 
 
 class FixedBinning(BaseInterface):
@@ -1419,10 +1906,14 @@ class FixedBinning(BaseInterface):
         n_frames = self.inputs.n_frames
         pet_offset = self.inputs.pet_offset
         bin_len = self.inputs.bin_len
-        start_times = np.loadtxt(self.inputs.start_times, dtype=str)
+        if isdefined(self.inputs.timeline):
+            timeline = AcquisitionTimeline.load(self.inputs.timeline)
+        else:
+            timeline = AcquisitionTimeline.from_start_times(
+                np.loadtxt(self.inputs.start_times, dtype=str))
         pet_duration = self.inputs.pet_duration
         pet_start_time = self.inputs.pet_start_time
-        motion_mats = np.loadtxt(self.inputs.motion_mats, dtype=str)
+        motion_mats = read_motion_mats(self.inputs.motion_mats)
         if n_frames == 0 and pet_offset == 0:
             pet_len = pet_duration
         elif n_frames == 0 and pet_offset != 0:
@@ -1430,107 +1921,33 @@ class FixedBinning(BaseInterface):
         elif n_frames != 0:
             pet_len = bin_len * n_frames
 
-        MR_start_time = dt.datetime.strptime(str(start_times[0]), '%H%M%S.%f')
-        start_times_diff = [
-            (dt.datetime.strptime(str(start_times[i + 1]), '%H%M%S.%f') -
-             dt.datetime.strptime(
-                 str(start_times[i]), '%H%M%S.%f')).total_seconds()
-            for i in range(len(start_times) - 1)]
-        scan_duration = np.cumsum(np.asarray(start_times_diff))
-
-        pet_st = (dt.datetime.strptime(str(pet_start_time), '%H%M%S.%f') +
-                  dt.timedelta(seconds=pet_offset))
-        PetBins = [pet_st + dt.timedelta(seconds=x) for x in
-                   range(0, pet_len, bin_len)]
-        MrBins = [MR_start_time + dt.timedelta(seconds=x)
-                  for x in scan_duration]
-        MrStartPoints = [MrBins[i] + dt.timedelta(
-            seconds=(MrBins[i + 1] - MrBins[i]).total_seconds() / 2) for i in
-            range(len(MrBins) - 1)]
-
-        indxs = []
-        PetBins.append(pet_st + dt.timedelta(seconds=pet_len))
+        # Work in float seconds from the start of the MR acquisition, each
+        # matrix being assigned to the mid point of its volume
+        vol_bounds = timeline.bounds
+        vol_mid_points = (vol_bounds[:-1] + vol_bounds[1:]) / 2
+
+        pet_st_sec = timeline.to_seconds(pet_start_time) + pet_offset
+        bin_edges = pet_st_sec + np.append(np.arange(0, pet_len, bin_len),
+                                           pet_len)
         if pet_offset != 0:
             print(('PET start time offset of {0} seconds detected. '
                    'Fixed binning will start at {2} and will last '
                    'for {1} seconds.'.format(str(pet_offset), str(pet_len),
-                                             pet_st.strftime('%H%M%S.%f'))))
-        for pet_bin in PetBins:
-
-            for i in range(len(MrStartPoints) - 1):
-                if (pet_bin > MrStartPoints[i] and
-                        pet_bin < MrStartPoints[i + 1]):
-                    MrDiff = (
-                        (MrStartPoints[i + 1] -
-                         MrStartPoints[i]).total_seconds())
-                    w0 = (MrStartPoints[i + 1] -
-                          pet_bin).total_seconds() / MrDiff
-                    w1 = (pet_bin - MrStartPoints[i]).total_seconds() / MrDiff
-                    indxs.append([[w0, i], [w1, i + 1]])
-                    break
-                elif pet_bin < MrStartPoints[i]:
-                    indxs.append([[1, i], [0, i + 1]])
-                    break
-        while len(indxs) < len(PetBins):
-            indxs.append([[0, len(MrStartPoints) - 2],
-                          [1, len(MrStartPoints) - 1]])
-        z = 0
-        for ii in range(len(indxs) - 1):
-            start = indxs[ii]
-            end = indxs[ii + 1]
-            s1 = start[0][1]
-            e1 = start[1][1]
-            s2 = end[0][1]
-            e2 = end[1][1]
-            if s1 == s2 and e1 == e2:
-                mat_s1 = np.loadtxt(motion_mats[s1])
-                mat_e1 = np.loadtxt(motion_mats[e1])
-                av_mat = start[0][0] * mat_s1 + start[1][0] * mat_e1
-                np.savetxt(
-                    'average_motion_mat_bin_{0}.txt'.format(str(z).zfill(3)),
-                    av_mat)
-                z = z + 1
-            elif (s1 + 1 == s2 and e1 + 1 == e2) or (s1 + 2 == s2 and
-                                                     e1 + 2 == e2):
-                mat_s1 = np.loadtxt(motion_mats[s1])
-                mat_e1 = np.loadtxt(motion_mats[e1])
-                mat_s2 = np.loadtxt(motion_mats[s2])
-                mat_e2 = np.loadtxt(motion_mats[e2])
-                av_mat_1 = start[0][0] * mat_s1 + start[1][0] * mat_e1
-                av_mat_2 = end[0][0] * mat_s2 + end[1][0] * mat_e2
-                mean_mat = (av_mat_1 + av_mat_2) / 2
-                np.savetxt(
-                    'average_motion_mat_bin_{0}.txt'.format(str(z).zfill(3)),
-                    mean_mat)
-                z = z + 1
-            else:
-                mat_tot = np.zeros((4, 4, (s2 - s1)))
-                mat_s1 = np.loadtxt(motion_mats[s1])
-                mat_e1 = np.loadtxt(motion_mats[e1])
-                mat_s2 = np.loadtxt(motion_mats[s2])
-                mat_e2 = np.loadtxt(motion_mats[e2])
-                mat_tot[:, :, 0] = (
-                    start[0][0] * mat_s1 + start[1][0] * mat_e1)
-                mat_tot[:, :, -1] = (
-                    end[0][0] * mat_s2 + end[1][0] * mat_e2)
-                for i, m in enumerate(range(e1 + 1, s2)):
-                    mat_tot[:, :, i + 1] = np.loadtxt(motion_mats[m])
-                mean_mat = np.mean(mat_tot, axis=2)
-                np.savetxt(
-                    'average_motion_mat_bin_{0}.txt'
-                    .format(str(z).zfill(3)), mean_mat)
-                z = z + 1
-        os.mkdir('average_bin_mats')
-        files = glob.glob('*bin*.txt')
-        for f in files:
-            shutil.move(f, 'average_bin_mats')
+                                             timeline.to_clock_times(
+                                                 pet_st_sec))))
+        average_bin_mats = bin_motion_mats(
+            motion_mats[:len(vol_mid_points)], vol_mid_points, bin_edges)
+        bin_names = ['average_motion_mat_bin_{0}'.format(str(z).zfill(3))
+                     for z in range(len(average_bin_mats))]
+        save_motion_mats_stack('average_bin_mats.npy', average_bin_mats,
+                               volume_names=bin_names)
 
         return runtime
 
     def _list_outputs(self):
         outputs = self._outputs().get()
 
-        outputs["average_bin_mats"] = os.getcwd() + '/average_bin_mats'
+        outputs["average_bin_mats"] = os.getcwd() + '/average_bin_mats.npy'
 
         return outputs
 
@@ -6,21 +6,80 @@ import numpy as np
 from nipype.utils.filemanip import split_filename
 import os
 import matplotlib.pyplot as plot
-from sklearn.decomposition import PCA
 import subprocess as sp
 from nipype.interfaces.base.traits_extension import Directory, isdefined
 import shutil
 import glob
 import pydicom
 from nipype.interfaces import fsl
-
-
-list_mode_framing_path = os.path.abspath(
-    os.path.join(os.path.dirname(__file__), '..', 'resources', 'C_C++',
-                 'ListModeFraming'))
-interfile_path = os.path.abspath(
-    os.path.join(os.path.dirname(__file__), '..', 'resources', 'pet',
-                 'biograph_mmr_short_int.hs'))
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from scipy import ndimage
+from banana.interfaces.motion_correction import (
+    read_motion_mats, flirt_to_voxel_mats)
+from banana.utils.list_mode import (
+    unlist_list_mode, read_list_mode_header, list_mode_header_path,
+    MMR_SINOGRAM_SIZE)
+from banana.utils.sinogram import (
+    ssrb_files, sinogram_pca, detect_motion_events)
+from banana.utils.voxels import (
+    load_mask, iter_voxel_blocks, slab_size_for, memmapped_image,
+    create_nifti_memmap, gzip_file, open_image, regional_statistics,
+    save_regional_statistics)
+from banana.utils.kinetics import kinetic_maps
+from banana.exceptions import BananaUsageError
+from banana.utils.timeline import (
+    IntervalTimeline, AcquisitionTimeline, parse_hhmmss, format_hhmmss)
+
+
+def dual_regression(img, regression_maps, mask=None, slab_size=None):
+    """
+    Dual regression of a 4D image against one or more spatial maps. The time
+    course of each map is the projection of the time series of every voxel
+    onto the map, and the resulting spatial maps are the projections of the
+    time series onto each time course, z-scored over the voxels of the mask.
+    The image is streamed in slabs from a memory map (see banana.utils.voxels
+    .iter_voxel_blocks and open_image), so it is only read twice whatever the
+    number of maps, and all computations are restricted to the mask and done
+    in float32.
+
+    Parameters
+    ----------
+    img : nibabel.Nifti1Image | str
+        The 4D image
+    regression_maps : np.ndarray
+        The 3D map or a 4D stack of maps (along the last axis)
+    mask : np.ndarray | str | None
+        Mask of the voxels to include (all voxels if None)
+    slab_size : int | None
+        Number of axial slices read at a time
+
+    Returns
+    -------
+    timecourses : np.ndarray
+        The (n_timepoints, n_maps) time course of each map
+    spatial_maps : np.ndarray
+        The (x, y, z, n_maps) z-scored spatial maps (zero outside the mask)
+    """
+    regression_maps = np.asarray(regression_maps, dtype=np.float32)
+    if regression_maps.ndim == 3:
+        regression_maps = regression_maps[..., np.newaxis]
+    n_maps = regression_maps.shape[-1]
+    with open_image(img) as img:
+        mask = load_mask(mask, img.shape[:3])
+        timecourses = np.zeros((img.shape[3], n_maps))
+        for slab, slab_mask, block in iter_voxel_blocks(img, mask,
+                                                        slab_size):
+            timecourses += block.T.dot(
+                regression_maps[:, :, slab][slab_mask])
+        timecourses = timecourses.astype(np.float32)
+        spatial_maps = np.zeros(img.shape[:3] + (n_maps,), dtype=np.float32)
+        for slab, slab_mask, block in iter_voxel_blocks(img, mask,
+                                                        slab_size):
+            spatial_maps[:, :, slab][slab_mask] = block.dot(timecourses)
+    masked = spatial_maps[mask]
+    spatial_maps[mask] = ((masked - masked.mean(axis=0, dtype=np.float64)) /
+                          masked.std(axis=0, dtype=np.float64))
+    return timecourses, spatial_maps
 
 
 class PETdrInputSpec(BaseInterfaceInputSpec):
@@ -28,7 +87,11 @@ class PETdrInputSpec(BaseInterfaceInputSpec):
     volume = File(exists=True, desc='4D input for the dual regression',
                   mandatory=True)
     regression_map = File(exists=True, desc='3D map to use for the spatial '
-                          'regression (first step of the dr)', mandatory=True)
+                          'regression (first step of the dr), or a 4D stack '
+                          'of maps (e.g. ICA components) to regress in a '
+                          'single pass', mandatory=True)
+    brain_mask = File(exists=True, desc='Mask the regression is restricted '
+                      'to (default all voxels)')
     threshold = traits.Float(desc='Threshold to be applied to the abs(reg_map)'
                              ' before regression (default zero)', default=0.0)
     binarize = traits.Bool(desc='If True, all the voxels greater than '
@@ -40,10 +103,13 @@ class PETdrOutputSpec(TraitedSpec):
 
     spatial_map = File(
         exists=True, desc='Nifti file containing result for the temporal '
-        'regression')
+        'regression (4D if multiple regression maps are provided)')
     timecourse = File(
         exists=True, desc='Png file containing result for the spatial '
         'regression')
+    timecourses = File(
+        exists=True, desc='Text file with the time course of each regression '
+        'map (one column per map)')
 
 
 class PETdr(BaseInterface):
@@ -59,31 +125,29 @@ class PETdr(BaseInterface):
         _, base, _ = split_filename(fname)
         _, base_map, _ = split_filename(mapname)
 
-        img = nib.load(fname)
-        data = np.array(img.get_data())
-        spatial_regressor = nib.load(mapname)
-        spatial_regressor = np.array(spatial_regressor.get_data())
+        spatial_regressor = np.asarray(nib.load(mapname).dataobj,
+                                       dtype=np.float32)
 
-        n_voxels = data.shape[0]*data.shape[1]*data.shape[2]
-        ts = data.reshape(n_voxels, data.shape[3])
-        mask = spatial_regressor.reshape(n_voxels, 1)
         if th and not binarize:
-            mask[np.abs(mask) < th] = 0
+            spatial_regressor[np.abs(spatial_regressor) < th] = 0
             base = base+'_th_{}'.format(str(th))
         elif th and binarize:
-            mask[mask < th] = 0
-            mask[mask >= th] = 1
+            spatial_regressor = (spatial_regressor >= th).astype(np.float32)
             base = base+'_bin_th_{}'.format(str(th))
-        timecourse = np.dot(ts.T, mask)
-        sm = np.dot(ts, timecourse)
-        mean = np.mean(sm)
-        std = np.std(sm)
-        sm_zscore = (sm-mean)/std
-
-        im2save = nib.Nifti1Image(
-            sm_zscore.reshape(spatial_regressor.shape), affine=img.affine)
+        mask = (self.inputs.brain_mask
+                if isdefined(self.inputs.brain_mask) else None)
+        with memmapped_image(fname, tmp_dir=os.getcwd()) as img:
+            affine = img.affine
+            timecourse, sm_zscore = dual_regression(img, spatial_regressor,
+                                                    mask=mask)
+        if spatial_regressor.ndim == 3:
+            sm_zscore = sm_zscore[..., 0]
+
+        im2save = nib.Nifti1Image(sm_zscore, affine=affine)
         nib.save(
             im2save, '{0}_{1}_GLM_fit_zscore.nii.gz'.format(base, base_map))
+        np.savetxt('{0}_{1}_timecourses.txt'.format(base, base_map),
+                   timecourse)
 
         plot.plot(timecourse)
         plot.savefig('{0}_{1}_timecourse.png'.format(base, base_map))
@@ -109,14 +173,92 @@ class PETdr(BaseInterface):
             '{0}_{1}_GLM_fit_zscore.nii.gz'.format(base, base_map))
         outputs["timecourse"] = os.path.abspath(
             '{0}_{1}_timecourse.png'.format(base, base_map))
+        outputs["timecourses"] = os.path.abspath(
+            '{0}_{1}_timecourses.txt'.format(base, base_map))
 
         return outputs
 
 
+def leading_temporal_component(img, mask=None, slab_size=None):
+    """
+    The leading principal component of the time series of the voxels of a 4D
+    image (i.e. the temporal PCA component that is removed by
+    GlobalTrendRemoval). The voxels are streamed in slabs (see
+    banana.utils.voxels.iter_voxel_blocks) to accumulate the (time x time)
+    covariance matrix, whose leading eigenvector is the component.
+
+    Parameters
+    ----------
+    img : nibabel.Nifti1Image | str
+        The 4D image (or path to it)
+    mask : np.ndarray | str | None
+        Mask of the voxels to include (all voxels if None)
+    slab_size : int | None
+        Number of axial slices read at a time
+
+    Returns
+    -------
+    component : np.ndarray
+        The unit-norm leading component (n_timepoints,)
+    """
+    with open_image(img) as img:
+        n_vols = img.shape[3]
+        sums = np.zeros(n_vols)
+        products = np.zeros((n_vols, n_vols))
+        n_voxels = 0
+        for _, _, block in iter_voxel_blocks(img, mask, slab_size):
+            sums += block.sum(axis=0, dtype=np.float64)
+            products += block.T.dot(block)
+            n_voxels += len(block)
+    covariance = products - np.outer(sums, sums) / n_voxels
+    _, eigvecs = np.linalg.eigh(covariance)
+    return eigvecs[:, -1]
+
+
+def remove_global_trend(img, out_path, mask=None, slab_size=None):
+    """
+    Removes the leading temporal principal component from the time series of
+    every voxel (within the mask) of a 4D image, streaming the image in slabs
+    and writing the result into a memory-mapped (uncompressed) NIfTI file
+
+    Parameters
+    ----------
+    img : nibabel.Nifti1Image | str
+        The 4D image (or path to it)
+    out_path : str
+        Path of the detrended image (.nii)
+    mask : np.ndarray | str | None
+        Mask of the voxels to detrend (all voxels if None), the voxels outside
+        the mask being copied unchanged
+    slab_size : int | None
+        Number of axial slices read at a time
+    """
+    with open_image(img) as img:
+        mask = load_mask(mask, img.shape[:3])
+        if slab_size is None:
+            slab_size = slab_size_for(img.shape)
+        baseline = leading_temporal_component(img, mask, slab_size).astype(
+            np.float32)
+        detrended = create_nifti_memmap(out_path, img.shape, img.affine)
+        for z0 in range(0, img.shape[2], slab_size):
+            slab = slice(z0, min(z0 + slab_size, img.shape[2]))
+            # Copy so that the data of in-memory images isn't modified in
+            # place
+            data = np.array(img.dataobj[:, :, slab], dtype=np.float32)
+            slab_mask = mask[:, :, slab]
+            ts = data[slab_mask]
+            data[slab_mask] = ts - np.outer(ts.dot(baseline), baseline)
+            detrended[:, :, slab] = data
+        detrended.flush()
+        del detrended
+
+
 class GlobalTrendRemovalInputSpec(BaseInterfaceInputSpec):
 
     volume = File(exists=True, desc='4D input file',
                   mandatory=True)
+    brain_mask = File(exists=True, desc='Mask the trend is estimated from and'
+                      ' removed within (default all voxels)')
 
 
 class GlobalTrendRemovalOutputSpec(TraitedSpec):
@@ -135,21 +277,13 @@ class GlobalTrendRemoval(BaseInterface):
 
         fname = self.inputs.volume
         _, base, _ = split_filename(fname)
+        mask = (self.inputs.brain_mask
+                if isdefined(self.inputs.brain_mask) else None)
 
-        img = nib.load(fname)
-        data = np.array(img.get_data())
-
-        n_voxels = data.shape[0]*data.shape[1]*data.shape[2]
-        ts = data.reshape(n_voxels, data.shape[3])
-        pca = PCA(50)
-        pca.fit(ts)
-        baseline = np.reshape(
-            pca.components_[0, :], (len(pca.components_[0, :]), 1))
-        new_ts = ts.T-np.dot(baseline, np.dot(np.linalg.pinv(baseline), ts.T))
-        im2save = nib.Nifti1Image(
-            new_ts.T.reshape(data.shape), affine=img.affine)
-        nib.save(
-            im2save, '{}_baseline_removed.nii.gz'.format(base))
+        with memmapped_image(fname, tmp_dir=os.getcwd()) as img:
+            remove_global_trend(
+                img, '{}_baseline_removed.nii'.format(base), mask=mask)
+        gzip_file('{}_baseline_removed.nii'.format(base))
 
         return runtime
 
@@ -191,14 +325,13 @@ class SUVRCalculation(BaseInterface):
         _, base, _ = split_filename(fname)
 
         img = nib.load(fname)
-        data = np.array(img.get_data())
-        mask = nib.load(maskname)
-        mask = np.array(mask.get_data())
-
-        [x, y, z] = np.where(mask > 0)
-        ii = np.arange(x.shape[0])
-        mean_uptake = np.mean(data[x[ii], y[ii], z[ii]])
-        new_data = data / mean_uptake
+        mask = np.asarray(nib.load(maskname).dataobj) > 0
+        if not mask.any():
+            raise BananaUsageError(
+                "Baseline mask '{}' is empty, so the SUVR can't be calculated"
+                .format(maskname))
+        mean_uptake = regional_statistics(img, mask).means[0, 0]
+        new_data = np.asarray(img.dataobj, dtype=np.float64) / mean_uptake
         im2save = nib.Nifti1Image(new_data, affine=img.affine)
         nib.save(im2save, '{}_SUVR.nii.gz'.format(base))
 
@@ -216,192 +349,363 @@ class SUVRCalculation(BaseInterface):
         return outputs
 
 
-class PrepareUnlistingInputsInputSpec(BaseInterfaceInputSpec):
+class RegionalStatisticsInputSpec(BaseInterfaceInputSpec):
 
-    time_offset = traits.Int(desc='Time between the PET start time and the '
-                             'time when you want to initiate the sinogram '
-                             'sorting (in seconds).')
-    num_frames = traits.Int(desc='Number of frame you want to unlist.')
-    temporal_len = traits.Float(desc='Temporal duration, in seconds, of each '
-                                'frame. Minumum is 0.001.')
-    list_mode = File(exists=True, desc='Listmode data')
+    volume = File(exists=True, desc='3D or 4D input file', mandatory=True)
+    label_image = File(exists=True, mandatory=True,
+                       desc='Label image (e.g. atlas) of the regions')
+    reference_mask = File(
+        exists=True, desc='Mask of the reference region, the ratio of the '
+        'mean of each region to that of the reference region (e.g. SUVR) '
+        'being added to the table')
+    out_file = File(genfile=True, desc='Path of the CSV table')
 
 
-class PrepareUnlistingInputsOutputSpec(TraitedSpec):
+class RegionalStatisticsOutputSpec(TraitedSpec):
 
-    out = traits.List(desc='List of all the outputs for PETListModeUnlisting '
-                      'pipeline')
+    out_file = File(
+        exists=True, desc='CSV table of the voxel count, mean, sum and std of '
+        'each region in each frame')
 
 
-class PrepareUnlistingInputs(BaseInterface):
+class RegionalStatistics(BaseInterface):
+    """
+    Computes the statistics of every region of a label image in every frame
+    of an image (i.e. regional SUVRs or time-activity curves) in a single
+    pass (see banana.utils.voxels.regional_statistics)
+    """
 
-    input_spec = PrepareUnlistingInputsInputSpec
-    output_spec = PrepareUnlistingInputsOutputSpec
+    input_spec = RegionalStatisticsInputSpec
+    output_spec = RegionalStatisticsOutputSpec
 
     def _run_interface(self, runtime):
+        reference_mask = (self.inputs.reference_mask
+                          if isdefined(self.inputs.reference_mask) else None)
+        with memmapped_image(self.inputs.volume,
+                             tmp_dir=os.getcwd()) as img:
+            stats = regional_statistics(img, self.inputs.label_image,
+                                        reference_mask=reference_mask)
+        save_regional_statistics(self._gen_filename('out_file'), stats)
+        return runtime
 
-        time_offset = self.inputs.time_offset
-        num_frames = self.inputs.num_frames
-        temporal_len = self.inputs.temporal_len
-        list_mode = self.inputs.list_mode
-
-        start_times = (np.arange(time_offset, num_frames*temporal_len,
-                                 temporal_len)).tolist()
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['out_file'] = self._gen_filename('out_file')
+        return outputs
 
-        self.list_outputs = list(zip([list_mode]*len(start_times), start_times,
-                                 [temporal_len]*len(start_times)))
+    def _gen_filename(self, name):
+        if name == 'out_file':
+            if isdefined(self.inputs.out_file):
+                fname = os.path.abspath(self.inputs.out_file)
+            else:
+                _, base, _ = split_filename(self.inputs.volume)
+                fname = os.path.abspath(
+                    '{}_regional_stats.csv'.format(base))
+        else:
+            assert False
+        return fname
+
+
+class GraphicalKineticAnalysisInputSpec(BaseInterfaceInputSpec):
+
+    volume = File(exists=True, desc='4D (dynamic) PET image', mandatory=True)
+    frame_times = File(
+        exists=True, mandatory=True, desc='Text file with the start time and '
+        'duration of each frame of the volume (i.e. of the reconstructed '
+        'frames) or a single column of frame mid-times')
+    input_function = File(
+        exists=True, xor=['input_mask'], desc='Text file with the (plasma) '
+        'input function sampled at each frame')
+    input_mask = File(
+        exists=True, xor=['input_function'], desc='Mask of the reference '
+        'region or of the blood pool (image-derived input function), whose '
+        'mean time-activity curve is used as the input function')
+    brain_mask = File(exists=True, desc='Mask of the voxels to fit (default '
+                      'all voxels)')
+    start_time = traits.Float(
+        desc='Time (in the units of the frame times) from which the Patlak '
+        'and Logan plots are assumed to be linear (default the mid-time of '
+        'the middle frame)')
+    num_threads = traits.Int(1, usedefault=True,
+                             desc='Number of voxel blocks fitted in parallel')
+
+
+class GraphicalKineticAnalysisOutputSpec(TraitedSpec):
+
+    patlak_slope = File(exists=True, desc='Patlak slope (influx constant) map')
+    patlak_intercept = File(exists=True, desc='Patlak intercept map')
+    logan_slope = File(exists=True, desc='Logan slope (distribution volume '
+                       '(ratio)) map')
+    logan_intercept = File(exists=True, desc='Logan intercept map')
+
+
+class GraphicalKineticAnalysis(BaseInterface):
+    """
+    Voxelwise Patlak and Logan graphical analysis of a dynamic PET image (see
+    banana.utils.kinetics.kinetic_maps)
+    """
+
+    input_spec = GraphicalKineticAnalysisInputSpec
+    output_spec = GraphicalKineticAnalysisOutputSpec
 
+    def _run_interface(self, runtime):
+        frame_times = np.loadtxt(self.inputs.frame_times, ndmin=1)
+        # Check the number of frames from the header before the (possibly
+        # compressed) volume is read
+        n_vols = int(np.prod(nib.load(self.inputs.volume).shape[3:]))
+        if len(frame_times) != n_vols:
+            raise BananaUsageError(
+                "Number of frames in '{}' ({}) doesn't match the number of "
+                "volumes in '{}' ({}). The frame times need to be those of "
+                "the reconstructed frames".format(
+                    self.inputs.frame_times, len(frame_times),
+                    self.inputs.volume, n_vols))
+        mask = (self.inputs.brain_mask
+                if isdefined(self.inputs.brain_mask) else None)
+        start_time = (self.inputs.start_time
+                      if isdefined(self.inputs.start_time) else None)
+        _, base, _ = split_filename(self.inputs.volume)
+        with memmapped_image(self.inputs.volume,
+                             tmp_dir=os.getcwd()) as img:
+            if isdefined(self.inputs.input_function):
+                input_function = np.loadtxt(self.inputs.input_function,
+                                            ndmin=1)
+            elif isdefined(self.inputs.input_mask):
+                input_mask = np.asarray(
+                    nib.load(self.inputs.input_mask).dataobj) > 0
+                input_function = regional_statistics(
+                    img, input_mask.astype(np.int8)).means[0]
+            else:
+                raise BananaUsageError(
+                    "Either 'input_function' or 'input_mask' needs to be "
+                    "provided to GraphicalKineticAnalysis")
+            maps = kinetic_maps(img, input_function, frame_times, mask=mask,
+                                start_time=start_time,
+                                num_threads=self.inputs.num_threads)
+            affine = img.affine
+        for name, data in zip(maps._fields, maps):
+            nib.save(nib.Nifti1Image(data, affine),
+                     '{}_{}.nii.gz'.format(base, name))
         return runtime
 
     def _list_outputs(self):
         outputs = self._outputs().get()
-
-        outputs["out"] = self.list_outputs
-
+        _, base, _ = split_filename(self.inputs.volume)
+        for name in ('patlak_slope', 'patlak_intercept', 'logan_slope',
+                     'logan_intercept'):
+            outputs[name] = os.path.abspath('{}_{}.nii.gz'.format(base, name))
         return outputs
 
 
-class PETListModeUnlistingInputSpec(BaseInterfaceInputSpec):
+class ListModeUnlistingInputSpec(BaseInterfaceInputSpec):
 
-    list_inputs = traits.List(desc='List containing the time_offset and the '
-                              'temporal frame length, as generated by '
-                              'PrepareUnlistingInputs')
+    list_mode = File(exists=True, mandatory=True, desc='Listmode data')
+    time_offset = traits.Float(
+        0.0, usedefault=True, desc='Time between the PET start time and the '
+        'time when you want to initiate the sinogram sorting (in seconds).')
+    num_frames = traits.Int(mandatory=True,
+                            desc='Number of frame you want to unlist.')
+    temporal_len = traits.Float(mandatory=True,
+                                desc='Temporal duration, in seconds, of each '
+                                'frame. Minumum is 0.001.')
+    delays = traits.Bool(False, usedefault=True,
+                         desc='Store the delayed events after the prompts in '
+                         'each sinogram')
+    sinogram_size = traits.Int(MMR_SINOGRAM_SIZE, usedefault=True,
+                               desc='Number of bins in the sinogram (default '
+                               'that of the Biograph mMR)')
+    chunk_size = traits.Int(2 ** 24, usedefault=True,
+                            desc='Number of list-mode words decoded at a time')
+    num_threads = traits.Int(1, usedefault=True,
+                             desc='Number of threads used to decode the '
+                             'list-mode data')
 
 
-class PETListModeUnlistingOutputSpec(TraitedSpec):
+class ListModeUnlistingOutputSpec(TraitedSpec):
 
-    pet_sinogram = File(exists=True, desc='unlisted sinogram.')
+    pet_sinograms = traits.List(File(exists=True),
+                                desc='unlisted sinogram of each frame.')
 
 
-class PETListModeUnlisting(BaseInterface):
+class ListModeUnlisting(BaseInterface):
+    """
+    Unlists all the frames from a single pass over the list-mode data (see
+    banana.utils.list_mode.unlist_list_mode) instead of running the
+    ListModeFraming binary over the whole file for each frame. Frames that
+    start after the end of the acquisition (as given by the header of the
+    accompanying DICOM file if present) are skipped.
+    """
 
-    input_spec = PETListModeUnlistingInputSpec
-    output_spec = PETListModeUnlistingOutputSpec
+    input_spec = ListModeUnlistingInputSpec
+    output_spec = ListModeUnlistingOutputSpec
 
     def _run_interface(self, runtime):
-
-        file_path = self.inputs.list_inputs[0]
-        start = self.inputs.list_inputs[1]
-        frame_len = self.inputs.list_inputs[2]
-        end = start+frame_len
-        print('Unlisting Frame {}'.format(str(start/frame_len)))
-        cmd = (
-            '{0} {1} 0 {2} 4 {3} {4} {5}'.format(
-                list_mode_framing_path, file_path, str(frame_len), str(start),
-                str(end), str(start/frame_len)))
-        sp.check_output(cmd, shell=True)
-
+        start_times = (self.inputs.time_offset + np.arange(
+            self.inputs.num_frames) * self.inputs.temporal_len)
+        if os.path.exists(list_mode_header_path(self.inputs.list_mode)):
+            duration = read_list_mode_header(self.inputs.list_mode).duration
+            if duration:
+                start_times = start_times[start_times < duration]
+        self.sinograms = unlist_list_mode(
+            self.inputs.list_mode, start_times, self.inputs.temporal_len,
+            out_dir=os.getcwd(), sinogram_size=self.inputs.sinogram_size,
+            delays=self.inputs.delays, chunk_size=self.inputs.chunk_size,
+            num_threads=self.inputs.num_threads)
         return runtime
 
     def _list_outputs(self):
         outputs = self._outputs().get()
-        start = self.inputs.list_inputs[0]
-        frame_len = self.inputs.list_inputs[1]
-        fname = self.inputs.list_mode
-
-        _, _, ext = split_filename(fname)
-
-        outputs["pet_sinogram"] = (
-            os.getcwd()+'/Frame{0}{1}'.format(str(start/frame_len).zfill(5),
-                                              ext))
-
+        outputs['pet_sinograms'] = self.sinograms
         return outputs
 
 
 class SSRBInputSpec(BaseInterfaceInputSpec):
 
-    unlisted_sinogram = File(exists=True, desc='unlisted sinogram, output of '
-                             'PETListModeUnlisting.')
+    unlisted_sinograms = traits.List(
+        File(exists=True), mandatory=True,
+        desc='unlisted sinograms, output of ListModeUnlisting. Sinograms '
+        'unlisted with delays are rebinned into stacks of the rebinned '
+        'prompts and delays.')
+    num_segments_to_combine = traits.Int(
+        1, usedefault=True, desc='Number of neighbouring segments to combine '
+        '(must be odd)')
+    view_mash = traits.Int(36, usedefault=True,
+                           desc='Number of neighbouring views to combine')
+    normalise = traits.Bool(False, usedefault=True,
+                            desc='Normalise by the number of contributing '
+                            'sinogram bins')
+    num_threads = traits.Int(1, usedefault=True,
+                             desc='Number of frames to rebin in parallel')
 
 
 class SSRBOutputSpec(TraitedSpec):
 
-    ssrb_sinogram = File(exists=True, desc='Sinogram compressed using SSRB '
-                         'algorithm. This will be the input of the PCA method '
-                         'for motion detection')
+    ssrb_sinograms = traits.List(
+        File(exists=True), desc='Sinograms compressed using SSRB algorithm. '
+        'These will be the input of the PCA method for motion detection')
+    sinogram_folder = Directory(desc='Directory containing all the compressed '
+                                'sinograms.')
 
 
 class SSRB(BaseInterface):
+    """
+    Single-slice rebinning of the sinograms of all frames (see
+    banana.utils.sinogram.ssrb), saved as float32 .npy files into a single
+    directory
+    """
 
     input_spec = SSRBInputSpec
     output_spec = SSRBOutputSpec
 
     def _run_interface(self, runtime):
-
-        unlisted_sinogram = self.inputs.unlisted_sinogram
-        basename = unlisted_sinogram.split('.')[0]
-        new_ext = '.s'
-        new_name = basename+new_ext
-        os.rename(unlisted_sinogram, new_name)
-        self.gen_interfiles(new_name)
-        num_segs_to_combine = 1
-        view_mash = 36
-        do_ssrb_norm = 0
-        cmd = ('SSRB {0}_ssrb {0}.hs {1} {2} {3}'
-               .format(basename, num_segs_to_combine, view_mash, do_ssrb_norm))
-        sp.check_output(cmd, shell=True)
-        os.remove(basename+'.hs')
-
+        out_dir = self._sinogram_folder()
+        if not os.path.isdir(out_dir):
+            os.mkdir(out_dir)
+        self.ssrb_sinograms = ssrb_files(
+            self.inputs.unlisted_sinograms, out_dir,
+            num_threads=self.inputs.num_threads,
+            num_segments_to_combine=self.inputs.num_segments_to_combine,
+            view_mash=self.inputs.view_mash,
+            normalise=self.inputs.normalise)
         return runtime
 
-    def gen_interfiles(self, sinogram):
-
-        file_pre = sinogram.split('/')[-1].split('.')[0]
-        file_suf = '.hs'
-        print('New file name: ' + file_pre + file_suf)
-        with open(file_pre + file_suf, 'w') as new_file:
-            with open(interfile_path) as old_file:
-                for line in old_file:
-                    new_file.write(
-                        line.replace('name of data file := biograph_mmr.s\n',
-                                     'name of data file := ' +
-                                     sinogram.split('/')[-1]+'\n'))
-
-        new_file.close()
-        old_file.close()
-
     def _list_outputs(self):
         outputs = self._outputs().get()
-        unlisted_sinogram = self.inputs.unlisted_sinogram
-        basename = unlisted_sinogram.split('.')[0]
-
-        outputs["ssrb_sinogram"] = basename+'_ssrb.s'
-
+        outputs["ssrb_sinograms"] = self.ssrb_sinograms
+        outputs["sinogram_folder"] = self._sinogram_folder()
         return outputs
 
-
-class MergeUnlistingOutputsInputSpec(BaseInterfaceInputSpec):
-
-    sinograms = traits.List(desc='List of ssrb sinogram to merge into'
-                            'one folder.')
-
-
-class MergeUnlistingOutputsOutputSpec(TraitedSpec):
-
-    sinogram_folder = Directory(desc='Directory containing all the compressed '
-                                'sinograms.')
-
-
-class MergeUnlistingOutputs(BaseInterface):
-
-    input_spec = MergeUnlistingOutputsInputSpec
-    output_spec = MergeUnlistingOutputsOutputSpec
+    def _sinogram_folder(self):
+        return os.path.join(os.getcwd(), 'PET_sinograms_for_PCA')
+
+
+class SinogramPCAMotionDetectionInputSpec(BaseInterfaceInputSpec):
+
+    sinogram_folder = Directory(exists=True, mandatory=True,
+                                desc='Directory containing the SSRB sinograms '
+                                'of all frames (.npy), output of SSRB')
+    temporal_len = traits.Float(mandatory=True,
+                                desc='Temporal duration, in seconds, of each '
+                                'frame.')
+    time_offset = traits.Float(0.0, usedefault=True,
+                               desc='Time between the PET start time and the '
+                               'start of the first frame (in seconds).')
+    pet_start_time = traits.Str(desc='PET start time')
+    timeline = File(exists=True, desc='Acquisition timeline of the session '
+                    '(see banana.utils.timeline.AcquisitionTimeline), used to '
+                    'place the frames on the same timeline as the MR-based '
+                    'motion framing. Requires pet_start_time.')
+    n_components = traits.Int(3, usedefault=True,
+                              desc='Number of principal components')
+    method = traits.Enum('gram', 'incremental', usedefault=True,
+                         desc='PCA method (see banana.utils.sinogram'
+                         '.sinogram_pca)')
+    batch_size = traits.Int(16, usedefault=True,
+                            desc='Number of frames read at a time by the '
+                            'incremental PCA')
+    event_threshold = traits.Float(
+        3.0, usedefault=True, desc='Frame-to-frame changes in the motion '
+        'surrogate larger than this number of (robust) standard deviations '
+        'are detected as motion events')
+
+
+class SinogramPCAMotionDetectionOutputSpec(TraitedSpec):
+
+    surrogate_rc = File(exists=True, desc='Principal component scores of each'
+                        ' frame (the first being the motion surrogate) as a '
+                        'real clock timeline (see banana.utils.timeline'
+                        '.IntervalTimeline)')
+    motion_event_times = File(exists=True, desc='Start times of the frames '
+                              'following a detected motion event, in real '
+                              'clock time if the PET start time is provided '
+                              'or in seconds from the PET start otherwise.')
+
+
+class SinogramPCAMotionDetection(BaseInterface):
+    """
+    Data-driven motion detection from the principal components of the (SSRB)
+    sinograms of short frames (see banana.utils.sinogram.sinogram_pca). The
+    sinograms are streamed from disk so hundreds of frames can be analysed.
+    """
+
+    input_spec = SinogramPCAMotionDetectionInputSpec
+    output_spec = SinogramPCAMotionDetectionOutputSpec
 
     def _run_interface(self, runtime):
-
-        sinograms = self.inputs.sinograms
-        if os.path.isdir('PET_sinograms_for_PCA') is False:
-            os.mkdir('PET_sinograms_for_PCA')
-        for s in sinograms:
-            shutil.move(s, 'PET_sinograms_for_PCA')
-
+        sinograms = sorted(glob.glob(
+            os.path.join(self.inputs.sinogram_folder, '*.npy')))
+        scores, _ = sinogram_pca(
+            sinograms, n_components=self.inputs.n_components,
+            method=self.inputs.method, batch_size=self.inputs.batch_size)
+        starts = (self.inputs.time_offset +
+                  np.arange(len(sinograms)) * self.inputs.temporal_len)
+        # Place the frames on the session timeline (seconds since its start)
+        study_start_time = None
+        if isdefined(self.inputs.pet_start_time):
+            if isdefined(self.inputs.timeline):
+                timeline = AcquisitionTimeline.load(self.inputs.timeline)
+            else:
+                timeline = AcquisitionTimeline(
+                    parse_hhmmss(self.inputs.pet_start_time), [], [])
+            starts += timeline.to_seconds(self.inputs.pet_start_time)
+            study_start_time = format_hhmmss(timeline.session_start)
+        IntervalTimeline(
+            starts, starts + self.inputs.temporal_len, scores,
+            study_start_time=study_start_time).save('surrogate_rc.txt')
+        event_starts = starts[detect_motion_events(
+            scores[:, 0], threshold=self.inputs.event_threshold)]
+        if study_start_time is not None:
+            event_starts = timeline.to_clock_times(event_starts)
+        np.savetxt('motion_event_times.txt', np.asarray(event_starts),
+                   fmt='%s')
         return runtime
 
     def _list_outputs(self):
         outputs = self._outputs().get()
-
-        outputs["sinogram_folder"] = os.getcwd()+'/PET_sinograms_for_PCA'
-
+        outputs['surrogate_rc'] = os.path.join(os.getcwd(),
+                                               'surrogate_rc.txt')
+        outputs['motion_event_times'] = os.path.join(
+            os.getcwd(), 'motion_event_times.txt')
         return outputs
 
 
@@ -506,23 +810,65 @@ class PreparePetDir(BaseInterface):
         return outputs
 
 
+def fov_crop_affine(img, mins):
+    """
+    The affine of an image cropped to the box starting at the voxel `mins`
+    (computed from the header only)
+    """
+    new_affine = np.copy(img.affine)
+    new_affine[:3, -1] = (img.affine[:3, -1]-np.multiply(
+        img.header.get_zooms()[:3], mins) * np.sign(img.affine[:3, -1]))
+    return new_affine
+
+
+def crop_fov(in_file, out_file, box, affine):
+    """
+    Crops an image to a box, reading only the voxels within it through the
+    image's array proxy (compressed images are only decompressed up to the
+    end of the box)
+
+    Parameters
+    ----------
+    in_file : str
+        Path to the (3D or 4D) image to crop
+    out_file : str
+        Path of the cropped image
+    box : tuple[slice]
+        The x, y and z slices of the box to crop to
+    affine : np.ndarray
+        The affine of the cropped image (see fov_crop_affine)
+    """
+    pet_cropped = nib.load(in_file).dataobj[box]
+    im2save = nib.Nifti1Image(pet_cropped, affine=affine)
+    im2save.set_qform(affine, code='scanner')
+    im2save.set_sform(affine, code='scanner')
+    nib.save(im2save, out_file)
+    return out_file
+
+
 class PETFovCroppingInputSpec(BaseInterfaceInputSpec):
 
-    pet_image = File(exists=True, desc='PET images to crop.')
-#     ref_pet = File(exists=True, desc='Reference image to use to save the '
-#                    'cropped PET. Usually is the output of fslroi command '
-#                    'with the same cropping parameters.')
+    pet_image = File(exists=True, xor=['pet_images'],
+                     desc='PET images to crop.')
+    pet_images = traits.List(
+        File(exists=True), xor=['pet_image'], desc='PET frames to crop (in '
+        'parallel). They are assumed to share the same geometry, the affine '
+        'of the cropped images being computed from the first.')
     x_min = traits.Int()
     x_size = traits.Int()
     y_min = traits.Int()
     y_size = traits.Int()
     z_min = traits.Int()
     z_size = traits.Int()
+    num_threads = traits.Int(1, usedefault=True,
+                             desc='Number of frames to crop in parallel')
 
 
 class PETFovCroppingOutputSpec(TraitedSpec):
 
     pet_cropped = File(exists=True, desc='Cropped PET')
+    pet_cropped_images = traits.List(File(exists=True),
+                                     desc='Cropped PET frames')
 
 
 class PETFovCropping(BaseInterface):
@@ -532,55 +878,47 @@ class PETFovCropping(BaseInterface):
 
     def _run_interface(self, runtime):
 
-        pet_image = self.inputs.pet_image
-#         ref = self.inputs.ref_pet
-        x_min = self.inputs.x_min
-        x_size = self.inputs.x_size
-        y_min = self.inputs.y_min
-        y_size = self.inputs.y_size
-        z_min = self.inputs.z_min
-        z_size = self.inputs.z_size
-        _, basename, ext = split_filename(pet_image)
-        outname = basename+'_crop'+ext
-        pet = nib.load(pet_image)
-        new_affine = np.copy(pet.affine)
-        new_affine[:3, -1] = (pet.affine[:3, -1]-np.multiply(
-            pet.header.get_zooms()[:3], (x_min, y_min, z_min)) *
-            np.sign(pet.affine[:3, -1]))
-        pet = pet.get_data()
-        if len(pet.shape) == 3:
-            pet_cropped = pet[x_min:x_min+x_size, y_min:y_min+y_size,
-                              z_min:z_min+z_size]
-        elif len(pet.shape) == 4:
-            pet_cropped = pet[x_min:x_min+x_size, y_min:y_min+y_size,
-                              z_min:z_min+z_size, :]
-#         cmd = 'fslroi {} ref_roi 100 130 100 130 20 100'.format(im)
-#         sp.check_output(cmd, shell=True)
-#         ref = nib.load(ref)
-        im2save = nib.Nifti1Image(pet_cropped, affine=new_affine)
-        im2save.set_qform(new_affine, code='scanner')
-        im2save.set_sform(new_affine, code='scanner')
-        nib.save(im2save, outname)
+        in_files = self._in_files()
+        mins = (self.inputs.x_min, self.inputs.y_min, self.inputs.z_min)
+        box = (slice(self.inputs.x_min, self.inputs.x_min+self.inputs.x_size),
+               slice(self.inputs.y_min, self.inputs.y_min+self.inputs.y_size),
+               slice(self.inputs.z_min, self.inputs.z_min+self.inputs.z_size))
+        new_affine = fov_crop_affine(nib.load(in_files[0]), mins)
+        with ThreadPoolExecutor(
+                max_workers=max(self.inputs.num_threads, 1)) as executor:
+            list(executor.map(
+                lambda f: crop_fov(f, self._out_fname(f), box, new_affine),
+                in_files))
 
         return runtime
 
     def _list_outputs(self):
         outputs = self._outputs().get()
-        pet_image = self.inputs.pet_image
-        _, basename, ext = split_filename(pet_image)
-        outname = basename+'_crop'+ext
-
-        outputs["pet_cropped"] = os.getcwd()+'/'+outname
+        out_files = [self._out_fname(f) for f in self._in_files()]
+        if isdefined(self.inputs.pet_images):
+            outputs["pet_cropped_images"] = out_files
+        else:
+            outputs["pet_cropped"] = out_files[0]
 
         return outputs
 
+    def _in_files(self):
+        if isdefined(self.inputs.pet_images):
+            return self.inputs.pet_images
+        return [self.inputs.pet_image]
+
+    @staticmethod
+    def _out_fname(in_file):
+        _, basename, ext = split_filename(in_file)
+        return os.getcwd()+'/'+basename+'_crop'+ext
+
 
 class CheckPetMCInputsInputSpec(BaseInterfaceInputSpec):
 
     pet_data = Directory(desc='Directory with the reconstructed PET images.')
-    motion_mats = Directory(
-        desc='Directory with the motion matrices calculated by the '
-        'frame2reference pipeline')
+    motion_mats = File(
+        desc='Stack (motion_mats_stack format) with the motion matrices '
+        'calculated by the frame2reference pipeline')
     corr_factors = File(
         desc='Text file with the PET temporal correction factors used to '
         'generate the static PET motion corrected image.')
@@ -591,7 +929,6 @@ class CheckPetMCInputsOutputSpec(TraitedSpec):
 
     pet_images = traits.List(desc='List of PET images found in the PET recon'
                              ' directory.')
-    motion_mats = traits.List(desc='List of motion matrices.')
     corr_factors = traits.List(desc='List of PET temporal correction factors.')
     pet2ref_mat = File(exists=True, desc='Matrix that transform images from '
                        'PET space to reference space.')
@@ -606,8 +943,8 @@ class CheckPetMCInputs(BaseInterface):
 
         dct = {}
         pet_data = sorted(glob.glob(self.inputs.pet_data+'/*.nii.gz'))
-        motion_mats = sorted(glob.glob(
-            self.inputs.motion_mats+'/*.txt'))
+        motion_mats = read_motion_mats(self.inputs.motion_mats,
+                                       pattern='*.txt')
         reference = self.inputs.reference
         if isdefined(self.inputs.corr_factors):
             corr_factors = np.loadtxt(self.inputs.corr_factors).tolist()
@@ -629,7 +966,6 @@ class CheckPetMCInputs(BaseInterface):
             pet2ref = np.dot(ref_qform_inv, pet_qform)
             np.savetxt('pet2ref.mat', pet2ref)
             dct['pet_data'] = pet_data
-            dct['motion_mats'] = motion_mats
             if (corr_factors is not None and
                     (len(pet_data) == len(corr_factors))):
                 dct['corr_factors'] = corr_factors
@@ -665,7 +1001,6 @@ class CheckPetMCInputs(BaseInterface):
         outputs = self._outputs().get()
 
         outputs["pet_images"] = self.dct['pet_data']
-        outputs["motion_mats"] = self.dct['motion_mats']
         outputs["corr_factors"] = self.dct['corr_factors']
         outputs["pet2ref_mat"] = os.getcwd()+'/pet2ref.mat'
 
@@ -754,19 +1089,8 @@ class PetImageMotionCorrection(BaseInterface):
 
     def extract_qform(self, image):
 
-        cmd = 'fslhd {}'.format(image)
-        image_info = (sp.check_output(cmd, shell=True)).decode('utf-8')
-        image_info = image_info.strip().split('\n')
         qform = np.eye(4)
-        for i, line in enumerate(image_info):
-            if 'qto_xyz:1' in line:
-                qform[0, -1] = abs(float(
-                    image_info[i].split(':1')[-1].strip().split()[-1]))
-                qform[1, -1] = abs(float(
-                    image_info[i+1].split(':2')[-1].strip().split()[-1]))
-                qform[2, -1] = abs(float(
-                    image_info[i+2].split(':3')[-1].strip().split()[-1]))
-                break
+        qform[:3, -1] = np.abs(nib.load(image).get_qform()[:3, -1])
 
         return qform
 
@@ -781,10 +1105,136 @@ class PetImageMotionCorrection(BaseInterface):
         return outputs
 
 
+def motion_correct_pet_frame(pet_image, transformation_mat, corr_factor,
+                             out_basename, reference=None):
+    """
+    Resamples one PET frame to the reference position given the FLIRT
+    transformation matrix and applies the temporal correction factor to both
+    the motion corrected and uncorrected frames. Defined at module level so
+    that it can be run in a process pool.
+
+    Returns
+    -------
+    pet_mc_image : str
+        Path to the motion corrected frame
+    pet_no_mc_image : str
+        Path to the frame without motion correction
+    """
+    pet_img = nib.load(pet_image)
+    ref_img = nib.load(reference) if reference else pet_img
+    data = np.asanyarray(pet_img.dataobj).astype(np.float32)
+    vox_mat = flirt_to_voxel_mats(transformation_mat, pet_img, ref_img)
+    mc_data = ndimage.affine_transform(
+        data, vox_mat, output_shape=ref_img.shape[:3], order=1,
+        mode='constant', cval=0.0)
+    basename = pet_image.split('/')[-1].split('.')[0]
+    outname = os.path.abspath('{0}_{1}'.format(basename, out_basename))
+    pet_mc_image = outname + '_mc_corr.nii.gz'
+    pet_no_mc_image = outname + '_no_mc_corr.nii.gz'
+    for out_data, img, fname in ((mc_data, ref_img, pet_mc_image),
+                                 (data, pet_img, pet_no_mc_image)):
+        out_img = nib.Nifti1Image(out_data * np.float32(corr_factor),
+                                  img.affine, img.header)
+        out_img.set_data_dtype(np.float32)
+        nib.save(out_img, fname)
+    return pet_mc_image, pet_no_mc_image
+
+
+class PetImageMotionCorrectionBatchInputSpec(BaseInterfaceInputSpec):
+
+    pet_images = traits.List(File(exists=True), mandatory=True,
+                             desc='List of the fov cropped PET frames.')
+    motion_mats = File(exists=True, mandatory=True,
+                       desc='Stack (motion_mats_stack format) with one motion '
+                       'matrix per PET frame.')
+    corr_factors = traits.List(traits.Float(), desc='PET temporal correction '
+                               'factor for each frame. Default is 1.')
+    pet2ref_mat = File(exists=True, mandatory=True)
+    structural_image = File(desc='If provided, the final PET mc images will '
+                            'be aligned to this image.')
+    structural2ref_regmat = File()
+    num_processes = traits.Int(1, usedefault=True, desc='Number of frames to '
+                               'correct in parallel.')
+
+
+class PetImageMotionCorrectionBatchOutputSpec(TraitedSpec):
+
+    pet_mc_image = traits.List(File(exists=True), desc='Motion corrected PET '
+                               'frames.')
+    pet_no_mc_image = traits.List(File(exists=True), desc='PET frames without '
+                                  'motion correction.')
+
+
+class PetImageMotionCorrectionBatch(BaseInterface):
+    """
+    Same as PetImageMotionCorrection but for all the PET frames at once. The
+    transformation matrices of all the frames are composed in one go and each
+    frame is resampled and corrected in memory, the frames being distributed
+    over a process pool.
+    """
+
+    input_spec = PetImageMotionCorrectionBatchInputSpec
+    output_spec = PetImageMotionCorrectionBatchOutputSpec
+
+    def _run_interface(self, runtime):
+
+        pet_images = self.inputs.pet_images
+        motion_mats = read_motion_mats(self.inputs.motion_mats,
+                                       pattern='*.txt')
+        if len(motion_mats) != len(pet_images):
+            raise Exception(
+                "The number of PET frames ({0}) is different from that of the "
+                "motion matrices ({1}). Please check."
+                .format(len(pet_images), len(motion_mats)))
+        if isdefined(self.inputs.corr_factors) and self.inputs.corr_factors:
+            corr_factors = self.inputs.corr_factors
+        else:
+            corr_factors = [1.0] * len(pet_images)
+        pet2ref_mat = np.loadtxt(self.inputs.pet2ref_mat)
+        if isdefined(self.inputs.structural_image):
+            reference = self.inputs.structural_image
+            ref2pet_mat = np.linalg.inv(
+                np.loadtxt(self.inputs.structural2ref_regmat))
+            out_basename = 'al2Struct'
+        else:
+            reference = None
+            ref2pet_mat = np.linalg.inv(pet2ref_mat)
+            out_basename = 'al2Ref'
+        transformation_mats = np.matmul(
+            np.matmul(ref2pet_mat, np.linalg.inv(motion_mats)), pet2ref_mat)
+        args = (pet_images, transformation_mats, corr_factors,
+                [out_basename] * len(pet_images),
+                [reference] * len(pet_images))
+        if self.inputs.num_processes > 1:
+            with ProcessPoolExecutor(
+                    max_workers=self.inputs.num_processes) as executor:
+                results = list(executor.map(motion_correct_pet_frame, *args))
+        else:
+            results = list(map(motion_correct_pet_frame, *args))
+        self.pet_mc_images, self.pet_no_mc_images = (
+            [list(r) for r in zip(*results)])
+
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+
+        outputs["pet_mc_image"] = self.pet_mc_images
+        outputs["pet_no_mc_image"] = self.pet_no_mc_images
+        return outputs
+
+
 class StaticPETImageGenerationInputSpec(BaseInterfaceInputSpec):
 
     pet_mc_images = traits.List()
     pet_no_mc_images = traits.List()
+    frame_weights = traits.List(
+        traits.Float(), desc='Optional weight (e.g. the duration) of each '
+        'frame. If provided, the static images are the weighted sums of the '
+        'frames. Only for direct use of the interface: it is left '
+        'unconnected in MotionDetectionMixin, whose frames are already '
+        'scaled by their correction factors (the fraction of the total '
+        'duration they cover) in PetImageMotionCorrectionBatch.')
 
 
 class StaticPETImageGenerationOutputSpec(TraitedSpec):
@@ -802,21 +1252,47 @@ class StaticPETImageGeneration(BaseInterface):
 
         pet_mc_images = self.inputs.pet_mc_images
         pet_no_mc_images = self.inputs.pet_no_mc_images
+        if isdefined(self.inputs.frame_weights) and self.inputs.frame_weights:
+            weights = self.inputs.frame_weights
+        else:
+            weights = [1.0] * len(pet_mc_images)
+        if not (len(pet_mc_images) == len(pet_no_mc_images) == len(weights)):
+            raise Exception(
+                "Mismatching number of motion corrected frames ({0}), frames "
+                "without motion correction ({1}) and frame weights ({2})"
+                .format(len(pet_mc_images), len(pet_no_mc_images),
+                        len(weights)))
 
-        self.frames_sum('mc_corr', pet_mc_images)
-        self.frames_sum('no_mc_corr', pet_no_mc_images)
+        self.frames_sum(['mc_corr', 'no_mc_corr'],
+                        [pet_mc_images, pet_no_mc_images], weights)
 
         return runtime
 
-    def frames_sum(self, outname, images):
-
-        cmd = 'fslmaths '
-        for i, frame in enumerate(images):
-            if i != len(images)-1:
-                cmd = cmd + '{0} -add '.format(frame)
-            else:
-                cmd = (cmd+'{0} static_PET_{1}'.format(frame, outname))
-        sp.check_output(cmd, shell=True)
+    def frames_sum(self, outnames, image_lists, weights):
+        """
+        Sums each list of frames into a static image, reading each frame once
+        into a float32 accumulator so that only one volume per output (plus
+        the frame being read) is held in memory at any time
+        """
+        accumulators = [None] * len(outnames)
+        ref_imgs = [None] * len(outnames)
+        for frames, weight in zip(zip(*image_lists), weights):
+            for i, frame in enumerate(frames):
+                img = nib.load(frame)
+                data = np.asarray(img.dataobj, dtype=np.float32)
+                if weight != 1.0:
+                    data *= np.float32(weight)
+                if accumulators[i] is None:
+                    accumulators[i] = data
+                    ref_imgs[i] = img
+                else:
+                    accumulators[i] += data
+        for outname, accumulator, ref_img in zip(outnames, accumulators,
+                                                 ref_imgs):
+            static = nib.Nifti1Image(accumulator, ref_img.affine,
+                                     ref_img.header)
+            static.set_data_dtype(np.float32)
+            nib.save(static, 'static_PET_{}.nii.gz'.format(outname))
 
     def _list_outputs(self):
         outputs = self._outputs().get()
@@ -1,13 +1,85 @@
-
 from nipype.interfaces.base import (BaseInterface, BaseInterfaceInputSpec,
-                                    traits, File, TraitedSpec)
+                                    traits, File, TraitedSpec, isdefined)
 import nibabel as nib
 import numpy as np
-from sklearn.decomposition import FastICA as fICA
+from concurrent.futures import ProcessPoolExecutor
+from sklearn.decomposition import FastICA as fICA, PCA
 from nipype.utils.filemanip import split_filename
+from banana.utils.voxels import load_mask, iter_voxel_blocks, memmapped_image
 import os
 
 
+def fast_ica(ica_input, n_components, n_pca_components=None,
+             random_state=None):
+    """
+    Runs FastICA on a (n_samples, n_features) matrix, reducing its
+    dimensionality with a randomized PCA first
+
+    Parameters
+    ----------
+    ica_input : np.ndarray
+        The data to decompose
+    n_components : int
+        Number of independent components to extract
+    n_pca_components : int | None
+        Number of principal components the data is reduced to before the ICA
+        (n_components if None, no reduction if 0)
+    random_state : int | None
+        Seed of the randomized PCA and FastICA
+
+    Returns
+    -------
+    sources : np.ndarray
+        The (n_samples, n_components) estimated sources
+    components : np.ndarray
+        The (n_components, n_features) unmixing matrix (i.e. FastICA's
+        components_ in the space of the original features)
+    """
+    if n_pca_components is None:
+        n_pca_components = n_components
+    pca = None
+    if n_pca_components:
+        pca = PCA(n_components=max(n_pca_components, n_components),
+                  svd_solver='randomized', random_state=random_state)
+        ica_input = pca.fit_transform(ica_input)
+    ica = fICA(n_components=n_components, random_state=random_state)
+    sources = ica.fit_transform(ica_input)
+    components = ica.components_
+    if pca is not None:
+        components = components.dot(pca.components_)
+    return sources, components
+
+
+def match_components(reference, components):
+    """
+    Matches each component of a reference decomposition to the most similar
+    component (by absolute correlation) of another decomposition, e.g. one
+    from a different random restart
+
+    Parameters
+    ----------
+    reference : np.ndarray
+        (n_samples, n_components) reference components
+    components : np.ndarray
+        (n_samples, n_components) components to match
+
+    Returns
+    -------
+    similarity : np.ndarray
+        The absolute correlation of each reference component with its best
+        match
+    """
+    n = reference.shape[1]
+    corr = np.corrcoef(reference.T, components.T)[:n, n:]
+    return np.nanmax(np.abs(corr), axis=1)
+
+
+def skew_sign_flips(sm):
+    "Signs that make the distribution of each column positively skewed"
+    dt = sm - sm.mean(axis=0)
+    return np.where((dt ** 3).mean(axis=0) < 0, -1.0, 1.0)
+
+
 class FastICAInputSpec(BaseInterfaceInputSpec):
 
     volume = File(exists=True, desc='4D file to be decomposed using ICA',
@@ -16,6 +88,22 @@ class FastICAInputSpec(BaseInterfaceInputSpec):
                               mandatory=True)
     ica_type = traits.Str(desc='Type of ICA to run. Possible types are '
                           'spatial (default) and temporal.', default='spatial')
+    brain_mask = File(exists=True, desc='Mask of the voxels to decompose '
+                      '(default all voxels)')
+    n_pca_components = traits.Int(
+        desc='Number of principal components (randomized PCA) the data is '
+        'reduced to before the ICA (default n_components, 0 for no '
+        'reduction)')
+    n_restarts = traits.Int(
+        1, usedefault=True, desc='Number of random restarts of the ICA, the '
+        'components of the first being saved and those of the others used '
+        'to assess their stability')
+    random_seed = traits.Int(desc='Seed of the first restart (incremented '
+                             'for each subsequent restart)')
+    num_processes = traits.Int(
+        1, usedefault=True, desc='Number of restarts to run in parallel. Each '
+        'worker process is sent its own (pickled) copy of the voxels x time '
+        'matrix, so memory use grows with the number of processes')
 
 
 class FastICAOutputSpec(TraitedSpec):
@@ -26,6 +114,10 @@ class FastICAOutputSpec(TraitedSpec):
         exists=True, desc='Nifti file containing ICA timecourse plots')
     mixing_mat = File(
         exists=True, desc='Text file containing ICA mixing matrix')
+    stability = File(
+        exists=True, desc='Text file containing the mean absolute '
+        'correlation of each component with its best match in the other '
+        'restarts')
 
 
 class FastICA(BaseInterface):
@@ -34,13 +126,18 @@ class FastICA(BaseInterface):
 
     def _run_interface(self, runtime):
         fname = self.inputs.volume
-        img = nib.load(fname)
         comp = self.inputs.n_components
-        data = np.array(img.get_data())
-
-        n_voxels = data.shape[0]*data.shape[1]*data.shape[2]
-        ts = data.reshape(n_voxels, data.shape[3])
         _, base, _ = split_filename(fname)
+        mask_file = (self.inputs.brain_mask
+                     if isdefined(self.inputs.brain_mask) else None)
+
+        with memmapped_image(fname, tmp_dir=os.getcwd()) as img:
+            shape = img.shape
+            affine = img.affine
+            mask = load_mask(mask_file, shape[:3])
+            ts = np.concatenate([b for _, _, b in iter_voxel_blocks(img,
+                                                                    mask)])
+        n_voxels = ts.shape[0]
 
         if self.inputs.ica_type == 'spatial':
             ica_input = ts.T
@@ -49,46 +146,48 @@ class FastICA(BaseInterface):
             ica_input = ts
             outname = 'tICA'
 
-        # Run ICA
-        ica = fICA(n_components=comp)
-        ica.fit(ica_input)
-        S_ = ica.fit_transform(ica_input)
+        # Run ICA (with restarts in parallel)
+        n_pca = (self.inputs.n_pca_components
+                 if isdefined(self.inputs.n_pca_components) else None)
+        if isdefined(self.inputs.random_seed):
+            seeds = [self.inputs.random_seed + i
+                     for i in range(self.inputs.n_restarts)]
+        else:
+            seeds = [None] * self.inputs.n_restarts
+        if len(seeds) > 1 and self.inputs.num_processes > 1:
+            with ProcessPoolExecutor(
+                    max_workers=self.inputs.num_processes) as executor:
+                results = list(executor.map(
+                    fast_ica, [ica_input] * len(seeds), [comp] * len(seeds),
+                    [n_pca] * len(seeds), seeds))
+        else:
+            results = [fast_ica(ica_input, comp, n_pca, s) for s in seeds]
+
+        # Spatial maps and timecourses of each restart
         if self.inputs.ica_type == 'spatial':
-            sm = ica.components_.T[:]
-            tc = S_[:]
+            decompositions = [(c.T, S) for S, c in results]
         else:
-            sm = S_[:]
-            tc = ica.components_.T[:]
-
-        ica_zscore = np.zeros((data.shape[0], data.shape[1],
-                               data.shape[2], self.inputs.n_components))
-        ica_tc = np.zeros((data.shape[3], self.inputs.n_components))
-        for i in range(self.inputs.n_components):
-            dt = sm[:, i]-np.mean(sm[:, i])
-            num = np.mean(dt**3)
-            denom = (np.mean(dt**2))**1.5
-            s = num / denom
-            print(s)
-            if np.sign(s) == -1:
-                print('Flipping sign of component {}'.format(str(i)))
-                sm[:, i] = -1*sm[:, i]
-                tc[:, i] = -1*tc[:, i]
-
-            pc = sm[:, i].reshape(
-                data.shape[0], data.shape[1], data.shape[2])
-
-            vstd = np.linalg.norm(sm[:, i])/np.sqrt(n_voxels-1)
-            if vstd != 0:
-                pc_zscore = pc/vstd
-            else:
-                print('Not converting to z-scores as division by zero'
-                      ' warning may occur.')
-                pc_zscore = pc
-            ica_zscore[:, :, :, i] = pc_zscore
-            ica_tc[:, i] = tc[:, i]
-
-        im2save = nib.Nifti1Image(ica_zscore, affine=img.affine)
-        tc2save = nib.Nifti1Image(ica_tc, affine=np.eye(4))
+            decompositions = [(S, c.T) for S, c in results]
+        S_ = results[0][0]
+        sm, tc = decompositions[0]
+
+        if len(results) > 1:
+            stability = np.mean([match_components(sm, other)
+                                 for other, _ in decompositions[1:]], axis=0)
+        else:
+            stability = np.ones(comp)
+
+        signs = skew_sign_flips(sm)
+        sm = sm * signs
+        tc = tc * signs
+        vstd = np.linalg.norm(sm, axis=0) / np.sqrt(n_voxels - 1)
+        sm = sm / np.where(vstd != 0, vstd, 1.0)
+
+        ica_zscore = np.zeros(shape[:3] + (comp,), dtype=np.float32)
+        ica_zscore[mask] = sm
+
+        im2save = nib.Nifti1Image(ica_zscore, affine=affine)
+        tc2save = nib.Nifti1Image(tc, affine=np.eye(4))
         nib.save(
             im2save, '{0}_{1}_results_pc{2}_zscore.nii.gz'
             .format(base, outname, str(self.inputs.n_components)))
@@ -98,6 +197,9 @@ class FastICA(BaseInterface):
         np.savetxt(
             '{0}_{1}_mixing_matrix_pc{2}.txt'.format(
                 base, outname, str(self.inputs.n_components)), S_)
+        np.savetxt(
+            '{0}_{1}_stability_pc{2}.txt'.format(
+                base, outname, str(self.inputs.n_components)), stability)
 
         return runtime
 
@@ -118,5 +220,8 @@ class FastICA(BaseInterface):
         outputs["mixing_mat"] = os.path.abspath(
             base+'_{0}_mixing_matrix_pc{1}.txt'.format(
                 outname, str(self.inputs.n_components)))
+        outputs["stability"] = os.path.abspath(
+            base+'_{0}_stability_pc{1}.txt'.format(
+                outname, str(self.inputs.n_components)))
 
         return outputs
@@ -26,9 +26,10 @@ from banana.interfaces.motion_correction import (
 from banana.exceptions import BananaUsageError
 from banana.reference import FslReferenceData
 from banana.file_format import (
-    nifti_format, motion_mats_format, nifti_gz_format, custom_kspace_format,
-    multi_nifti_gz_format, zip_format, text_matrix_format, STD_IMAGE_FORMATS,
-    KSPACE_FORMATS, dicom_format, gif_format, nifti_gz_x_format)
+    nifti_format, motion_mats_format, motion_mats_stack_format,
+    nifti_gz_format, custom_kspace_format, multi_nifti_gz_format, zip_format,
+    text_matrix_format, STD_IMAGE_FORMATS, KSPACE_FORMATS, dicom_format,
+    gif_format, nifti_gz_x_format)
 from banana.citation import fsl_cite, bet_cite, bet2_cite, ants_cite, spm_cite
 from banana.requirement import (
     fsl_req, mrtrix_req, ants_req, spm_req, c3d_req, matlab_req)
@@ -108,8 +109,8 @@ class MriStudy(Study, metaclass=StudyMetaClass):
         FilesetSpec('coreg_to_tmpl_ants_warp', nifti_gz_format,
                     'coreg_to_tmpl_pipeline',
                     desc=("")),
-        FilesetSpec('motion_mats', motion_mats_format, 'motion_mat_pipeline',
-                    desc=("")),
+        FilesetSpec('motion_mats', motion_mats_stack_format,
+                    'motion_mat_pipeline', desc=("")),
         FilesetSpec('qformed', nifti_gz_format, 'qform_transform_pipeline',
                     desc=("")),
         FilesetSpec('qform_mat', text_matrix_format,
@@ -1166,7 +1167,7 @@ class MriStudy(Study, metaclass=StudyMetaClass):
             'motion_mats',
             MotionMatCalculation(),
             outputs={
-                'motion_mats': ('motion_mats', motion_mats_format)})
+                'motion_mats': ('motion_mats', motion_mats_stack_format)})
         if not self.is_coregistered:
             logger.info("Cannot derive 'coreg_matrix' for {} required for "
                         "motion matrix calculation, assuming that it "
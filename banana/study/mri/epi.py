@@ -12,7 +12,7 @@ from banana.interfaces.motion_correction import (
     PrepareDWI, GenTopupConfigFiles)
 from banana.file_format import (
     nifti_gz_format, text_matrix_format,
-    par_format, motion_mats_format, dicom_format)
+    par_format, motion_mats_format, motion_mats_stack_format, dicom_format)
 from banana.interfaces.bold import FieldMapTimeInfo
 from banana.interfaces.motion_correction import (
     MergeListMotionMat, MotionMatCalculation)
@@ -361,7 +361,7 @@ class EpiSeriesStudy(EpiStudy, metaclass=StudyMetaClass):
                 'reg_mat': ('coreg_fsl_mat', text_matrix_format),
                 'qform_mat': ('qform_mat', text_matrix_format)},
             outputs={
-                'motion_mats': ('motion_mats', motion_mats_format)})
+                'motion_mats': ('motion_mats', motion_mats_stack_format)})
         if 'reverse_phase' not in self.input_names:
             pipeline.connect_input('align_mats', mm, 'align_mats',
                                    motion_mats_format)
@@ -1,7 +1,8 @@
 from arcana.data import FilesetSpec, FieldSpec, InputFilesetSpec
 from banana.file_format import (
     nifti_gz_format, directory_format, text_format, png_format, dicom_format,
-    text_matrix_format, motion_mats_format)
+    json_format, text_matrix_format, motion_mats_stack_format,
+    motion_mats_index_format)
 from banana.interfaces.motion_correction import (
     MeanDisplacementCalculation, MotionFraming, PlotMeanDisplacementRC,
     AffineMatAveraging, PetCorrectionFactor, CreateMocoSeries, FixedBinning,
@@ -20,8 +21,8 @@ from arcana.data import InputFilesets
 import logging
 from banana.study.pet.base import PetStudy
 from banana.interfaces.pet import (
-    CheckPetMCInputs, PetImageMotionCorrection, StaticPETImageGeneration,
-    PETFovCropping)
+    CheckPetMCInputs, PetImageMotionCorrectionBatch,
+    StaticPETImageGeneration, PETFovCropping)
 from arcana.study import ParamSpec, SwitchSpec
 import os
 from banana.interfaces.converters import Nii2Dicom
@@ -73,16 +74,18 @@ class MotionDetectionMixin(MultiStudy, metaclass=MultiStudyMetaClass):
                     'mean_displacement_pipeline'),
         FilesetSpec('mean_displacement_consecutive', text_format,
                     'mean_displacement_pipeline'),
-        FilesetSpec('mats4average', text_format,
+        FilesetSpec('mats4average', motion_mats_stack_format,
+                    'mean_displacement_pipeline'),
+        FilesetSpec('mats4average_index', motion_mats_index_format,
                     'mean_displacement_pipeline'),
         FilesetSpec('start_times', text_format,
                     'mean_displacement_pipeline'),
+        FilesetSpec('timeline', json_format,
+                    'mean_displacement_pipeline'),
         FilesetSpec('motion_par_rc', text_format,
                     'mean_displacement_pipeline'),
         FilesetSpec('motion_par', text_format,
                     'mean_displacement_pipeline'),
-        FilesetSpec('offset_indexes', text_format,
-                    'mean_displacement_pipeline'),
         FilesetSpec('severe_motion_detection_report', text_format,
                     'mean_displacement_pipeline'),
         FilesetSpec('frame_start_times', text_format,
@@ -91,13 +94,15 @@ class MotionDetectionMixin(MultiStudy, metaclass=MultiStudyMetaClass):
                     'motion_framing_pipeline'),
         FilesetSpec('timestamps', directory_format,
                     'motion_framing_pipeline'),
+        FilesetSpec('framing_sweep', json_format,
+                    'motion_framing_pipeline'),
         FilesetSpec('mean_displacement_plot', png_format,
                     'plot_mean_displacement_pipeline'),
         FilesetSpec('rotation_plot', png_format,
                     'plot_mean_displacement_pipeline'),
         FilesetSpec('translation_plot', png_format,
                     'plot_mean_displacement_pipeline'),
-        FilesetSpec('average_mats', directory_format,
+        FilesetSpec('average_mats', motion_mats_stack_format,
                     'frame_mean_transformation_mats_pipeline'),
         FilesetSpec('correction_factors', text_format,
                     'pet_correction_factors_pipeline'),
@@ -109,7 +114,7 @@ class MotionDetectionMixin(MultiStudy, metaclass=MultiStudyMetaClass):
                     'gather_outputs_pipeline'),
         FilesetSpec('moco_series', directory_format,
                     'create_moco_series_pipeline'),
-        FilesetSpec('fixed_binning_mats', directory_format,
+        FilesetSpec('fixed_binning_mats', motion_mats_stack_format,
                     'fixed_binning_pipeline'),
         FieldSpec('pet_duration', int, 'pet_header_extraction_pipeline'),
         FieldSpec('pet_end_time', str, 'pet_header_extraction_pipeline'),
@@ -119,7 +124,14 @@ class MotionDetectionMixin(MultiStudy, metaclass=MultiStudyMetaClass):
         ParamSpec('framing_th', 2.0),
         ParamSpec('framing_temporal_th', 30.0),
         ParamSpec('framing_duration', 0),
+        ParamSpec('framing_sweep_th', None, dtype=float, array=True,
+                  desc=("Grid of motion thresholds to sweep the motion "
+                        "framing over (see 'framing_sweep')")),
+        ParamSpec('framing_sweep_temporal_th', None, dtype=float, array=True,
+                  desc=("Grid of temporal thresholds to sweep the motion "
+                        "framing over (see 'framing_sweep')")),
         ParamSpec('md_framing', True),
+        ParamSpec('md_plot_resolution', 1.0),
         ParamSpec('align_pct', False),
         ParamSpec('align_fixed_binning', False),
         ParamSpec('moco_template', os.path.join(
@@ -136,7 +148,11 @@ class MotionDetectionMixin(MultiStudy, metaclass=MultiStudyMetaClass):
         ParamSpec('crop_zmin', 20),
         ParamSpec('crop_zsize', 100),
         ParamSpec('PET2MNI_reg', False),
-        ParamSpec('dynamic_pet_mc', False)]
+        ParamSpec('dynamic_pet_mc', False),
+        ParamSpec('num_threads', 1,
+                  desc=("Number of threads (or processes) used by each of the "
+                        "parallelised nodes, which reserve as many cores from "
+                        "the processor"))]
 
     def mean_displacement_pipeline(self, **name_maps):
 
@@ -161,7 +177,7 @@ class MotionDetectionMixin(MultiStudy, metaclass=MultiStudyMetaClass):
             else:
                 k = 'in{}'.format(merge_index)
                 motion_mats_in[k] = (spec.map('motion_mats'),
-                                     motion_mats_format)
+                                     motion_mats_stack_format)
                 tr_in[k] = (spec.map('tr'), float)
                 start_time_in[k] = (spec.map('start_time'), float)
                 real_duration_in[k] = (spec.map('real_duration'), float)
@@ -205,10 +221,12 @@ class MotionDetectionMixin(MultiStudy, metaclass=MultiStudyMetaClass):
                 'mean_displacement_consecutive': (
                     'mean_displacement_consecutive', text_format),
                 'start_times': ('start_times', text_format),
+                'timeline': ('timeline', json_format),
                 'motion_par_rc': ('motion_parameters_rc', text_format),
                 'motion_par': ('motion_parameters', text_format),
-                'offset_indexes': ('offset_indexes', text_format),
-                'mats4average': ('mats4average', text_format),
+                'mats4average': ('mats4average', motion_mats_stack_format),
+                'mats4average_index': ('mats4average_index',
+                                       motion_mats_index_format),
                 'severe_motion_detection_report': ('corrupted_volumes',
                                                    text_format)})
 
@@ -234,11 +252,19 @@ class MotionDetectionMixin(MultiStudy, metaclass=MultiStudyMetaClass):
                 'mean_displacement': ('mean_displacement', text_format),
                 'mean_displacement_consec': ('mean_displacement_consecutive',
                                              text_format),
-                'start_times': ('start_times', text_format)},
+                'timeline': ('timeline', json_format)},
             outputs={
                 'frame_start_times': ('frame_start_times', text_format),
                 'frame_vol_numbers': ('frame_vol_numbers', text_format),
-                'timestamps': ('timestamps_dir', directory_format)})
+                'timestamps': ('timestamps_dir', directory_format),
+                'framing_sweep': ('framing_sweep', json_format)})
+
+        if self.parameter('framing_sweep_th') is not None:
+            framing.inputs.sweep_motion_thresholds = self.parameter(
+                'framing_sweep_th')
+        if self.parameter('framing_sweep_temporal_th') is not None:
+            framing.inputs.sweep_temporal_thresholds = self.parameter(
+                'framing_sweep_temporal_th')
 
         if 'pet_data_dir' in self.input_names:
             pipeline.connect_input('pet_start_time', framing, 'pet_start_time')
@@ -257,10 +283,10 @@ class MotionDetectionMixin(MultiStudy, metaclass=MultiStudyMetaClass):
         pipeline.add(
             'plot_md',
             PlotMeanDisplacementRC(
-                framing=self.parameter('md_framing')),
+                framing=self.parameter('md_framing'),
+                resolution=self.parameter('md_plot_resolution')),
             inputs={
                 'mean_disp_rc': ('mean_displacement_rc', text_format),
-                'false_indexes': ('offset_indexes', text_format),
                 'frame_start_times': ('frame_start_times', text_format),
                 'motion_par_rc': ('motion_par_rc', text_format)},
             outputs={
@@ -284,9 +310,10 @@ class MotionDetectionMixin(MultiStudy, metaclass=MultiStudyMetaClass):
             AffineMatAveraging(),
             inputs={
                 'frame_vol_numbers': ('frame_vol_numbers', text_format),
-                'all_mats4average': ('mats4average', text_format)},
+                'mats_index': ('mats4average_index',
+                               motion_mats_index_format)},
             outputs={
-                'average_mats': ('average_mats', directory_format)})
+                'average_mats': ('average_mats', motion_mats_stack_format)})
 
         return pipeline
 
@@ -307,12 +334,13 @@ class MotionDetectionMixin(MultiStudy, metaclass=MultiStudyMetaClass):
                 pet_offset=self.parameter('pet_offset'),
                 bin_len=self.parameter('fixed_binning_bin_len')),
             inputs={
-                'start_times': ('start_times', text_format),
+                'timeline': ('timeline', json_format),
                 'pet_start_time': ('pet_start_time', str),
                 'pet_duration': ('pet_duration', int),
-                'motion_mats': ('mats4average', text_format)},
+                'motion_mats': ('mats4average', motion_mats_stack_format)},
             outputs={
-                'fixed_binning_mats': ('average_bin_mats', directory_format)})
+                'fixed_binning_mats': ('average_bin_mats',
+                                       motion_mats_stack_format)})
 
         return pipeline
 
@@ -371,13 +399,14 @@ class MotionDetectionMixin(MultiStudy, metaclass=MultiStudyMetaClass):
             'nii2dicom',
             Nii2Dicom(
                 # extension='Frame',  #  nii2dicom parameter
-            ),
+                num_threads=self.parameter('num_threads')),
             inputs={
                 'reference_dicom': (list_dicoms, 'files')},
             outputs={
                 'in_file': (reorient_niftis, 'reoriented_umaps')},
             iterfield=['in_file'],
-            wall_time=20)
+            wall_time=20,
+            n_procs=self.parameter('num_threads'))
 
         pipeline.add(
             'copy2dir',
@@ -403,15 +432,16 @@ class MotionDetectionMixin(MultiStudy, metaclass=MultiStudyMetaClass):
         pipeline.add(
             'umap2ref_alignment',
             UmapAlign2Reference(
-                pct=self.parameter('align_pct')),
+                pct=self.parameter('align_pct'),
+                num_threads=self.parameter('num_threads')),
             inputs={
                 'ute_regmat': ('umap_ref_coreg_matrix', text_matrix_format),
                 'ute_qform_mat': ('umap_ref_qform_mat', text_matrix_format),
-                'average_mats': ('average_mats', directory_format),
+                'average_mats': ('average_mats', motion_mats_stack_format),
                 'umap': ('umap', nifti_gz_format)},
             outputs={
                 'umaps_align2ref': ('umaps_align2ref', directory_format)},
-            requirements=[fsl_req.v('5.0.9')])
+            n_procs=self.parameter('num_threads'))
 
         return pipeline
 
@@ -432,12 +462,14 @@ class MotionDetectionMixin(MultiStudy, metaclass=MultiStudyMetaClass):
         pipeline.add(
             'create_moco_series',
             CreateMocoSeries(
-                moco_template=self.parameter('moco_template')),
+                moco_template=self.parameter('moco_template'),
+                num_threads=self.parameter('num_threads')),
             inputs={
-                'start_times': ('start_times', text_format),
+                'timeline': ('timeline', json_format),
                 'motion_par': ('motion_par', text_format)},
             outputs={
-                'moco_series': ('modified_moco', directory_format)})
+                'moco_series': ('modified_moco', directory_format)},
+            n_procs=self.parameter('num_threads'))
 
         return pipeline
 
@@ -523,24 +555,21 @@ class MotionDetectionMixin(MultiStudy, metaclass=MultiStudyMetaClass):
                     'in_file': ('struct2align', nifti_gz_format)},
                 requirements=[fsl_req.v('5.0.9')])
 
+        pet_mc = pipeline.add(
+            'pet_mc',
+            PetImageMotionCorrectionBatch(
+                num_processes=self.parameter('num_threads')),
+            inputs={
+                'pet_images': (check_pet, 'pet_images'),
+                'pet2ref_mat': (check_pet, 'pet2ref_mat')},
+            n_procs=self.parameter('num_threads'))
         if self.branch('dynamic_pet_mc'):
-            pet_mc = pipeline.add(
-                'pet_mc',
-                PetImageMotionCorrection(),
-                inputs={
-                    'pet_image': (check_pet, 'pet_images'),
-                    'motion_mat': (check_pet, 'motion_mats'),
-                    'pet2ref_mat': (check_pet, 'pet2ref_mat')},
-                requirements=[fsl_req.v('5.0.9')],
-                iterfield=['pet_image', 'motion_mat'])
+            pipeline.connect_input('fixed_binning_mats', pet_mc,
+                                   'motion_mats')
         else:
-            pet_mc = pipeline.add(
-                'pet_mc',
-                PetImageMotionCorrection(),
-                inputs={
-                    'corr_factor': (check_pet, 'corr_factors')},
-                requirements=[fsl_req.v('5.0.9')],
-                iterfield=['corr_factor', 'pet_image', 'motion_mat'])
+            pipeline.connect_input('average_mats', pet_mc, 'motion_mats')
+            pipeline.connect(check_pet, 'corr_factors', pet_mc,
+                             'corr_factors')
 
         if StructAlignment:
             pipeline.connect(struct_reg, 'out_matrix_file', pet_mc,
@@ -552,13 +581,47 @@ class MotionDetectionMixin(MultiStudy, metaclass=MultiStudyMetaClass):
         else:
             mni_reg = False
 
+        crop_params = dict(
+            x_min=self.parameter('crop_xmin'),
+            x_size=self.parameter('crop_xsize'),
+            y_min=self.parameter('crop_ymin'),
+            y_size=self.parameter('crop_ysize'),
+            z_min=self.parameter('crop_zmin'),
+            z_size=self.parameter('crop_zsize'))
+
         if self.branch('dynamic_pet_mc'):
+            if not StructAlignment:
+                # Crop the motion-corrected frames (in parallel) before they
+                # are merged
+                cropping = pipeline.add(
+                    'pet_cropping',
+                    PETFovCropping(
+                        num_threads=self.parameter('num_threads'),
+                        **crop_params),
+                    inputs={
+                        'pet_images': (pet_mc, 'pet_mc_image')},
+                    n_procs=self.parameter('num_threads'))
+
+                cropping_no_mc = pipeline.add(
+                    'pet_no_mc_cropping',
+                    PETFovCropping(
+                        num_threads=self.parameter('num_threads'),
+                        **crop_params),
+                    inputs={
+                        'pet_images': (pet_mc, 'pet_no_mc_image')},
+                    n_procs=self.parameter('num_threads'))
+                mc_frames = (cropping, 'pet_cropped_images')
+                no_mc_frames = (cropping_no_mc, 'pet_cropped_images')
+            else:
+                mc_frames = (pet_mc, 'pet_mc_image')
+                no_mc_frames = (pet_mc, 'pet_no_mc_image')
+
             merge_mc = pipeline.add(
                 'merge_pet_mc',
                 fsl.Merge(
                     dimension='t'),
                 inputs={
-                    'in_files': (pet_mc, 'pet_mc_image')},
+                    'in_files': mc_frames},
                 requirements=[fsl_req.v('5.0.9')])
 
             merge_no_mc = pipeline.add(
@@ -566,16 +629,19 @@ class MotionDetectionMixin(MultiStudy, metaclass=MultiStudyMetaClass):
                 fsl.Merge(
                     dimension='t'),
                 inputs={
-                    'in_files': (pet_mc, 'pet_no_mc_image')},
+                    'in_files': no_mc_frames},
                 requirements=[fsl_req.v('5.0.9')])
+            mc_node, mc_out = merge_mc, 'merged_file'
+            no_mc_node, no_mc_out = merge_no_mc, 'merged_file'
         else:
             static_mc = pipeline.add(
                 'static_mc_generation',
                 StaticPETImageGeneration(),
                 inputs={
                     'pet_mc_images': (pet_mc, 'pet_mc_image'),
-                    'pet_no_mc_images': (pet_mc, 'pet_no_mc_image')},
-                requirements=[fsl_req.v('5.0.9')])
+                    'pet_no_mc_images': (pet_mc, 'pet_no_mc_image')})
+            mc_node, mc_out = static_mc, 'static_mc'
+            no_mc_node, no_mc_out = static_mc, 'static_no_mc'
 
         merge_outputs = pipeline.add(
             'merge_outputs',
@@ -584,37 +650,20 @@ class MotionDetectionMixin(MultiStudy, metaclass=MultiStudyMetaClass):
                 'in1': ('mean_displacement_plot', png_format)})
 
         if not StructAlignment:
-            cropping = pipeline.add(
-                'pet_cropping',
-                PETFovCropping(
-                    x_min=self.parameter('crop_xmin'),
-                    x_size=self.parameter('crop_xsize'),
-                    y_min=self.parameter('crop_ymin'),
-                    y_size=self.parameter('crop_ysize'),
-                    z_min=self.parameter('crop_zmin'),
-                    z_size=self.parameter('crop_zsize')))
-            if self.branch('dynamic_pet_mc'):
-                pipeline.connect(merge_mc, 'merged_file', cropping,
-                                 'pet_image')
-            else:
-                pipeline.connect(static_mc, 'static_mc', cropping,
-                                 'pet_image')
-
-            cropping_no_mc = pipeline.add(
-                'pet_no_mc_cropping',
-                PETFovCropping(
-                    x_min=self.parameter('crop_xmin'),
-                    x_size=self.parameter('crop_xsize'),
-                    y_min=self.parameter('crop_ymin'),
-                    y_size=self.parameter('crop_ysize'),
-                    z_min=self.parameter('crop_zmin'),
-                    z_size=self.parameter('crop_zsize')))
-            if self.branch('dynamic_pet_mc'):
-                pipeline.connect(merge_no_mc, 'merged_file', cropping_no_mc,
-                                 'pet_image')
-            else:
-                pipeline.connect(static_mc, 'static_no_mc', cropping_no_mc,
-                                 'pet_image')
+            if not self.branch('dynamic_pet_mc'):
+                cropping = pipeline.add(
+                    'pet_cropping',
+                    PETFovCropping(**crop_params),
+                    inputs={
+                        'pet_image': (mc_node, mc_out)})
+
+                cropping_no_mc = pipeline.add(
+                    'pet_no_mc_cropping',
+                    PETFovCropping(**crop_params),
+                    inputs={
+                        'pet_image': (no_mc_node, no_mc_out)})
+                mc_node, mc_out = cropping, 'pet_cropped'
+                no_mc_node, no_mc_out = cropping_no_mc, 'pet_cropped'
 
             if mni_reg:
                 if self.branch('dynamic_pet_mc'):
@@ -623,7 +672,7 @@ class MotionDetectionMixin(MultiStudy, metaclass=MultiStudyMetaClass):
                         ImageMaths(
                             op_string='-Tmean'),
                         inputs={
-                            'in_file': (cropping, 'pet_cropped')},
+                            'in_file': (mc_node, mc_out)},
                         requirements=[fsl_req.v('5.0.9')])
 
                 reg_tmean2MNI = pipeline.add(
@@ -656,7 +705,7 @@ class MotionDetectionMixin(MultiStudy, metaclass=MultiStudyMetaClass):
                             interpolation='Linear',
                             input_image_type=3),
                         inputs={
-                            'input_image': (cropping, 'pet_cropped'),
+                            'input_image': (mc_node, mc_out),
                             'transforms': (merge_trans, 'out')},
                         wall_time=7,
                         mem_gb=24,
@@ -664,26 +713,15 @@ class MotionDetectionMixin(MultiStudy, metaclass=MultiStudyMetaClass):
                     pipeline.connect(apply_trans, 'output_image',
                                      merge_outputs, 'in2'),
                 else:
-                    pipeline.connect(cropping, 'pet_cropped', reg_tmean2MNI,
+                    pipeline.connect(mc_node, mc_out, reg_tmean2MNI,
                                      'input_file')
                     pipeline.connect(reg_tmean2MNI, 'reg_file',
                                      merge_outputs, 'in2')
             else:
-                pipeline.connect(cropping, 'pet_cropped', merge_outputs,
-                                 'in2')
-            pipeline.connect(cropping_no_mc, 'pet_cropped', merge_outputs,
-                             'in3')
+                pipeline.connect(mc_node, mc_out, merge_outputs, 'in2')
         else:
-            if self.branch('dynamic_pet_mc'):
-                pipeline.connect(merge_mc, 'merged_file', merge_outputs,
-                                 'in2')
-                pipeline.connect(merge_no_mc, 'merged_file', merge_outputs,
-                                 'in3')
-            else:
-                pipeline.connect(static_mc, 'static_mc', merge_outputs,
-                                 'in2')
-                pipeline.connect(static_mc, 'static_no_mc', merge_outputs,
-                                 'in3')
+            pipeline.connect(mc_node, mc_out, merge_outputs, 'in2')
+        pipeline.connect(no_mc_node, no_mc_out, merge_outputs, 'in3')
 #         mcflirt = pipeline.add('mcflirt', MCFLIRT())
 #                 'in_file': (merge_mc_ps, 'merged_file'),
 #                 cost='normmi',
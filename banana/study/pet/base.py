@@ -12,8 +12,7 @@ from banana.interfaces.pet import PreparePetDir
 from banana.interfaces.dicom import PetTimeInfo
 from arcana.study import ParamSpec
 from banana.interfaces.pet import (
-    PrepareUnlistingInputs, PETListModeUnlisting, SSRB, MergeUnlistingOutputs)
-from banana.requirement import stir_req
+    ListModeUnlisting, SSRB, SinogramPCAMotionDetection)
 from banana.exceptions import BananaUsageError
 
 
@@ -25,7 +24,9 @@ template_path = os.path.abspath(
 class PetStudy(Study, metaclass=StudyMetaClass):
 
     add_param_specs = [ParamSpec('ica_n_components', 2),
-                       ParamSpec('ica_type', 'spatial'),
+                       ParamSpec('ica_type', 'spatial',
+                                 choices=('spatial', 'temporal')),
+                       ParamSpec('ica_n_restarts', 1),
                        ParamSpec('norm_transformation', 's'),
                        ParamSpec('norm_dim', 3),
                        ParamSpec('norm_template',
@@ -37,11 +38,22 @@ class PetStudy(Study, metaclass=StudyMetaClass):
                        ParamSpec('crop_ysize', 130),
                        ParamSpec('crop_zmin', 20),
                        ParamSpec('crop_zsize', 100),
-                       ParamSpec('image_orientation_check', False)]
+                       ParamSpec('image_orientation_check', False),
+                       ParamSpec('sinogram_pca_n_components', 3),
+                       ParamSpec('sinogram_pca_method', 'gram',
+                                 choices=('gram', 'incremental')),
+                       ParamSpec('motion_event_threshold', 3.0),
+                       ParamSpec('num_threads', 1,
+                                 desc=("Number of threads (or processes) "
+                                       "used by each of the parallelised "
+                                       "nodes, which reserve as many cores "
+                                       "from the processor"))]
 
     add_data_specs = [
         InputFilesetSpec('list_mode', list_mode_format),
         InputFilesetSpec('registered_volumes', nifti_gz_format),
+        InputFilesetSpec('brain_mask', nifti_gz_format, optional=True),
+        InputFilesetSpec('atlas_labels', nifti_gz_format, optional=True),
         InputFilesetSpec('pet_image', nifti_gz_format),
         InputFilesetSpec('pet_data_dir', directory_format),
         InputFilesetSpec('pet_recon_dir', directory_format),
@@ -50,6 +62,7 @@ class PetStudy(Study, metaclass=StudyMetaClass):
         FilesetSpec('decomposed_file', nifti_gz_format, 'ICA_pipeline'),
         FilesetSpec('timeseries', nifti_gz_format, 'ICA_pipeline'),
         FilesetSpec('mixing_mat', text_format, 'ICA_pipeline'),
+        FilesetSpec('ica_stability', text_format, 'ICA_pipeline'),
         FilesetSpec('registered_volume', nifti_gz_format,
                     'Image_normalization_pipeline'),
         FilesetSpec('warp_file', nifti_gz_format,
@@ -68,7 +81,11 @@ class PetStudy(Study, metaclass=StudyMetaClass):
         InputFieldSpec('temporal_length', float),
         InputFieldSpec('num_frames', int),
         FilesetSpec('ssrb_sinograms', directory_format,
-                    'sinogram_unlisting_pipeline')]
+                    'sinogram_unlisting_pipeline'),
+        FilesetSpec('pca_surrogate_rc', text_format,
+                    'sinogram_pca_motion_detection_pipeline'),
+        FilesetSpec('pca_motion_event_times', text_format,
+                    'sinogram_pca_motion_detection_pipeline')]
 
     def ICA_pipeline(self, **kwargs):
 
@@ -79,17 +96,25 @@ class PetStudy(Study, metaclass=StudyMetaClass):
             citations=[],
             **kwargs)
 
-        pipeline.add(
+        ica = pipeline.add(
             'ICA',
             FastICA(
                 n_components=self.parameter('ica_n_components'),
-                ica_type=self.parameter('ica_type')),
+                ica_type=self.parameter('ica_type'),
+                n_restarts=self.parameter('ica_n_restarts'),
+                num_processes=self.parameter('num_threads')),
             inputs={
                 'volume': ('registered_volumes', nifti_gz_format)},
-            ouputs={
+            outputs={
                 'decomposed_file': ('ica_decomposition', nifti_gz_format),
                 'timeseries': ('ica_timeseries', nifti_gz_format),
-                'mixing_mat': ('mixing_mat', text_format)})
+                'mixing_mat': ('mixing_mat', text_format),
+                'ica_stability': ('stability', text_format)},
+            n_procs=self.parameter('num_threads'))
+
+        if self.provided('brain_mask'):
+            pipeline.connect_input('brain_mask', ica, 'brain_mask',
+                                   nifti_gz_format)
 
         return pipeline
 
@@ -106,7 +131,7 @@ class PetStudy(Study, metaclass=StudyMetaClass):
             AntsRegSyn(
                 out_prefix='vol2template',
                 num_dimensions=self.parameter('norm_dim'),
-                num_threads=self.processor.num_processes,
+                num_threads=self.parameter('num_threads'),
                 transformation=self.parameter('norm_transformation'),
                 ref_file=self.parameter('norm_template')),
             inputs={
@@ -115,7 +140,8 @@ class PetStudy(Study, metaclass=StudyMetaClass):
                 'registered_volume': ('reg_file', nifti_gz_format),
                 'warp_file': ('warp_file', nifti_gz_format),
                 'invwarp_file': ('inv_warp', nifti_gz_format),
-                'affine_mat': ('regmat', text_matrix_format)})
+                'affine_mat': ('regmat', text_matrix_format)},
+            n_procs=self.parameter('num_threads'))
 
         return pipeline
 
@@ -156,8 +182,8 @@ class PetStudy(Study, metaclass=StudyMetaClass):
             PetTimeInfo(),
             inputs={
                 'pet_data_dir': ('pet_data_dir', directory_format)},
-            ouputs={
-                'pet_end_time': ('pet_end_time', float),
+            outputs={
+                'pet_end_time': ('pet_end_time', str),
                 'pet_start_time': ('pet_start_time', str),
                 'pet_duration': ('pet_duration', int)})
         return pipeline
@@ -177,37 +203,55 @@ class PetStudy(Study, metaclass=StudyMetaClass):
                 "'list_mode' was not provided as an input to the study "
                 "so cannot perform sinogram unlisting")
 
-        prepare_inputs = pipeline.add(
-            'prepare_inputs',
-            PrepareUnlistingInputs(),
+        unlisting = pipeline.add(
+            'unlisting',
+            ListModeUnlisting(
+                num_threads=self.parameter('num_threads')),
             inputs={
                 'list_mode': ('list_mode', list_mode_format),
                 'time_offset': ('time_offset', int),
                 'num_frames': ('num_frames', int),
-                'temporal_len': ('temporal_length', float)})
+                'temporal_len': ('temporal_length', float)},
+            n_procs=self.parameter('num_threads'))
 
-        unlisting = pipeline.add(
-            'unlisting',
-            PETListModeUnlisting(),
-            inputs={
-                'list_inputs': (prepare_inputs, 'out')},
-            iterfield=['list_inputs'])
-
-        ssrb = pipeline.add(
+        pipeline.add(
             'ssrb',
-            SSRB(),
+            SSRB(
+                num_threads=self.parameter('num_threads')),
             inputs={
-                'unlisted_sinogram': (unlisting, 'pet_sinogram')},
-            requirements=[stir_req.v('3.0')])
+                'unlisted_sinograms': (unlisting, 'pet_sinograms')},
+            outputs={
+                'ssrb_sinograms': ('sinogram_folder', directory_format)},
+            n_procs=self.parameter('num_threads'))
 
-        pipeline.add(
-            'merge_sinograms',
-            MergeUnlistingOutputs(),
+        return pipeline
+
+    def sinogram_pca_motion_detection_pipeline(self, **kwargs):
+
+        pipeline = self.new_pipeline(
+            name='sinogram_pca_motion_detection',
+            desc=('Detect motion from the principal components of the SSRB '
+                  'sinograms of short frames.'),
+            citations=[],
+            **kwargs)
+
+        detection = pipeline.add(
+            'pca_motion_detection',
+            SinogramPCAMotionDetection(
+                n_components=self.parameter('sinogram_pca_n_components'),
+                method=self.parameter('sinogram_pca_method'),
+                event_threshold=self.parameter('motion_event_threshold')),
             inputs={
-                'sinograms': (ssrb, 'ssrb_sinograms')},
-            ouputs={
-                'ssrb_sinograms': ('sinogram_folder', directory_format)},
-            joinsource='unlisting',
-            joinfield=['sinograms'])
+                'sinogram_folder': ('ssrb_sinograms', directory_format),
+                'temporal_len': ('temporal_length', float),
+                'time_offset': ('time_offset', int)},
+            outputs={
+                'pca_surrogate_rc': ('surrogate_rc', text_format),
+                'pca_motion_event_times': ('motion_event_times',
+                                           text_format)})
+
+        if 'pet_data_dir' in self.input_names:
+            pipeline.connect_input('pet_start_time', detection,
+                                   'pet_start_time')
 
         return pipeline
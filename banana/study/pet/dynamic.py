@@ -4,9 +4,11 @@ from arcana.study.base import StudyMetaClass
 from nipype.interfaces.fsl import ExtractROI
 from nipype.interfaces.ants.resampling import ApplyTransforms
 from arcana.utils.interfaces import Merge
-from banana.interfaces.pet import PETdr, GlobalTrendRemoval
+from banana.interfaces.pet import (
+    PETdr, GlobalTrendRemoval, RegionalStatistics, GraphicalKineticAnalysis)
+from banana.exceptions import BananaUsageError
 from banana.file_format import (nifti_gz_format, png_format,
-                                text_matrix_format)
+                                text_matrix_format, text_format, csv_format)
 from arcana.study import ParamSpec
 import os
 
@@ -20,6 +22,16 @@ class DynamicPetStudy(PetStudy, metaclass=StudyMetaClass):
     add_data_specs = [
         InputFilesetSpec('pet_volumes', nifti_gz_format),
         InputFilesetSpec('regression_map', nifti_gz_format),
+        InputFilesetSpec('input_function', text_format, optional=True),
+        InputFilesetSpec('input_function_mask', nifti_gz_format,
+                         optional=True),
+        InputFilesetSpec('frame_times', text_format, optional=True,
+                         desc=("Start time and duration (or mid-time) of each "
+                               "of the reconstructed frames in "
+                               "'registered_volumes', required for kinetic "
+                               "modelling. The frames listed in the list-mode "
+                               "header describe the acquisition, not the "
+                               "reconstruction, so can't be used instead.")),
         FilesetSpec('pet_image', nifti_gz_format,
                     'Extract_vol_pipeline'),
         FilesetSpec('registered_volumes', nifti_gz_format,
@@ -28,7 +40,17 @@ class DynamicPetStudy(PetStudy, metaclass=StudyMetaClass):
                     'Baseline_Removal_pipeline'),
         FilesetSpec('spatial_map', nifti_gz_format,
                     'Dual_Regression_pipeline'),
-        FilesetSpec('ts', png_format, 'Dual_Regression_pipeline')]
+        FilesetSpec('ts', png_format, 'Dual_Regression_pipeline'),
+        FilesetSpec('timecourses', text_format, 'Dual_Regression_pipeline'),
+        FilesetSpec('regional_tacs', csv_format, 'regional_tac_pipeline'),
+        FilesetSpec('patlak_slope', nifti_gz_format,
+                    'kinetic_modelling_pipeline'),
+        FilesetSpec('patlak_intercept', nifti_gz_format,
+                    'kinetic_modelling_pipeline'),
+        FilesetSpec('logan_slope', nifti_gz_format,
+                    'kinetic_modelling_pipeline'),
+        FilesetSpec('logan_intercept', nifti_gz_format,
+                    'kinetic_modelling_pipeline')]
 
     add_param_specs = [
         ParamSpec('trans_template',
@@ -36,7 +58,11 @@ class DynamicPetStudy(PetStudy, metaclass=StudyMetaClass):
         ParamSpec('base_remove_th', 0),
         ParamSpec('base_remove_binarize', False),
         ParamSpec('regress_th', 0),
-        ParamSpec('regress_binarize', False)]
+        ParamSpec('regress_binarize', False),
+        ParamSpec('kinetic_fit_start', None, dtype=float,
+                  desc=("Time (s) from which the Patlak and Logan plots are "
+                        "assumed to be linear (default the mid-time of the "
+                        "middle frame)"))]
 
     primary_scan_name = 'pet_volumes'
 
@@ -98,7 +124,7 @@ class DynamicPetStudy(PetStudy, metaclass=StudyMetaClass):
             citations=[],
             **kwargs)
 
-        pipeline.add(
+        trend_removal = pipeline.add(
             'Baseline_removal',
             GlobalTrendRemoval(),
             inputs={
@@ -106,6 +132,10 @@ class DynamicPetStudy(PetStudy, metaclass=StudyMetaClass):
             outputs={
                 'detrended_volumes': ('detrended_file', nifti_gz_format)})
 
+        if self.provided('brain_mask'):
+            pipeline.connect_input('brain_mask', trend_removal,
+                                   'brain_mask', nifti_gz_format)
+
         return pipeline
 
     def Dual_Regression_pipeline(self, **kwargs):
@@ -116,7 +146,7 @@ class DynamicPetStudy(PetStudy, metaclass=StudyMetaClass):
             citations=[],
             **kwargs)
 
-        pipeline.add(
+        dual_regression = pipeline.add(
             'PET_dr',
             PETdr(
                 threshold=self.parameter('regress_th'),
@@ -126,6 +156,85 @@ class DynamicPetStudy(PetStudy, metaclass=StudyMetaClass):
                 'regression_map': ('regression_map', nifti_gz_format)},
             outputs={
                 'spatial_map': ('spatial_map', nifti_gz_format),
-                'ts': ('timecourse', png_format)})
+                'ts': ('timecourse', png_format),
+                'timecourses': ('timecourses', text_format)})
+
+        if self.provided('brain_mask'):
+            pipeline.connect_input('brain_mask', dual_regression,
+                                   'brain_mask', nifti_gz_format)
+
+        return pipeline
+
+    def regional_tac_pipeline(self, **kwargs):
+
+        pipeline = self.new_pipeline(
+            name='regional_tac',
+            desc=('Extract the time-activity curves of every region of the '
+                  'atlas'),
+            citations=[],
+            **kwargs)
+
+        if not self.provided('atlas_labels'):
+            raise BananaUsageError(
+                "'atlas_labels' needs to be provided to the study to extract "
+                "regional time-activity curves")
+
+        pipeline.add(
+            'regional_TAC',
+            RegionalStatistics(),
+            inputs={
+                'volume': ('registered_volumes', nifti_gz_format),
+                'label_image': ('atlas_labels', nifti_gz_format)},
+            outputs={
+                'regional_tacs': ('out_file', csv_format)})
+
+        return pipeline
+
+    def kinetic_modelling_pipeline(self, **kwargs):
+
+        pipeline = self.new_pipeline(
+            name='kinetic_modelling',
+            desc=('Voxelwise Patlak and Logan graphical analysis of the '
+                  'dynamic PET volumes'),
+            citations=[],
+            **kwargs)
+
+        if not self.provided('frame_times'):
+            raise BananaUsageError(
+                "'frame_times' of the reconstructed frames needs to be "
+                "provided to the study to perform kinetic modelling")
+
+        kinetic_modelling = pipeline.add(
+            'graphical_analysis',
+            GraphicalKineticAnalysis(
+                num_threads=self.parameter('num_threads')),
+            inputs={
+                'volume': ('registered_volumes', nifti_gz_format),
+                'frame_times': ('frame_times', text_format)},
+            outputs={
+                'patlak_slope': ('patlak_slope', nifti_gz_format),
+                'patlak_intercept': ('patlak_intercept', nifti_gz_format),
+                'logan_slope': ('logan_slope', nifti_gz_format),
+                'logan_intercept': ('logan_intercept', nifti_gz_format)},
+            n_procs=self.parameter('num_threads'))
+
+        if self.provided('input_function'):
+            pipeline.connect_input('input_function', kinetic_modelling,
+                                   'input_function', text_format)
+        elif self.provided('input_function_mask'):
+            pipeline.connect_input('input_function_mask', kinetic_modelling,
+                                   'input_mask', nifti_gz_format)
+        else:
+            raise BananaUsageError(
+                "Either 'input_function' or 'input_function_mask' needs to be "
+                "provided to the study to perform kinetic modelling")
+
+        if self.parameter('kinetic_fit_start') is not None:
+            kinetic_modelling.inputs.start_time = self.parameter(
+                'kinetic_fit_start')
+
+        if self.provided('brain_mask'):
+            pipeline.connect_input('brain_mask', kinetic_modelling,
+                                   'brain_mask', nifti_gz_format)
 
         return pipeline
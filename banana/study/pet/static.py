@@ -1,8 +1,8 @@
 from .base import PetStudy
 from arcana.data import FilesetSpec, InputFilesetSpec
 from arcana.study.base import StudyMetaClass
-from banana.interfaces.pet import SUVRCalculation
-from banana.file_format import (nifti_gz_format)
+from banana.interfaces.pet import SUVRCalculation, RegionalStatistics
+from banana.file_format import nifti_gz_format, csv_format
 import os
 
 template_path = os.path.abspath(
@@ -15,7 +15,8 @@ class StaticPetStudy(PetStudy, metaclass=StudyMetaClass):
     add_data_specs = [
         InputFilesetSpec('pet_image', nifti_gz_format),
         InputFilesetSpec('base_mask', nifti_gz_format),
-        FilesetSpec('SUVR_image', nifti_gz_format, 'suvr_pipeline')]
+        FilesetSpec('SUVR_image', nifti_gz_format, 'suvr_pipeline'),
+        FilesetSpec('regional_suvr', csv_format, 'suvr_pipeline')]
 
     primary_scan_name = 'pet_image'
 
@@ -36,6 +37,17 @@ class StaticPetStudy(PetStudy, metaclass=StudyMetaClass):
             outputs={
                 'SUVR_image': ('SUVR_file', nifti_gz_format)})
 
+        if self.provided('atlas_labels'):
+            pipeline.add(
+                'regional_SUVR',
+                RegionalStatistics(),
+                inputs={
+                    'volume': ('registered_volume', nifti_gz_format),
+                    'label_image': ('atlas_labels', nifti_gz_format),
+                    'reference_mask': ('base_mask', nifti_gz_format)},
+                outputs={
+                    'regional_suvr': ('out_file', csv_format)})
+
         return pipeline
 
     def _ica_inputs(self):
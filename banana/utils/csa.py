@@ -0,0 +1,119 @@
+import re
+import warnings
+import pydicom
+
+with warnings.catch_warnings():
+    warnings.simplefilter("ignore")
+    import nibabel.nicom.csareader as csareader
+
+
+CSA_IMAGE_HEADER_TAG = 0x00291010
+CSA_SERIES_HEADER_TAG = 0x00291020
+
+# Header elements required to read the Siemens CSA headers, along with their
+# private creator
+CSA_TAGS = (0x00290010, CSA_IMAGE_HEADER_TAG, CSA_SERIES_HEADER_TAG)
+
+ASCCONV_RE = re.compile(r'### ASCCONV BEGIN[^\n]*###\n(.*?)\n### ASCCONV END',
+                        re.DOTALL)
+ASCCONV_LINE_RE = re.compile(r'^\s*([^\s=#]+)\s*=\s*(.*?)\s*$')
+
+
+def read_csa_header(dcm, tag=CSA_SERIES_HEADER_TAG):
+    """
+    Reads a Siemens CSA header from a DICOM dataset
+
+    Parameters
+    ----------
+    dcm : pydicom.Dataset | str
+        The DICOM dataset or the path to the DICOM file (in which case only
+        the CSA headers are read)
+    tag : int
+        The tag of the CSA header element, either CSA_SERIES_HEADER_TAG or
+        CSA_IMAGE_HEADER_TAG
+
+    Returns
+    -------
+    csa : dict | None
+        The CSA header as returned by nibabel.nicom.csareader.read or None if
+        the element is not present in the dataset
+    """
+    if not isinstance(dcm, pydicom.Dataset):
+        dcm = pydicom.read_file(dcm, stop_before_pixels=True,
+                                specific_tags=list(CSA_TAGS))
+    if tag not in dcm:
+        return None
+    return csareader.read(dcm[tag].value)
+
+
+def _parse_ascconv_value(value):
+    if value.startswith('"'):
+        # Strings are enclosed in double double quotes
+        return re.match(r'"+(.*?)"+', value).group(1)
+    value = value.split('#')[0].strip()
+    try:
+        return int(value, 0)
+    except ValueError:
+        try:
+            return float(value)
+        except ValueError:
+            return value
+
+
+def parse_ascconv(text):
+    """
+    Parses the ASCCONV block of a Siemens protocol into a dictionary
+
+    Parameters
+    ----------
+    text : str
+        The protocol text (e.g. the MrPhoenixProtocol item of the CSA series
+        header) containing an ASCCONV block. If no "### ASCCONV BEGIN ###"
+        marker is found the whole text is parsed.
+
+    Returns
+    -------
+    ascconv : dict
+        The protocol parameters keyed by their (flattened) names, e.g.
+        'alTR[0]' or 'sSliceArray.asSlice[0].dInPlaneRot', with integer, float
+        or string values
+    """
+    match = ASCCONV_RE.search(text)
+    if match is not None:
+        text = match.group(1)
+    ascconv = {}
+    for line in text.splitlines():
+        match = ASCCONV_LINE_RE.match(line)
+        if match is not None:
+            key, value = match.groups()
+            ascconv[key] = _parse_ascconv_value(value)
+    return ascconv
+
+
+def read_ascconv(dcm):
+    """
+    Reads the ASCCONV protocol parameters from the CSA series header of a
+    Siemens DICOM
+
+    Parameters
+    ----------
+    dcm : pydicom.Dataset | str
+        The DICOM dataset or the path to the DICOM file
+
+    Returns
+    -------
+    ascconv : dict
+        The protocol parameters (see parse_ascconv), empty if the DICOM
+        doesn't contain a CSA series header with a protocol
+    """
+    csa = read_csa_header(dcm, CSA_SERIES_HEADER_TAG)
+    if csa is None:
+        return {}
+    for name in ('MrPhoenixProtocol', 'MrProtocol'):
+        try:
+            items = csa['tags'][name]['items']
+        except KeyError:
+            continue
+        if items:
+            return parse_ascconv(items[0])
+    return {}
@@ -0,0 +1,208 @@
+import os
+import os.path as op
+import json
+import sqlite3
+import hashlib
+from logging import getLogger
+from concurrent.futures import ProcessPoolExecutor
+import pydicom
+from pydicom.multival import MultiValue
+
+
+# Header fields required by the motion detection utilities
+# (banana.utils.moco) and DicomHeaderInfoExtraction
+INDEXED_KEYWORDS = (
+    'SeriesNumber', 'SeriesDescription', 'ImageType', 'AcquisitionTime',
+    'AcquisitionDateTime', 'EchoTime', 'ImageOrientationPatient',
+    'PixelSpacing', 'SliceThickness', 'MagneticFieldStrength',
+    'InPlanePhaseEncodingDirection')
+
+# Directory the indices of DICOM directories are cached in by default
+DEFAULT_CACHE_DIR = op.join(op.expanduser('~'), '.cache', 'banana',
+                            'dicom_header_index')
+
+logger = getLogger('banana')
+
+
+def _to_json(value):
+    if isinstance(value, (MultiValue, list, tuple)):
+        return [_to_json(v) for v in value]
+    elif isinstance(value, (int, float)):
+        return (int(value) if isinstance(value, int) else float(value))
+    elif isinstance(value, bytes):
+        return None
+    return str(value)
+
+
+def header_fields(dcm, keywords=INDEXED_KEYWORDS):
+    """
+    Extracts the given fields from a DICOM dataset into a dictionary of JSON
+    serialisable values, fields missing from the header being omitted
+    """
+    fields = {}
+    for keyword in keywords:
+        value = getattr(dcm, keyword, None)
+        if value is not None:
+            fields[keyword] = _to_json(value)
+    return fields
+
+
+def read_header_fields(path, keywords=INDEXED_KEYWORDS):
+    """
+    Reads the given fields from the header of a DICOM file (without loading
+    its pixel data), see header_fields
+    """
+    return header_fields(
+        pydicom.read_file(path, stop_before_pixels=True,
+                          specific_tags=list(keywords)), keywords)
+
+
+class DicomHeaderIndex(object):
+    """
+    Persistent (SQLite) index of the header fields in INDEXED_KEYWORDS, keyed
+    by the path of each DICOM file. The modification time and size of each
+    file are stored along with its fields so that only new or modified files
+    are parsed when the index is updated. If the database can't be opened
+    (e.g. its directory is read-only) the headers are read directly from the
+    files instead.
+
+    Parameters
+    ----------
+    path : str
+        Path to the SQLite database (created if it doesn't exist)
+    num_processes : int
+        Number of processes used to parse the headers (defaults to the number
+        of CPUs)
+    """
+
+    QUERY_CHUNK = 500
+
+    def __init__(self, path, num_processes=None):
+        self.path = op.abspath(path)
+        self.num_processes = num_processes
+        try:
+            os.makedirs(op.dirname(self.path), exist_ok=True)
+            self._conn = sqlite3.connect(self.path)
+            with self._conn:
+                self._conn.execute(
+                    'CREATE TABLE IF NOT EXISTS headers ('
+                    'path TEXT PRIMARY KEY, mtime REAL, size INTEGER, '
+                    'fields TEXT)')
+        except (OSError, sqlite3.Error) as e:
+            logger.warning(
+                "Could not open DICOM header index at {} ({}), reading the "
+                "headers directly instead".format(self.path, e))
+            self._conn = None
+
+    @classmethod
+    def for_directory(cls, directory, cache_dir=None, **kwargs):
+        """
+        The index of the DICOMs in the given directory, stored in the cache
+        directory (outside of the directory itself so the source data isn't
+        modified)
+
+        Parameters
+        ----------
+        directory : str
+            The directory containing the DICOM files (or series directories)
+        cache_dir : str | None
+            The directory to store the index in, DEFAULT_CACHE_DIR if None
+        """
+        if cache_dir is None:
+            cache_dir = DEFAULT_CACHE_DIR
+        key = hashlib.sha1(op.abspath(directory).encode()).hexdigest()
+        return cls(op.join(cache_dir, key + '.sqlite'), **kwargs)
+
+    @property
+    def persistent(self):
+        "Whether the index is stored in a database"
+        return self._conn is not None
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def update(self, paths):
+        """
+        Parses the headers of the files that are not in the index or have
+        been modified since they were added
+
+        Parameters
+        ----------
+        paths : list[str]
+            Paths of the DICOM files to index
+
+        Returns
+        -------
+        n_parsed : int
+            The number of headers parsed
+        """
+        if self._conn is None:
+            return 0
+        paths = [op.abspath(p) for p in paths]
+        indexed = dict((p, (m, s)) for p, m, s in self._select(
+            'path, mtime, size', paths))
+        stale = []
+        for path in paths:
+            stat = os.stat(path)
+            if indexed.get(path) != (stat.st_mtime, stat.st_size):
+                stale.append((path, stat.st_mtime, stat.st_size))
+        if not stale:
+            return 0
+        stale_paths = [s[0] for s in stale]
+        if self.num_processes == 1 or len(stale) < 2:
+            fields = [read_header_fields(p) for p in stale_paths]
+        else:
+            with ProcessPoolExecutor(
+                    max_workers=self.num_processes) as executor:
+                fields = list(executor.map(
+                    read_header_fields, stale_paths,
+                    chunksize=max(len(stale) // 64, 1)))
+        with self._conn:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO headers VALUES (?, ?, ?, ?)',
+                [(p, m, s, json.dumps(f))
+                 for (p, m, s), f in zip(stale, fields)])
+        return len(stale)
+
+    def headers(self, paths):
+        """
+        Returns the indexed header fields of each of the given files, updating
+        the index first if required
+
+        Parameters
+        ----------
+        paths : list[str]
+            Paths of the DICOM files
+
+        Returns
+        -------
+        headers : list[dict]
+            The header fields of each file
+        """
+        paths = [op.abspath(p) for p in paths]
+        if self._conn is None:
+            return [read_header_fields(p) for p in paths]
+        self.update(paths)
+        fields = dict(self._select('path, fields', paths))
+        return [json.loads(fields[p]) for p in paths]
+
+    def _select(self, columns, paths):
+        # Query in chunks to stay within SQLite's limit on the number of
+        # parameters
+        for i in range(0, len(paths), self.QUERY_CHUNK):
+            chunk = paths[i:i + self.QUERY_CHUNK]
+            for row in self._conn.execute(
+                    'SELECT {} FROM headers WHERE path IN ({})'.format(
+                        columns, ', '.join('?' * len(chunk))), chunk):
+                yield row
+
+    def __getitem__(self, path):
+        return self.headers([path])[0]
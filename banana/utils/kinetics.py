@@ -0,0 +1,211 @@
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+import numpy as np
+from banana.utils.voxels import load_mask, iter_voxel_blocks, open_image
+
+
+KineticMaps = namedtuple(
+    'KineticMaps',
+    'patlak_slope patlak_intercept logan_slope logan_intercept')
+
+
+def frame_mid_times(frame_times):
+    """
+    Mid-time of each frame from a (n_frames, 2) array of frame start times
+    and durations (or a 1D array of mid-times, which is returned as is)
+    """
+    frame_times = np.asarray(frame_times, dtype=float)
+    if frame_times.ndim == 1:
+        return frame_times
+    return frame_times[:, 0] + frame_times[:, 1] / 2.0
+
+
+def cumulative_integral(values, times):
+    """
+    Cumulative (trapezoidal) integral of time-activity curves sampled at the
+    given times along their last axis, starting from zero at time zero
+    """
+    values = np.asarray(values, dtype=float)
+    dt = np.diff(np.concatenate(([0.0], times)))
+    previous = np.concatenate((np.zeros(values.shape[:-1] + (1,)),
+                               values[..., :-1]), axis=-1)
+    return np.cumsum((values + previous) * (dt / 2.0), axis=-1)
+
+
+def fit_lines(x, y):
+    """
+    Least-squares slopes and intercepts of straight lines fitted to each row
+    of x and y at once (rows with non-finite values get zero slopes and
+    intercepts)
+
+    Parameters
+    ----------
+    x : np.ndarray
+        (n_lines, n_points) abscissae, or (n_points,) abscissae shared by all
+        lines
+    y : np.ndarray
+        (n_lines, n_points) ordinates
+
+    Returns
+    -------
+    slopes : np.ndarray
+        The slope of each line
+    intercepts : np.ndarray
+        The intercept of each line
+    """
+    x = np.broadcast_to(x, y.shape)
+    n = y.shape[-1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sx = x.sum(axis=-1)
+        sy = y.sum(axis=-1)
+        slopes = ((n * (x * y).sum(axis=-1) - sx * sy) /
+                  (n * (x * x).sum(axis=-1) - sx ** 2))
+        intercepts = (sy - slopes * sx) / n
+    invalid = ~(np.isfinite(slopes) & np.isfinite(intercepts))
+    slopes[invalid] = 0.0
+    intercepts[invalid] = 0.0
+    return slopes, intercepts
+
+
+def patlak(tacs, input_function, times, fit_frames):
+    """
+    Patlak graphical analysis of a block of time-activity curves, i.e. fits
+    C(t) / Cp(t) = Ki * int_0^t Cp / Cp(t) + V over the late frames
+
+    Parameters
+    ----------
+    tacs : np.ndarray
+        (n_voxels, n_frames) time-activity curves
+    input_function : np.ndarray
+        (n_frames,) (plasma, image-derived or reference region) input function
+    times : np.ndarray
+        (n_frames,) mid-times of the frames
+    fit_frames : np.ndarray
+        Boolean selection of the frames to fit
+
+    Returns
+    -------
+    slopes : np.ndarray
+        The influx constant (Ki) of each voxel
+    intercepts : np.ndarray
+        The intercept (V) of each voxel
+    """
+    input_function = np.asarray(input_function, dtype=float)
+    cp = input_function[fit_frames]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = cumulative_integral(input_function, times)[fit_frames] / cp
+        y = tacs[:, fit_frames] / cp
+    return fit_lines(x, y)
+
+
+def logan(tacs, input_function, times, fit_frames):
+    """
+    Logan graphical analysis of a block of time-activity curves, i.e. fits
+    int_0^t C / C(t) = DV * int_0^t Cp / C(t) + b over the late frames (the
+    slope being the distribution volume ratio if the input function is that
+    of a reference region)
+
+    Parameters
+    ----------
+    tacs : np.ndarray
+        (n_voxels, n_frames) time-activity curves
+    input_function : np.ndarray
+        (n_frames,) (plasma, image-derived or reference region) input function
+    times : np.ndarray
+        (n_frames,) mid-times of the frames
+    fit_frames : np.ndarray
+        Boolean selection of the frames to fit
+
+    Returns
+    -------
+    slopes : np.ndarray
+        The distribution volume (ratio) of each voxel
+    intercepts : np.ndarray
+        The intercept of each voxel
+    """
+    ct = tacs[:, fit_frames]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = cumulative_integral(input_function, times)[fit_frames] / ct
+        y = cumulative_integral(tacs, times)[:, fit_frames] / ct
+    return fit_lines(x, y)
+
+
+def kinetic_maps(img, input_function, frame_times, mask=None, start_time=None,
+                 slab_size=None, num_threads=1):
+    """
+    Voxelwise Patlak and Logan graphical analysis of a dynamic PET image. The
+    (masked) voxels are streamed in blocks of axial slabs, all the voxels of
+    a block being fitted at once, and blocks are fitted in parallel.
+
+    Parameters
+    ----------
+    img : nibabel.Nifti1Image | str
+        The 4D (dynamic) image (or path to it)
+    input_function : array-like
+        The input function sampled at each frame (in the same units as the
+        image)
+    frame_times : array-like
+        (n_frames, 2) start times and durations of the frames (or their
+        (n_frames,) mid-times)
+    mask : np.ndarray | str | None
+        Mask of the voxels to fit (all voxels if None)
+    start_time : float | None
+        The time from which the plots are assumed to be linear, only the
+        frames whose mid-times are after it being fitted (the second half of
+        the frames if None)
+    slab_size : int | None
+        Number of axial slices read at a time
+    num_threads : int
+        Number of blocks to fit in parallel
+
+    Returns
+    -------
+    maps : KineticMaps
+        The slope and intercept maps of the Patlak and Logan plots
+    """
+    with open_image(img) as img:
+        return _kinetic_maps(img, input_function, frame_times, mask,
+                             start_time, slab_size, num_threads)
+
+
+def _kinetic_maps(img, input_function, frame_times, mask, start_time,
+                  slab_size, num_threads):
+    times = frame_mid_times(frame_times)
+    input_function = np.asarray(input_function, dtype=float)
+    if not (len(times) == len(input_function) == img.shape[3]):
+        raise ValueError(
+            "Number of frame times ({}), input function samples ({}) and "
+            "volumes ({}) don't match".format(len(times), len(input_function),
+                                              img.shape[3]))
+    if start_time is None:
+        start_time = times[len(times) // 2]
+    fit_frames = times >= start_time
+    if fit_frames.sum() < 2:
+        raise ValueError(
+            "Less than 2 frames start after the start time of the fit ({})"
+            .format(start_time))
+    mask = load_mask(mask, img.shape[:3])
+    maps = KineticMaps(*(np.zeros(img.shape[:3], dtype=np.float32)
+                         for _ in KineticMaps._fields))
+
+    def fit(block):
+        slab, slab_mask, tacs = block
+        tacs = tacs.astype(np.float64)
+        return (slab, slab_mask,
+                patlak(tacs, input_function, times, fit_frames) +
+                logan(tacs, input_function, times, fit_frames))
+
+    blocks = iter_voxel_blocks(img, mask, slab_size)
+    num_threads = max(num_threads, 1)
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        # Read the blocks in batches so that at most num_threads of them are
+        # held in memory at once
+        while True:
+            batch = list(islice(blocks, num_threads))
+            if not batch:
+                break
+            for slab, slab_mask, values in executor.map(fit, batch):
+                for out, value in zip(maps, values):
+                    out[:, :, slab][slab_mask] = value
+    return maps
@@ -0,0 +1,416 @@
+import os
+import os.path as op
+import re
+import mmap
+from collections import namedtuple
+from functools import lru_cache, partial
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pydicom
+
+
+INTERFILE_BEGIN = b'!INTERFILE'
+INTERFILE_END = b'!END OF INTERFILE'
+
+INDEXED_KEY_RE = re.compile(r'^(.*?)\s*\[(\d+)\]$')
+
+ListModeHeader = namedtuple('ListModeHeader',
+                            ['start_time', 'duration', 'frames', 'fields'])
+ListModeHeader.__doc__ = """
+Metadata of a list-mode acquisition
+
+Parameters
+----------
+start_time : str | None
+    Acquisition start time (HHMMSS.ffffff) from the DICOM header
+duration : int | None
+    Duration of the acquisition in seconds
+frames : np.ndarray
+    (n_frames, 2) array with the relative start time and the duration of each
+    frame defined in the header (in seconds)
+fields : dict[str, str]
+    All the key/value pairs of the Interfile header, the keys being lower
+    case and stripped of the leading '!' and '%' characters
+"""
+
+
+def find_list_mode_file(pet_data_dir):
+    """
+    Returns the largest (non-hidden) list-mode file (.bf) in the PET data
+    directory (searched recursively) or None if there aren't any
+    """
+    bf_files = []
+    for root, dirs, files in os.walk(pet_data_dir):
+        bf_files.extend(op.join(root, f) for f in files
+                        if not f[0] == '.' and '.bf' in f)
+        dirs[:] = [d for d in dirs if not d[0] == '.']
+    if not bf_files:
+        return None
+    return max(bf_files, key=op.getsize)
+
+
+def list_mode_header_path(list_mode_file):
+    "The path of the DICOM file accompanying a list-mode (.bf) file"
+    return list_mode_file.split('.bf')[0] + '.dcm'
+
+
+def parse_interfile(text):
+    """
+    Parses the key/value pairs of an Interfile header
+
+    Parameters
+    ----------
+    text : str
+        The header text
+
+    Returns
+    -------
+    fields : dict[str, str]
+        The header values keyed by the lower case key names, stripped of the
+        leading '!' and '%' characters (later duplicates replace earlier ones)
+    """
+    fields = {}
+    for line in text.splitlines():
+        if ':=' not in line:
+            continue
+        key, value = line.split(':=', 1)
+        key = key.strip().lstrip('!%').strip().lower()
+        if key and not key.startswith(';'):
+            fields[key] = value.strip()
+    return fields
+
+
+def _frames(fields, duration):
+    starts = {}
+    durations = {}
+    for key, value in fields.items():
+        match = INDEXED_KEY_RE.match(key)
+        if match is None:
+            continue
+        name, index = match.group(1), int(match.group(2))
+        if name.startswith('image relative start time'):
+            starts[index] = float(value)
+        elif name.startswith('image duration'):
+            durations[index] = float(value)
+    if durations:
+        return np.array([(starts.get(i, 0.0), durations[i])
+                         for i in sorted(durations)])
+    if duration is None:
+        return np.zeros((0, 2))
+    start = float(fields.get('image relative start time (sec)', 0.0))
+    return np.array([(start, float(duration))])
+
+
+@lru_cache(maxsize=32)
+def _read_list_mode_header(header_path, mtime, size):
+    # The modification time and size are only passed so that cached records
+    # of files that have since changed are not returned
+    text = ''
+    if size:
+        with open(header_path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                begin = mm.find(INTERFILE_BEGIN)
+                if begin >= 0:
+                    end = mm.find(INTERFILE_END, begin)
+                    if end < 0:
+                        end = size
+                    text = mm[begin:end].decode('utf-8', errors='ignore')
+            finally:
+                mm.close()
+    fields = parse_interfile(text)
+    duration = fields.get('image duration (sec)')
+    if duration is None:
+        duration = next((v for k, v in reversed(list(fields.items()))
+                         if k.startswith('image duration')), None)
+    if duration is not None:
+        duration = int(float(duration))
+    try:
+        start_time = pydicom.read_file(
+            header_path, stop_before_pixels=True,
+            specific_tags=['AcquisitionTime']).AcquisitionTime
+    except AttributeError:
+        start_time = None
+    return ListModeHeader(start_time, duration, _frames(fields, duration),
+                          fields)
+
+
+def read_list_mode_header(list_mode_file):
+    """
+    Reads the metadata of a list-mode acquisition from the Interfile header
+    embedded in its accompanying DICOM file, which is memory-mapped so only
+    the pages containing the header are read. Records are cached per file
+    (and modification time) so the header is only parsed once per process.
+
+    Parameters
+    ----------
+    list_mode_file : str
+        Path to the list-mode (.bf) file or directly to its accompanying
+        DICOM (.dcm) file
+
+    Returns
+    -------
+    header : ListModeHeader
+        The start time, duration and frame definitions of the acquisition
+    """
+    header_path = op.abspath(list_mode_header_path(list_mode_file))
+    stat = os.stat(header_path)
+    return _read_list_mode_header(header_path, stat.st_mtime, stat.st_size)
+
+
+# Layout of the 32-bit words of Siemens mMR list-mode (.bf) files. Events
+# have the most significant bit unset, the next bit flagging prompts (vs
+# delays) and the remaining 30 bits the address of the event's bin in the
+# span-11 sinogram. Elapsed time tags (in ms) have the top three bits set to
+# 100 and the time in the remaining 29 bits.
+TAG_BIT = 0x80000000
+PROMPT_BIT = 0x40000000
+ADDRESS_MASK = 0x3FFFFFFF
+TIME_TAG_MASK = 0xE0000000
+TIME_TAG = 0x80000000
+TIME_MASK = 0x1FFFFFFF
+
+# Span-11 sinograms x views x tangential bins
+MMR_SINOGRAM_SHAPE = (837, 252, 344)
+MMR_SINOGRAM_SIZE = int(np.prod(MMR_SINOGRAM_SHAPE))
+
+
+def decode_list_mode(words, initial_time=0, delays=False):
+    """
+    Decodes a block of list-mode words into the times and bin addresses of
+    its events
+
+    Parameters
+    ----------
+    words : np.ndarray
+        The 32-bit list-mode words
+    initial_time : int
+        Time (ms) of the events preceding the first time tag in the block
+    delays : bool
+        Whether to return the delayed events as well as the prompts. If True
+        the addresses of the delays are offset by ADDRESS_MASK + 1
+
+    Returns
+    -------
+    times : np.ndarray
+        Time (ms) of each event (non-decreasing)
+    addresses : np.ndarray
+        The sinogram bin address of each event
+    """
+    words = np.asarray(words, dtype=np.uint32)
+    is_time = (words & TIME_TAG_MASK) == TIME_TAG
+    if delays:
+        is_event = (words & TAG_BIT) == 0
+    else:
+        is_event = (words & (TAG_BIT | PROMPT_BIT)) == PROMPT_BIT
+    # Look up the time of each event from the number of time tags preceding
+    # it
+    tag_times = np.concatenate((
+        [initial_time], (words[is_time] & TIME_MASK).astype(np.int64)))
+    times = tag_times[np.cumsum(is_time, dtype=np.intp)[is_event]]
+    event_words = words[is_event]
+    addresses = (event_words & ADDRESS_MASK).astype(np.int64)
+    if delays:
+        addresses[(event_words & PROMPT_BIT) == 0] += ADDRESS_MASK + 1
+    return times, addresses
+
+
+def _preceding_time(words, pos, block=4096):
+    # Scans backwards from pos for the last time tag
+    while pos > 0:
+        start = max(pos - block, 0)
+        block_words = words[start:pos]
+        tags = np.nonzero((block_words & TIME_TAG_MASK) == TIME_TAG)[0]
+        if len(tags):
+            return int(block_words[tags[-1]] & TIME_MASK)
+        pos = start
+    return 0
+
+
+def _unlist_chunk(words, begin, end, frame_starts, frame_ends, sinogram_size,
+                  delays):
+    times, addresses = decode_list_mode(
+        words[begin:end], initial_time=_preceding_time(words, begin),
+        delays=delays)
+    if delays:
+        prompt = addresses <= ADDRESS_MASK
+        addresses = np.where(prompt, addresses,
+                             addresses - (ADDRESS_MASK + 1) + sinogram_size)
+        valid = np.where(prompt, addresses < sinogram_size,
+                         addresses < 2 * sinogram_size)
+    else:
+        valid = addresses < sinogram_size
+    times = times[valid]
+    addresses = addresses[valid]
+    # The counts are kept sparse (only the bins hit in each frame), as a
+    # full sinogram per frame would take hundreds of MB
+    counts = {}
+    if len(times):
+        los = np.searchsorted(times, frame_starts, side='left')
+        his = np.searchsorted(times, frame_ends, side='left')
+        for i in np.nonzero(his > los)[0]:
+            counts[i] = np.unique(addresses[los[i]:his[i]],
+                                  return_counts=True)
+    last_time = int(times[-1]) if len(times) else None
+    return counts, last_time
+
+
+def unlist_list_mode(list_mode_file, frame_starts, frame_durations,
+                     out_dir='.', sinogram_size=MMR_SINOGRAM_SIZE,
+                     delays=False, chunk_size=2 ** 24, num_threads=1,
+                     out_fname='Frame{:05d}.s', block_size=2 ** 22):
+    """
+    Sorts the events of a list-mode file into the sinograms of multiple
+    (time) frames in a single pass. The file is memory-mapped and decoded
+    in chunks, the (sparse) counts of the events of each chunk in each frame
+    it overlaps being added to an int32 accumulator memory-mapped to disk
+    for each frame, so that memory use doesn't grow with the number of open
+    frames. Chunks can be decoded in parallel in a thread pool. Sinograms are
+    written to disk as soon as the stream passes the end of their frame.
+
+    Parameters
+    ----------
+    list_mode_file : str
+        Path to the list-mode (.bf) file
+    frame_starts : array-like
+        Start of each frame (in seconds from the start of the acquisition)
+    frame_durations : array-like | float
+        Duration of each frame (in seconds)
+    out_dir : str
+        Directory to write the sinograms to
+    sinogram_size : int
+        Number of bins in the sinogram
+    delays : bool
+        Whether to store the delayed events after the prompts in each
+        sinogram (doubling its size)
+    chunk_size : int
+        Number of list-mode words decoded at a time
+    num_threads : int
+        Number of threads to decode the chunks with
+    out_fname : str
+        Format of the sinogram file names (formatted with the frame index)
+    block_size : int
+        Number of bins converted at a time when writing the sinograms
+
+    Returns
+    -------
+    sinograms : list[str]
+        Paths to the sinogram of each frame, stored as little-endian signed
+        short integers
+    """
+    frame_starts = np.atleast_1d(np.asarray(frame_starts, dtype=float))
+    frame_ends = frame_starts + np.broadcast_to(
+        np.asarray(frame_durations, dtype=float), frame_starts.shape)
+    # Convert to ms to match the time tags
+    frame_starts = np.round(frame_starts * 1000).astype(np.int64)
+    frame_ends = np.round(frame_ends * 1000).astype(np.int64)
+    n_bins = 2 * sinogram_size if delays else sinogram_size
+    sinograms = [op.join(out_dir, out_fname.format(i))
+                 for i in range(len(frame_starts))]
+    accumulators = {}
+    flushed = np.zeros(len(frame_starts), dtype=bool)
+
+    def accumulate(i, bins, counts):
+        if i not in accumulators:
+            accumulators[i] = np.memmap(sinograms[i] + '.counts',
+                                        dtype=np.int32, mode='w+',
+                                        shape=(n_bins,))
+        # The bins are unique so they can be incremented in one go
+        accumulators[i][bins] += counts.astype(np.int32)
+
+    def flush(i):
+        acc = accumulators.pop(i, None)
+        with open(sinograms[i], 'wb') as f:
+            if acc is None:
+                f.truncate(n_bins * 2)
+            else:
+                for b in range(0, n_bins, block_size):
+                    np.clip(acc[b:b + block_size], None,
+                            np.iinfo(np.int16).max).astype('<i2').tofile(f)
+        if acc is not None:
+            del acc
+            os.remove(sinograms[i] + '.counts')
+        flushed[i] = True
+
+    words = np.memmap(list_mode_file, dtype='<u4', mode='r')
+    unlist_chunk = partial(_unlist_chunk, words, frame_starts=frame_starts,
+                           frame_ends=frame_ends, sinogram_size=sinogram_size,
+                           delays=delays)
+    bounds = list(range(0, len(words), chunk_size)) + [len(words)]
+    begins, ends = bounds[:-1], bounds[1:]
+    num_threads = max(num_threads, 1)
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        # Submit the chunks in batches so that the counts of at most
+        # num_threads chunks are held in memory at once
+        for b in range(0, len(begins), num_threads):
+            results = list(executor.map(unlist_chunk,
+                                        begins[b:b + num_threads],
+                                        ends[b:b + num_threads]))
+            last_time = None
+            for counts, chunk_last_time in results:
+                for i, (bins, frame_counts) in counts.items():
+                    accumulate(i, bins, frame_counts)
+                if chunk_last_time is not None:
+                    last_time = chunk_last_time
+            if last_time is not None:
+                for i in np.nonzero(~flushed & (frame_ends <= last_time))[0]:
+                    flush(i)
+            if flushed.all():
+                break
+    for i in np.nonzero(~flushed)[0]:
+        flush(i)
+    del unlist_chunk, words
+    return sinograms
+
+
+def simulate_list_mode(path, duration, rate=20.0, sinogram_size=1000,
+                       delay_fraction=0.2, seed=0):
+    """
+    Writes a synthetic list-mode file with a time tag every ms followed by a
+    Poisson distributed number of (prompt and delayed) events, interspersed
+    with other tag words that should be ignored. Used to validate the
+    unlisting.
+
+    Parameters
+    ----------
+    path : str
+        Path of the list-mode file to write
+    duration : int
+        Duration of the acquisition in ms
+    rate : float
+        Mean number of events per ms
+    sinogram_size : int
+        Number of bins in the sinogram
+    delay_fraction : float
+        Fraction of the events that are delays
+    seed : int
+        Seed of the random number generator
+
+    Returns
+    -------
+    times : np.ndarray
+        Time (ms) of each event
+    addresses : np.ndarray
+        The sinogram bin address of each event
+    prompt : np.ndarray
+        Whether each event is a prompt
+    """
+    rng = np.random.RandomState(seed)
+    n_events = rng.poisson(rate, duration)
+    times = np.repeat(np.arange(duration), n_events)
+    addresses = rng.randint(0, sinogram_size, len(times))
+    prompt = rng.uniform(size=len(times)) >= delay_fraction
+    events = (addresses | np.where(prompt, PROMPT_BIT, 0)).astype(np.uint32)
+    # Other tags (e.g. gantry and singles tags) with the top bits 101
+    others = (0xA0000000 | rng.randint(0, TIME_MASK, duration)).astype(
+        np.uint32)
+    tags = (TIME_TAG | np.arange(duration)).astype(np.uint32)
+    words = []
+    offsets = np.concatenate(([0], np.cumsum(n_events)))
+    for t in range(duration):
+        words.append(tags[t:t + 1])
+        words.append(events[offsets[t]:offsets[t + 1]])
+        if t % 7 == 3:
+            words.append(others[t:t + 1])
+    np.concatenate(words).astype('<u4').tofile(path)
+    return times, addresses, prompt
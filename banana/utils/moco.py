@@ -1,13 +1,15 @@
 import os.path
-import pydicom
 import glob
 import shutil
 import errno
 import subprocess as sp
 from banana.interfaces.dicom import DicomHeaderInfoExtraction
+from banana.utils.dicom_index import DicomHeaderIndex
+from banana.utils.csa import read_ascconv
 import numpy as np
 import re
 import datetime as dt
+from concurrent.futures import ThreadPoolExecutor
 
 
 PHASE_IMAGE_TYPE = ['ORIGINAL', 'PRIMARY', 'P', 'ND']
@@ -21,8 +23,31 @@ PHASE_IMAGE_TYPE = ['ORIGINAL', 'PRIMARY', 'P', 'ND']
 #     return avail_scans
 
 
+def series_name(fields):
+    """
+    Returns the 'NN_SeriesDescription' name of a series given the header
+    fields of one of its files (see banana.utils.dicom_index)
+    """
+    name_scan = (str(fields['SeriesNumber']).zfill(2) + '_' +
+                 fields['SeriesDescription'])
+    return name_scan.replace(" ", "_")
+
+
+def link_or_copy(src, dst_dir):
+    """
+    Places a file in a directory by hardlinking it, falling back to copying
+    it if the filesystem does not allow it (e.g. across devices)
+    """
+    dst = os.path.join(dst_dir, os.path.basename(src))
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy(src, dst)
+    return dst
+
+
 def local_motion_detection(input_dir, pet_dir=None, pet_recon=None,
-                           struct2align=None):
+                           struct2align=None, num_processes=None):
     scan_description = []
     dcm_files = sorted(glob.glob(input_dir + '/*.dcm'))
 
@@ -53,37 +78,31 @@ def local_motion_detection(input_dir, pet_dir=None, pet_recon=None,
         os.makedirs(working_dir)
         copy = False
 
+    header_index = DicomHeaderIndex.for_directory(
+        input_dir, cache_dir=working_dir, num_processes=num_processes)
+
     if dcm:
-        hdr = pydicom.read_file(dcm_files[0])
-        name_scan = (
-            str(hdr.SeriesNumber).zfill(2)+'_'+hdr.SeriesDescription)
-        name_scan = name_scan.replace(" ", "_")
-        scan_description = [name_scan]
-        files = []
-        for i, im in enumerate(dcm_files):
-            hdr = pydicom.read_file(im)
-            name_scan = (
-                str(hdr.SeriesNumber).zfill(2)+'_'+hdr.SeriesDescription)
-            name_scan = name_scan.replace(" ", "_")
+        series_names = [series_name(h)
+                        for h in header_index.headers(dcm_files)]
+        # Group consecutive files belonging to the same series
+        scan_description = [series_names[0]]
+        groups = [[]]
+        for im, name_scan in zip(dcm_files, series_names):
             if name_scan in scan_description[-1]:
-                files.append(im)
-            elif name_scan not in scan_description[-1] and copy:
-                if (os.path.isdir(
-                        os.path.join(working_dir, scan_description[-1])) is False):
-                    os.mkdir(os.path.join(working_dir, scan_description[-1]))
-                    for f in files:
-                        shutil.copy(f, os.path.join(working_dir, scan_description[-1]))
-                files = [im]
-                scan_description.append(name_scan)
-            elif name_scan not in scan_description[-1] and not copy:
-                files = [im]
+                groups[-1].append(im)
+            else:
                 scan_description.append(name_scan)
-            if i == len(dcm_files)-1 and copy:
-                if (os.path.isdir(os.path.join(working_dir, scan_description[-1])) is
-                        False):
-                    os.mkdir(os.path.join(working_dir, scan_description[-1]))
-                    for f in files:
-                        shutil.copy(f, os.path.join(working_dir, scan_description[-1]))
+                groups.append([im])
+        if copy:
+            to_place = []
+            for name_scan, files in zip(scan_description, groups):
+                scan_dir = os.path.join(working_dir, name_scan)
+                if os.path.isdir(scan_dir) is False:
+                    os.mkdir(scan_dir)
+                    to_place.extend((f, scan_dir) for f in files)
+            with ThreadPoolExecutor() as executor:
+                list(executor.map(lambda args: link_or_copy(*args),
+                                  to_place))
 
     elif not dcm and copy:
         for s in scan_description:
@@ -95,7 +114,8 @@ def local_motion_detection(input_dir, pet_dir=None, pet_recon=None,
         if struct2align is not None:
             shutil.copy2(struct2align, os.path.join(working_dir, '/'))
 
-    phase_image_type, no_dicom = check_image_type(input_dir, scan_description)
+    phase_image_type, no_dicom = check_image_type(
+        input_dir, scan_description, header_index=header_index)
 
     if no_dicom:
         print(('No DICOM files could be found in the following folders '
@@ -110,7 +130,8 @@ def local_motion_detection(input_dir, pet_dir=None, pet_recon=None,
         scan_description = [x for x in scan_description
                             if x not in phase_image_type]
 
-    same_start_time = check_image_start_time(input_dir, scan_description)
+    same_start_time = check_image_start_time(
+        input_dir, scan_description, header_index=header_index)
 
     if same_start_time:
         print(('The following scans were found to have the same start time '
@@ -119,6 +140,7 @@ def local_motion_detection(input_dir, pet_dir=None, pet_recon=None,
                .format('\n'.join(x for x in same_start_time))))
         scan_description = [x for x in scan_description
                             if x not in same_start_time]
+    header_index.close()
 
     return scan_description
 
@@ -206,7 +228,7 @@ def inputs_generation(scan_description, input_dir, siemens=False):
         return ref, ref_type, t1s, epis, t2s, dwis, utes, umaps
 
 
-def guess_scan_type(scans, input_dir):
+def guess_scan_type(scans, input_dir, header_index=None):
 
     ref = None
     ref_type = None
@@ -216,6 +238,10 @@ def guess_scan_type(scans, input_dir):
     dwi_scans = []
     res_t1 = []
     res_t2 = []
+    if header_index is None:
+        with DicomHeaderIndex.for_directory(input_dir) as header_index:
+            return guess_scan_type(
+                scans, input_dir, header_index=header_index)
 
     for scan in scans:
         sequence_name = None
@@ -224,17 +250,10 @@ def guess_scan_type(scans, input_dir):
             dcm_files = sorted(glob.glob(input_dir+'/'+scan+'/*.IMA'))
         if not dcm_files:
             continue
-        dicom = dcm_files[0]
-        hd = pydicom.read_file(dicom)
-        with open(dcm_files[0], 'rb') as f:
-            for line in f:
-                try:
-                    line = line[:-1].decode('utf-8')
-                except UnicodeDecodeError:
-                    continue
-                if 'tSequenceFileName' in line:
-                    sequence_name = line.strip().split('\\')[-1].split('"')[0]
-                    break
+        hd = header_index[dcm_files[0]]
+        sequence_file = read_ascconv(dcm_files[0]).get('tSequenceFileName')
+        if sequence_file is not None:
+            sequence_name = sequence_file.split('\\')[-1]
 
         if sequence_name is not None:
             if (('tfl' in sequence_name or
@@ -242,7 +261,7 @@ def guess_scan_type(scans, input_dir):
                     (re.match('.*(t1|T1).*', scan) or
                      re.match('.*(ute|UTE).*', scan))):
                 t1s.append(scan)
-                res_t1.append([scan, float(hd.PixelSpacing[0])])
+                res_t1.append([scan, float(hd['PixelSpacing'][0])])
             elif 'bold' in sequence_name or 'asl' in sequence_name:
                 epis.append(scan)
             elif 'diff' in sequence_name:
@@ -250,8 +269,9 @@ def guess_scan_type(scans, input_dir):
             else:
                 t2s.append(scan)
                 if 'gre' not in sequence_name:
-                    res_t2.append([scan, float(hd.PixelSpacing[0])])
-    dwis, unused_b0 = dwi_type_assignment(input_dir, dwi_scans)
+                    res_t2.append([scan, float(hd['PixelSpacing'][0])])
+    dwis, unused_b0 = dwi_type_assignment(input_dir, dwi_scans,
+                                          header_index=header_index)
     if unused_b0:
         print(('The following b0 images have different phase encoding '
                'direction respect to the main diffusion and/or the ped '
@@ -337,12 +357,16 @@ def guess_scan_type(scans, input_dir):
     return inputs
 
 
-def dwi_type_assignment(input_dir, dwi_images):
+def dwi_type_assignment(input_dir, dwi_images, header_index=None):
 
     main_dwi = []
     b0 = []
     dwis = []
     unused_b0 = []
+    if header_index is None:
+        with DicomHeaderIndex.for_directory(input_dir) as header_index:
+            return dwi_type_assignment(
+                input_dir, dwi_images, header_index=header_index)
 
     for dwi in dwi_images:
         cmd = 'mrinfo {0}'.format(input_dir+'/'+dwi)
@@ -354,6 +378,8 @@ def dwi_type_assignment(input_dir, dwi_images):
                 break
         hd_extraction = DicomHeaderInfoExtraction()
         hd_extraction.inputs.dicom_folder = input_dir+'/'+dwi
+        if header_index.persistent:
+            hd_extraction.inputs.header_index = header_index.path
         dcm_info = hd_extraction.run()
 
         if dcm_info.outputs.pe_angle and dcm_info.outputs.ped:
@@ -398,10 +424,14 @@ def dwi_type_assignment(input_dir, dwi_images):
     return dwis, unused_b0
 
 
-def check_image_type(input_dir, scans):
+def check_image_type(input_dir, scans, header_index=None):
 
     toremove = []
     nodicom = []
+    if header_index is None:
+        with DicomHeaderIndex.for_directory(input_dir) as header_index:
+            return check_image_type(
+                input_dir, scans, header_index=header_index)
 
     for scan in scans:
         dcm_file = None
@@ -417,8 +447,7 @@ def check_image_type(input_dir, scans):
 
         if dcm_file is not None:
             try:
-                hd = pydicom.read_file(dcm_file)
-                im_type = hd['0008', '0008'].value
+                im_type = header_index[dcm_file]['ImageType']
                 if im_type == PHASE_IMAGE_TYPE:
                     toremove.append(scan)
             except:
@@ -428,15 +457,21 @@ def check_image_type(input_dir, scans):
     return toremove, nodicom
 
 
-def check_image_start_time(input_dir, scans):
+def check_image_start_time(input_dir, scans, header_index=None):
 
     start_times = []
     toremove = []
+    if header_index is None:
+        with DicomHeaderIndex.for_directory(input_dir) as header_index:
+            return check_image_start_time(
+                input_dir, scans, header_index=header_index)
     for scan in scans:
         try:
             scan_number = scan.split('-')[0].zfill(3)
             hd_extraction = DicomHeaderInfoExtraction()
             hd_extraction.inputs.dicom_folder = input_dir+'/'+scan
+            if header_index.persistent:
+                hd_extraction.inputs.header_index = header_index.path
             dcm_info = hd_extraction.run()
 
             start_times.append([dcm_info.outputs.start_time, scan_number,
@@ -0,0 +1,298 @@
+import os
+import os.path as op
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from sklearn.decomposition import IncrementalPCA
+from banana.utils.list_mode import MMR_SINOGRAM_SHAPE
+
+
+# Segment number and number of axial positions of each segment of the span-11
+# mMR sinograms, in the order they are stored in (the segments being
+# interleaved 0, +1, -1, +2, -2, ...)
+MMR_SEGMENTS = ((0, 127), (1, 115), (-1, 115), (2, 93), (-2, 93), (3, 71),
+                (-3, 71), (4, 49), (-4, 49), (5, 27), (-5, 27))
+
+
+def _segment_order(max_segment):
+    return [0] + [s for n in range(1, max_segment + 1) for s in (n, -n)]
+
+
+def ssrb(sinograms, segments=MMR_SEGMENTS, num_segments_to_combine=1,
+         view_mash=1, normalise=False):
+    """
+    Single-slice rebinning (SSRB) of (a stack of) 3D sinograms. Groups of
+    neighbouring segments are combined into a single segment, each oblique
+    sinogram being added to the sinogram at the same average axial position
+    in the group's central segment, and groups of neighbouring views are
+    summed ("mashed"). Matches the behaviour of the STIR SSRB utility.
+
+    Parameters
+    ----------
+    sinograms : np.ndarray
+        (..., n_sinograms, n_views, n_tangential) array of sinograms (e.g. a
+        memory-mapped array), any leading dimensions (e.g. frames) being
+        rebinned independently
+    segments : list[tuple[int, int]]
+        The segment number and the number of axial positions of each segment
+        in the order they are stored in the sinograms
+    num_segments_to_combine : int
+        Number of neighbouring segments to combine (must be odd)
+    view_mash : int
+        Number of neighbouring views to combine (must divide the number of
+        views)
+    normalise : bool
+        Whether to divide each rebinned bin by the number of sinogram bins
+        that contribute to it
+
+    Returns
+    -------
+    rebinned : np.ndarray
+        The (..., n_rebinned_sinograms, n_views // view_mash, n_tangential)
+        float32 rebinned sinograms
+    rebinned_segments : list[tuple[int, int]]
+        The segment number and number of axial positions of each segment in
+        the rebinned sinograms
+    """
+    if num_segments_to_combine % 2 != 1:
+        raise ValueError("Number of segments to combine must be odd ({})"
+                         .format(num_segments_to_combine))
+    n_sinos, n_views, n_tang = sinograms.shape[-3:]
+    if sum(s for _, s in segments) != n_sinos:
+        raise ValueError(
+            "Sizes of segments ({}) don't add up to the number of sinograms "
+            "({})".format(sum(s for _, s in segments), n_sinos))
+    if n_views % view_mash:
+        raise ValueError("View mash ({}) doesn't divide the number of views "
+                         "({})".format(view_mash, n_views))
+    leading = sinograms.shape[:-3]
+    max_axial = max(s for _, s in segments)
+    starts = np.cumsum([0] + [s for _, s in segments])
+    in_segments = dict((num, (start, size)) for (num, size), start
+                       in zip(segments, starts))
+    half = num_segments_to_combine // 2
+    max_segment = max(abs(num) for num, _ in segments)
+    max_out_segment = (max_segment - half) // num_segments_to_combine
+    out_segments = [(g, in_segments[g * num_segments_to_combine][1])
+                    for g in _segment_order(max_out_segment)]
+    out_starts = np.cumsum([0] + [s for _, s in out_segments])
+    rebinned = np.zeros(leading + (out_starts[-1], n_views // view_mash,
+                                   n_tang), dtype=np.float32)
+    if normalise:
+        n_contrib = np.zeros(out_starts[-1], dtype=np.float32)
+    for (group, out_size), out_start in zip(out_segments, out_starts):
+        out_offset = (max_axial - out_size) // 2
+        centre = group * num_segments_to_combine
+        for num in range(centre - half, centre + half + 1):
+            in_start, in_size = in_segments[num]
+            # Shift between the axial positions of the input segment and
+            # those of the output segment
+            shift = (max_axial - in_size) // 2 - out_offset
+            z_in = np.arange(max(0, -shift), min(in_size, out_size - shift))
+            if not len(z_in):
+                continue
+            data = np.asarray(sinograms[..., in_start + z_in[0]:
+                                        in_start + z_in[-1] + 1, :, :])
+            data = data.reshape(data.shape[:-2] + (
+                n_views // view_mash, view_mash, n_tang)).sum(
+                    axis=-2, dtype=np.float32)
+            z_out = out_start + z_in + shift
+            rebinned[..., z_out[0]:z_out[-1] + 1, :, :] += data
+            if normalise:
+                n_contrib[z_out[0]:z_out[-1] + 1] += view_mash
+    if normalise:
+        rebinned /= n_contrib[:, np.newaxis, np.newaxis]
+    return rebinned, out_segments
+
+
+def ssrb_files(in_files, out_dir, shape=MMR_SINOGRAM_SHAPE, dtype='<i2',
+               num_threads=1, out_fname='{}_ssrb.npy', **kwargs):
+    """
+    Rebins sinogram files (e.g. the outputs of unlist_list_mode) frame by
+    frame, reading them through memory maps and saving the rebinned
+    sinograms as float32 .npy files (which can in turn be memory-mapped).
+    Files with the delayed events stored after the prompts (i.e. twice the
+    size of a sinogram) are rebinned into (2, ...) arrays of the rebinned
+    prompts and delays.
+
+    Parameters
+    ----------
+    in_files : list[str]
+        Paths to the raw sinogram files
+    out_dir : str
+        Directory to save the rebinned sinograms in
+    shape : tuple[int]
+        Shape of the sinograms (n_sinograms, n_views, n_tangential)
+    dtype : str
+        Data type of the sinogram files
+    num_threads : int
+        Number of frames to rebin in parallel
+    out_fname : str
+        Format of the rebinned file names (formatted with the stem of the
+        input file)
+    **kwargs
+        Passed to ssrb
+
+    Returns
+    -------
+    out_files : list[str]
+        Paths to the rebinned sinograms
+    """
+    sinogram_bytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+
+    def rebin(in_file):
+        size = os.path.getsize(in_file)
+        if size == sinogram_bytes:
+            file_shape = tuple(shape)
+        elif size == 2 * sinogram_bytes:
+            # Prompts followed by delays
+            file_shape = (2,) + tuple(shape)
+        else:
+            raise ValueError(
+                "Size of sinogram file '{}' ({} bytes) doesn't match that of "
+                "a {} sinogram of {} ({} bytes), or of one with delays ({} "
+                "bytes)".format(in_file, size, 'x'.join(str(d) for d in shape),
+                                np.dtype(dtype), sinogram_bytes,
+                                2 * sinogram_bytes))
+        sinograms = np.memmap(in_file, dtype=dtype, mode='r',
+                              shape=file_shape)
+        rebinned, _ = ssrb(sinograms, **kwargs)
+        out_file = op.join(out_dir, out_fname.format(
+            op.basename(in_file).split('.')[0]))
+        np.save(out_file, rebinned)
+        return out_file
+
+    with ThreadPoolExecutor(max_workers=max(num_threads, 1)) as executor:
+        return list(executor.map(rebin, in_files))
+
+
+def _flat_frames(sinograms):
+    # Memory-mapped (flattened) view of each frame's sinogram
+    frames = []
+    for sinogram in sinograms:
+        if isinstance(sinogram, str):
+            sinogram = np.load(sinogram, mmap_mode='r')
+        frames.append(sinogram.reshape(-1))
+    if len(set(f.shape for f in frames)) > 1:
+        raise ValueError("Sinograms of all frames need to be the same size")
+    return frames
+
+
+def sinogram_pca(sinograms, n_components=3, method='gram', normalise=True,
+                 block_size=2 ** 20, batch_size=16):
+    """
+    Principal component analysis of the sinograms of a series of (short)
+    frames, whose leading components act as surrogate signals of the motion
+    of the subject. The sinograms are streamed from disk so hundreds of
+    frames can be analysed without loading them all into memory at once.
+
+    Parameters
+    ----------
+    sinograms : list[str | np.ndarray]
+        The (SSRB) sinogram of each frame, either as paths to .npy files
+        (which are memory-mapped) or arrays
+    n_components : int
+        Number of principal components to return
+    method : str
+        Either 'gram', where the frames x frames Gram matrix is accumulated
+        over blocks of sinogram bins and eigendecomposed (exact, single pass
+        over the data), or 'incremental', where sklearn's IncrementalPCA is
+        fitted over batches of frames (two passes)
+    normalise : bool
+        Whether to normalise each frame by its total number of counts before
+        the analysis (removing the effects of decay and count rate)
+    block_size : int
+        Number of sinogram bins read at a time ('gram' method)
+    batch_size : int
+        Number of frames read at a time ('incremental' method)
+
+    Returns
+    -------
+    scores : np.ndarray
+        The (n_frames, n_components) principal component scores of each
+        frame, the sign of each component being chosen so that its largest
+        absolute score is positive
+    explained_variance_ratio : np.ndarray
+        The fraction of the variance explained by each component
+    """
+    frames = _flat_frames(sinograms)
+    n_frames = len(frames)
+    n_components = min(n_components, n_frames)
+    n_bins = frames[0].shape[0]
+    if method == 'gram':
+        gram = np.zeros((n_frames, n_frames))
+        totals = np.zeros(n_frames)
+        for start in range(0, n_bins, block_size):
+            block = np.stack([f[start:start + block_size] for f in frames])
+            block = block.astype(np.float64)
+            totals += block.sum(axis=1)
+            gram += block.dot(block.T)
+        if normalise:
+            scale = 1.0 / np.where(totals > 0, totals, 1.0)
+            gram *= np.outer(scale, scale)
+        # Centre the Gram matrix (i.e. subtract the mean sinogram)
+        centring = np.eye(n_frames) - 1.0 / n_frames
+        gram = centring.dot(gram).dot(centring)
+        eigvals, eigvecs = np.linalg.eigh(gram)
+        eigvals = np.clip(eigvals[::-1], 0, None)
+        eigvecs = eigvecs[:, ::-1]
+        scores = eigvecs[:, :n_components] * np.sqrt(
+            eigvals[:n_components])
+        explained = (eigvals[:n_components] / eigvals.sum()
+                     if eigvals.sum() else np.zeros(n_components))
+    elif method == 'incremental':
+        # Make sure every batch has at least n_components frames
+        batch_size = max(batch_size, n_components)
+        bounds = list(range(0, n_frames, batch_size))[1:]
+        if bounds and n_frames - bounds[-1] < n_components:
+            bounds.pop()
+        batches = np.split(np.arange(n_frames), bounds)
+
+        def load(batch):
+            data = np.stack([frames[i] for i in batch]).astype(np.float32)
+            if normalise:
+                totals = data.sum(axis=1, keepdims=True)
+                data /= np.where(totals > 0, totals, 1.0)
+            return data
+
+        ipca = IncrementalPCA(n_components=n_components)
+        for batch in batches:
+            ipca.partial_fit(load(batch))
+        scores = np.concatenate([ipca.transform(load(b)) for b in batches])
+        explained = ipca.explained_variance_ratio_
+    else:
+        raise ValueError(
+            "Unrecognised PCA method '{}', can be 'gram' or 'incremental'"
+            .format(method))
+    signs = np.sign(scores[np.abs(scores).argmax(axis=0),
+                           np.arange(scores.shape[1])])
+    scores *= np.where(signs == 0, 1, signs)
+    return scores, np.asarray(explained)
+
+
+def detect_motion_events(surrogate, threshold=3.0):
+    """
+    Detects abrupt changes in a motion surrogate signal, i.e. frame to frame
+    differences that are more than `threshold` robust standard deviations
+    (estimated from the median absolute deviation) above the median
+    difference
+
+    Parameters
+    ----------
+    surrogate : array-like
+        The surrogate signal of each frame
+    threshold : float
+        Detection threshold in robust standard deviations
+
+    Returns
+    -------
+    events : np.ndarray
+        Indices of the frames that start after a detected motion event
+    """
+    diffs = np.abs(np.diff(np.asarray(surrogate, dtype=float)))
+    if not len(diffs):
+        return np.zeros(0, dtype=int)
+    median = np.median(diffs)
+    sigma = 1.4826 * np.median(np.abs(diffs - median))
+    if sigma == 0:
+        sigma = diffs.std()
+    return np.nonzero(diffs > median + threshold * sigma)[0] + 1
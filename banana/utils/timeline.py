@@ -0,0 +1,335 @@
+import json
+import numpy as np
+
+
+class IntervalTimeline(object):
+    """
+    Run-length encoded timeline, i.e. a set of [start, end) intervals (in
+    seconds from the start of the study) each holding a constant vector of
+    values. Used to store "real clock" quantities such as the mean
+    displacement of each MR volume without having to sample them at a fixed
+    resolution. Periods that are not covered by any interval (e.g. the MR
+    scanner idling between two scans) are implicit in the gaps between
+    consecutive intervals.
+
+    On disk the timeline is stored as a text file with one interval per row
+    (start, end, value_1, ..., value_n) and the study start time in the
+    header.
+
+    Parameters
+    ----------
+    starts : array-like
+        Start times of the intervals (in seconds)
+    ends : array-like
+        End times of the intervals (in seconds)
+    values : array-like
+        Either a (N,) or (N, n_values) array with the values of each interval
+    study_start_time : str
+        The real clock time (HHMMSS.ffffff) corresponding to 0 s
+    """
+
+    HEADER_PREFIX = 'study_start_time='
+
+    def __init__(self, starts, ends, values, study_start_time=None):
+        self.starts = np.asarray(starts, dtype=float)
+        self.ends = np.asarray(ends, dtype=float)
+        values = np.asarray(values, dtype=float)
+        if values.ndim == 1:
+            values = values[:, np.newaxis]
+        self.values = values
+        self.study_start_time = study_start_time
+        if not (len(self.starts) == len(self.ends) == len(self.values)):
+            raise ValueError(
+                "Mismatching number of starts ({}), ends ({}) and values ({})"
+                .format(len(self.starts), len(self.ends), len(self.values)))
+        # Keep intervals sorted by start time so they can be searched
+        order = np.argsort(self.starts, kind='stable')
+        self.starts = self.starts[order]
+        self.ends = self.ends[order]
+        self.values = self.values[order]
+
+    def __len__(self):
+        return len(self.starts)
+
+    @property
+    def duration(self):
+        return self.ends.max() if len(self) else 0.0
+
+    def save(self, path):
+        header = self.HEADER_PREFIX + str(
+            self.study_start_time if self.study_start_time is not None
+            else '')
+        np.savetxt(path, np.column_stack((self.starts, self.ends,
+                                          self.values)), header=header)
+
+    @classmethod
+    def load(cls, path):
+        study_start_time = None
+        with open(path) as f:
+            first_line = f.readline()
+        header = first_line.lstrip('#').strip()
+        if header.startswith(cls.HEADER_PREFIX):
+            study_start_time = header[len(cls.HEADER_PREFIX):] or None
+        data = np.loadtxt(path, ndmin=2)
+        return cls(data[:, 0], data[:, 1], data[:, 2:],
+                   study_start_time=study_start_time)
+
+    def idle_periods(self):
+        """
+        Returns the (M, 2) array of [start, end) periods that are not covered
+        by any interval
+        """
+        covered_until = np.maximum.accumulate(self.ends)
+        gap = self.starts[1:] > covered_until[:-1]
+        return np.column_stack((covered_until[:-1][gap], self.starts[1:][gap]))
+
+    def sample(self, times):
+        """
+        Looks up the values of the timeline at the given times. Times falling
+        in idle periods take the value of the last interval that started
+        before them and, where intervals overlap, the one that started last
+        takes precedence.
+
+        Parameters
+        ----------
+        times : array-like
+            Times (in seconds) to sample the timeline at
+
+        Returns
+        -------
+        values : np.ndarray
+            The (len(times), n_values) sampled values
+        active : np.ndarray
+            Boolean array flagging the times that fall inside an interval
+        """
+        times = np.asarray(times, dtype=float)
+        indices = np.searchsorted(self.starts, times, side='right') - 1
+        valid = indices >= 0
+        indices = np.clip(indices, 0, None)
+        values = self.values[indices]
+        values[~valid] = np.nan
+        covered_until = np.maximum.accumulate(self.ends)
+        active = valid & (times < covered_until[indices])
+        return values, active
+
+    def expand(self, resolution=1.0):
+        """
+        Expands the timeline into regularly spaced samples from 0 to the end
+        of the last interval
+
+        Parameters
+        ----------
+        resolution : float
+            The sampling interval in seconds
+
+        Returns
+        -------
+        times : np.ndarray
+            The sample times
+        values : np.ndarray
+            The (len(times), n_values) sampled values
+        active : np.ndarray
+            Boolean array flagging the samples that fall inside an interval
+        """
+        times = np.arange(0.0, self.duration, resolution)
+        values, active = self.sample(times)
+        return times, values, active
+
+
+SECONDS_PER_DAY = 86400.0
+
+
+def parse_hhmmss(times):
+    """
+    Converts clock times in DICOM 'HHMMSS[.ffffff]' format (either strings or
+    numbers) into seconds since midnight
+
+    Parameters
+    ----------
+    times : str | float | array-like
+        The clock time(s) to convert
+
+    Returns
+    -------
+    secs : float | np.ndarray
+        Seconds since midnight (rounded to the microsecond)
+    """
+    values = np.asarray(times).astype(float)
+    secs = ((values // 10000) * 3600 + ((values // 100) % 100) * 60 +
+            values % 100)
+    secs = np.round(secs, 6)
+    return secs if secs.ndim else float(secs)
+
+
+def format_hhmmss(secs):
+    """
+    Converts seconds since midnight into 'HHMMSS.ffffff' clock time strings
+    (wrapping around midnight)
+
+    Parameters
+    ----------
+    secs : float | array-like
+        Seconds since midnight
+
+    Returns
+    -------
+    times : str | list[str]
+        The formatted clock time(s)
+    """
+    scalar = np.ndim(secs) == 0
+    micros = np.round(np.atleast_1d(np.asarray(secs, dtype=float)) *
+                      1e6).astype(np.int64) % int(SECONDS_PER_DAY * 1e6)
+    hours, micros = np.divmod(micros, 3600 * 10 ** 6)
+    minutes, micros = np.divmod(micros, 60 * 10 ** 6)
+    seconds, micros = np.divmod(micros, 10 ** 6)
+    times = ['{:02d}{:02d}{:02d}.{:06d}'.format(*t)
+             for t in zip(hours, minutes, seconds, micros)]
+    return times[0] if scalar else times
+
+
+def unwrap_midnight(secs):
+    """
+    Adds a day to the times (in seconds since midnight) of a session that
+    crosses midnight, i.e. if the times span more than 12 hours the ones in
+    the morning are assumed to belong to the following day
+    """
+    secs = np.asarray(secs, dtype=float)
+    if secs.size and np.ptp(secs) > SECONDS_PER_DAY / 2:
+        secs = np.where(secs < SECONDS_PER_DAY / 2, secs + SECONDS_PER_DAY,
+                        secs)
+    return secs
+
+
+class AcquisitionTimeline(object):
+    """
+    Acquisition times of the scans/volumes of a session, stored as float
+    seconds since the start of the session so that sorting, interval lookups
+    and durations are simple numpy operations.
+
+    Parameters
+    ----------
+    session_start : float
+        Clock time of the start of the session in seconds since midnight
+    starts : array-like
+        Start of each volume in seconds since the start of the session
+    ends : array-like
+        End of each volume in seconds since the start of the session
+    labels : list[str]
+        Name of each volume
+    scans : list[str]
+        Name of the scan each volume belongs to
+    """
+
+    def __init__(self, session_start, starts, ends, labels=None, scans=None):
+        self.session_start = float(session_start)
+        self.starts = np.asarray(starts, dtype=float)
+        self.ends = np.asarray(ends, dtype=float)
+        n = len(self.starts)
+        self.labels = (list(labels) if labels is not None
+                       else [str(i) for i in range(n)])
+        self.scans = list(scans) if scans is not None else list(self.labels)
+        if not (len(self.ends) == len(self.labels) == len(self.scans) == n):
+            raise ValueError(
+                "Mismatching number of starts ({}), ends ({}), labels ({}) "
+                "and scans ({})".format(n, len(self.ends), len(self.labels),
+                                        len(self.scans)))
+
+    @classmethod
+    def from_clock_times(cls, starts, ends, labels=None, scans=None):
+        """
+        Creates a timeline from the clock times ('HHMMSS.ffffff') of the
+        start and end of each volume. The session starts with the earliest
+        volume.
+        """
+        secs = unwrap_midnight(np.concatenate(
+            (np.atleast_1d(parse_hhmmss(starts)),
+             np.atleast_1d(parse_hhmmss(ends)))))
+        session_start = secs.min()
+        n = len(secs) // 2
+        return cls(session_start, secs[:n] - session_start,
+                   secs[n:] - session_start, labels=labels, scans=scans)
+
+    @classmethod
+    def from_start_times(cls, start_times, labels=None, scans=None):
+        """
+        Creates a timeline from a list of N + 1 clock times, the start of each
+        of the N consecutive volumes followed by the end of the last one (i.e.
+        the format of the 'start_times' output of MeanDisplacementCalculation)
+        """
+        start_times = np.atleast_1d(start_times)
+        return cls.from_clock_times(start_times[:-1], start_times[1:],
+                                    labels=labels, scans=scans)
+
+    def __len__(self):
+        return len(self.starts)
+
+    @property
+    def durations(self):
+        return self.ends - self.starts
+
+    @property
+    def bounds(self):
+        """The start of each volume followed by the end of the last one"""
+        return np.append(self.starts, self.ends[-1])
+
+    @property
+    def mid_points(self):
+        return (self.starts + self.ends) / 2
+
+    def sorted(self):
+        "Returns a copy of the timeline sorted by start time"
+        order = np.argsort(self.starts, kind='stable')
+        return type(self)(self.session_start, self.starts[order],
+                          self.ends[order],
+                          labels=[self.labels[i] for i in order],
+                          scans=[self.scans[i] for i in order])
+
+    def to_seconds(self, clock_times):
+        """
+        Converts clock times ('HHMMSS.ffffff') into seconds since the start of
+        the session, times more than 12 hours before the session start being
+        assumed to be on the following day
+        """
+        secs = np.asarray(parse_hhmmss(clock_times)) - self.session_start
+        secs = np.where(secs < -SECONDS_PER_DAY / 2, secs + SECONDS_PER_DAY,
+                        secs)
+        return secs if secs.ndim else float(secs)
+
+    def to_clock_times(self, secs):
+        "Converts seconds since the start of the session into clock times"
+        return format_hhmmss(self.session_start + np.asarray(secs))
+
+    def lookup(self, times):
+        """
+        Finds the volume acquired at each of the given times (in seconds since
+        the start of the session)
+
+        Returns
+        -------
+        indices : np.ndarray
+            Index of the last volume starting at or before each time (-1 if
+            the time is before the first volume)
+        inside : np.ndarray
+            Whether each time falls within the volume
+        """
+        times = np.asarray(times, dtype=float)
+        order = np.argsort(self.starts, kind='stable')
+        pos = np.searchsorted(self.starts[order], times, side='right') - 1
+        indices = np.where(pos >= 0, order[np.clip(pos, 0, None)], -1)
+        inside = (indices >= 0) & (times < self.ends[indices])
+        return indices, inside
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump({'session_start': format_hhmmss(self.session_start),
+                       'starts': self.starts.tolist(),
+                       'ends': self.ends.tolist(),
+                       'labels': self.labels,
+                       'scans': self.scans}, f, indent=2)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            dct = json.load(f)
+        return cls(parse_hhmmss(dct['session_start']), dct['starts'],
+                   dct['ends'], labels=dct['labels'], scans=dct['scans'])
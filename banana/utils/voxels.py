@@ -0,0 +1,303 @@
+import os
+import csv
+import gzip
+import shutil
+import tempfile
+from collections import namedtuple
+from contextlib import contextmanager
+import numpy as np
+import nibabel as nib
+
+
+def load_mask(mask, shape):
+    """
+    Loads a (brain) mask into a boolean array, returning an array that
+    selects every voxel if `mask` is None
+    """
+    if mask is None:
+        return np.ones(shape, dtype=bool)
+    if isinstance(mask, str):
+        mask = nib.load(mask).dataobj
+    mask = np.asarray(mask) > 0
+    if mask.shape != tuple(shape):
+        raise ValueError("Shape of mask {} doesn't match that of the image {}"
+                         .format(mask.shape, tuple(shape)))
+    return mask
+
+
+RegionalStats = namedtuple(
+    'RegionalStats', 'labels counts sums means stds reference_means')
+
+
+def slab_size_for(shape, max_bytes=2 ** 26, itemsize=4):
+    "Number of axial slices of a 4D image that fit within max_bytes"
+    slice_bytes = int(np.prod(shape[:2])) * int(np.prod(shape[3:])) * itemsize
+    return max(1, int(max_bytes // max(slice_bytes, 1)))
+
+
+def iter_voxel_blocks(img, mask=None, slab_size=None, dtype=np.float32):
+    """
+    Streams the time series of the (masked) voxels of a 4D image in slabs of
+    axial slices, reading them through a memory map (compressed images being
+    decompressed to a temporary file first, see open_image) so that the
+    whole image is never loaded into memory at once
+
+    Parameters
+    ----------
+    img : nibabel.Nifti1Image | str
+        The 4D image (or path to it)
+    mask : np.ndarray | str | None
+        Boolean mask (or path to a mask image) of the voxels to include, all
+        voxels being included if None
+    slab_size : int | None
+        Number of axial slices read at a time, by default as many as fit in
+        64 MB
+    dtype : np.dtype
+        Data type to convert the time series to
+
+    Yields
+    ------
+    slab : slice
+        The slice of the z-axis covered by the block
+    slab_mask : np.ndarray
+        The mask of the voxels of the slab included in the block
+    block : np.ndarray
+        The (n_voxels, n_timepoints) time series of the included voxels of the
+        slab
+    """
+    with open_image(img) as img:
+        shape = img.shape
+        mask = load_mask(mask, shape[:3])
+        if slab_size is None:
+            slab_size = slab_size_for(shape,
+                                      itemsize=np.dtype(dtype).itemsize)
+        for z0 in range(0, shape[2], slab_size):
+            slab = slice(z0, min(z0 + slab_size, shape[2]))
+            slab_mask = mask[:, :, slab]
+            if not slab_mask.any():
+                continue
+            data = np.asarray(img.dataobj[:, :, slab], dtype=dtype)
+            yield slab, slab_mask, data.reshape(data.shape[:3] + (-1,))[
+                slab_mask]
+
+
+@contextmanager
+def memmapped_image(path, tmp_dir=None):
+    """
+    Context manager that loads an image so that its data is memory-mapped.
+    Compressed images are decompressed (in a streaming fashion) into a
+    temporary file first, so that blocks of voxels can be read from them
+    without decompressing the whole file each time.
+
+    Parameters
+    ----------
+    path : str
+        Path to the image
+    tmp_dir : str | None
+        Directory to decompress compressed images into
+    """
+    if not path.endswith('.gz'):
+        yield nib.load(path, mmap=True)
+        return
+    with tempfile.NamedTemporaryFile(suffix='.nii', dir=tmp_dir,
+                                     delete=False) as tmp_file:
+        with gzip.open(path, 'rb') as f:
+            shutil.copyfileobj(f, tmp_file, 2 ** 24)
+    try:
+        yield nib.load(tmp_file.name, mmap=True)
+    finally:
+        os.remove(tmp_file.name)
+
+
+def is_compressed(img):
+    "Whether the data of a (proxy) image is read from a compressed file"
+    fname = img.get_filename()
+    return (nib.is_proxy(img.dataobj) and fname is not None and
+            fname.endswith('.gz'))
+
+
+@contextmanager
+def open_image(img, tmp_dir=None):
+    """
+    Context manager that opens an image so that blocks of its data can be
+    read efficiently, i.e. through a memory map (see memmapped_image). Paths
+    and images whose data is read from a compressed file are (re)opened with
+    memmapped_image, as reading blocks of a compressed file through its array
+    proxy decompresses the whole file for every block. Other images are
+    returned as is.
+
+    Parameters
+    ----------
+    img : nibabel.Nifti1Image | str
+        The image or path to it
+    tmp_dir : str | None
+        Directory to decompress compressed images into
+    """
+    if isinstance(img, str):
+        path = img
+    elif is_compressed(img):
+        path = img.get_filename()
+    else:
+        yield img
+        return
+    with memmapped_image(path, tmp_dir=tmp_dir) as opened:
+        yield opened
+
+
+def create_nifti_memmap(path, shape, affine, dtype=np.float32):
+    """
+    Creates an (uncompressed) NIfTI file and returns a writable memory map of
+    its data, so that large images can be written block by block
+
+    Parameters
+    ----------
+    path : str
+        Path of the image to create (.nii)
+    shape : tuple[int]
+        Shape of the image
+    affine : np.ndarray
+        Affine of the image
+    dtype : np.dtype
+        Data type of the image
+    """
+    hdr = nib.Nifti1Image(np.zeros((1,) * len(shape), dtype=dtype),
+                          affine).header
+    hdr.set_data_shape(shape)
+    offset = 352
+    hdr.set_data_offset(offset)
+    with open(path, 'wb') as f:
+        hdr.write_to(f)
+        f.write(b'\0' * (offset - f.tell()))
+        f.truncate(offset + int(np.prod(shape)) * np.dtype(dtype).itemsize)
+    return np.memmap(path, dtype=dtype, mode='r+', offset=offset,
+                     shape=tuple(shape), order='F')
+
+
+def gzip_file(path, out_path=None):
+    "Compresses a file (in a streaming fashion), removing the original"
+    if out_path is None:
+        out_path = path + '.gz'
+    with open(path, 'rb') as f, gzip.open(out_path, 'wb') as out_f:
+        shutil.copyfileobj(f, out_f, 2 ** 24)
+    os.remove(path)
+    return out_path
+
+
+def regional_statistics(img, labels, slab_size=None, reference_mask=None,
+                        background=0):
+    """
+    Computes the voxel count, sum, mean and (population) standard deviation of
+    every region of a label image (e.g. an atlas) in every frame of a 3D or 4D
+    image in a single pass over the image, streaming it in slabs of axial
+    slices and accumulating the sums of each region with np.bincount
+
+    Parameters
+    ----------
+    img : nibabel.Nifti1Image | str
+        The 3D or 4D image (or path to it)
+    labels : np.ndarray | str
+        Integer label image (or path to it) in the space of the image
+    slab_size : int | None
+        Number of axial slices read at a time
+    reference_mask : np.ndarray | str | None
+        Mask of a reference region (which may overlap the labelled regions),
+        whose mean in each frame is accumulated in the same pass (e.g. for
+        SUVR calculation)
+    background : int | None
+        Label of the voxels to ignore
+
+    Returns
+    -------
+    stats : RegionalStats
+        The labels of the regions (n_regions,), their voxel counts
+        (n_regions,) and the sums, means and standard deviations of their
+        voxels in each frame (n_regions, n_frames), along with the mean of the
+        reference region in each frame (n_frames,) or None
+    """
+    with open_image(img) as img:
+        return _regional_statistics(img, labels, slab_size, reference_mask,
+                                    background)
+
+
+def _regional_statistics(img, labels, slab_size, reference_mask, background):
+    shape = img.shape[:3]
+    n_frames = int(np.prod(img.shape[3:]))
+    if isinstance(labels, str):
+        labels = nib.load(labels).dataobj
+    labels = np.asarray(labels).astype(np.int64)
+    if labels.shape != shape:
+        raise ValueError(
+            "Shape of label image {} doesn't match that of the image {}"
+            .format(labels.shape, shape))
+    region_labels, indices = np.unique(labels, return_inverse=True)
+    indices = indices.reshape(shape)
+    n_regions = len(region_labels)
+    if reference_mask is not None:
+        reference_mask = load_mask(reference_mask, shape)
+        reference_sums = np.zeros(n_frames)
+    if slab_size is None:
+        slab_size = slab_size_for(img.shape, itemsize=8)
+    sums = np.zeros(n_regions * n_frames)
+    sq_sums = np.zeros(n_regions * n_frames)
+    frame_offsets = np.arange(n_frames)
+    for z0 in range(0, shape[2], slab_size):
+        slab = slice(z0, min(z0 + slab_size, shape[2]))
+        data = np.asarray(img.dataobj[:, :, slab], dtype=np.float64)
+        data = data.reshape(-1, n_frames)
+        # Index of the (region, frame) pair of each voxel in each frame
+        bins = (indices[:, :, slab].reshape(-1, 1) * n_frames +
+                frame_offsets).ravel()
+        values = data.ravel()
+        sums += np.bincount(bins, weights=values,
+                            minlength=n_regions * n_frames)
+        sq_sums += np.bincount(bins, weights=values ** 2,
+                               minlength=n_regions * n_frames)
+        if reference_mask is not None:
+            reference_sums += data[reference_mask[:, :, slab].ravel()].sum(
+                axis=0)
+    counts = np.bincount(indices.ravel(), minlength=n_regions)
+    sums = sums.reshape(n_regions, n_frames)
+    sq_sums = sq_sums.reshape(n_regions, n_frames)
+    if background is not None:
+        keep = region_labels != background
+        region_labels, counts = region_labels[keep], counts[keep]
+        sums, sq_sums = sums[keep], sq_sums[keep]
+    means = sums / counts[:, np.newaxis]
+    stds = np.sqrt(np.clip(sq_sums / counts[:, np.newaxis] - means ** 2, 0,
+                           None))
+    if reference_mask is not None:
+        reference_means = reference_sums / reference_mask.sum()
+    else:
+        reference_means = None
+    return RegionalStats(region_labels, counts, sums, means, stds,
+                         reference_means)
+
+
+def save_regional_statistics(path, stats):
+    """
+    Saves regional statistics (see regional_statistics) in a CSV table with a
+    row for each region in each frame, along with the ratio of the regional
+    means to the reference mean (e.g. the SUVR) if a reference was used
+
+    Parameters
+    ----------
+    path : str
+        Path of the CSV file
+    stats : RegionalStats
+        The regional statistics
+    """
+    n_frames = stats.sums.shape[1]
+    header = ['label', 'frame', 'voxels', 'mean', 'sum', 'std']
+    if stats.reference_means is not None:
+        header.append('ratio')
+    with open(path, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        for i, label in enumerate(stats.labels):
+            for frame in range(n_frames):
+                row = [label, frame, stats.counts[i], stats.means[i, frame],
+                       stats.sums[i, frame], stats.stds[i, frame]]
+                if stats.reference_means is not None:
+                    row.append(stats.means[i, frame] /
+                               stats.reference_means[frame])
+                writer.writerow(row)
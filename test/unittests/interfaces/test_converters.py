@@ -0,0 +1,69 @@
+import os
+import os.path as op
+import tempfile
+import shutil
+from unittest import TestCase
+import numpy as np
+import nibabel as nib
+import pydicom
+from pydicom.data import get_testdata_file
+from banana.interfaces.converters import Nii2Dicom
+
+
+class TestNii2Dicom(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        reference = pydicom.read_file(get_testdata_file('MR_small.dcm'))
+        shape = (reference.Columns, reference.Rows, 3)
+        self.reference_dicom = []
+        for i in range(shape[2]):
+            reference.InstanceNumber = i + 1
+            fname = op.join(self.tmp_dir, 'umap{}.dcm'.format(i))
+            reference.save_as(fname)
+            self.reference_dicom.append(fname)
+        rng = np.random.RandomState(0)
+        self.in_file = op.join(self.tmp_dir, 'umap.nii.gz')
+        nib.save(nib.Nifti1Image(
+            rng.uniform(0, 3000, shape).astype(np.float32), np.eye(4)),
+            self.in_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def per_slice(self, out_dir):
+        "The previous implementation, decoding the reference pixel data"
+        nii_data = nib.load(self.in_file).get_fdata()
+        for i in range(nii_data.shape[2]):
+            dcm = pydicom.read_file(self.reference_dicom[i])
+            nifti = nii_data[:, :, i].astype('uint16')
+            pixel_array = dcm.pixel_array
+            pixel_array.setflags(write=True)
+            pixel_array.flat[:] = nifti.flat[:]
+            dcm.PixelData = pixel_array.T.tobytes()
+            dcm.save_as(op.join(out_dir, 'umap_vol{}.dcm'.format(
+                str(i).zfill(4))))
+
+    def test_matches_per_slice(self):
+        ref_dir = op.join(self.tmp_dir, 'ref')
+        os.mkdir(ref_dir)
+        self.per_slice(ref_dir)
+        work_dir = op.join(self.tmp_dir, 'work')
+        os.mkdir(work_dir)
+        cwd = os.getcwd()
+        os.chdir(work_dir)
+        try:
+            out_dir = Nii2Dicom(
+                in_file=self.in_file, reference_dicom=self.reference_dicom,
+                num_threads=2).run().outputs.out_file
+        finally:
+            os.chdir(cwd)
+        fnames = sorted(os.listdir(ref_dir))
+        self.assertEqual(sorted(os.listdir(out_dir)), fnames)
+        for fname in fnames:
+            ref = pydicom.read_file(op.join(ref_dir, fname))
+            dcm = pydicom.read_file(op.join(out_dir, fname))
+            self.assertEqual(list(dcm.keys()), list(ref.keys()))
+            for elem in ref:
+                self.assertEqual(dcm[elem.tag].value, elem.value,
+                                 str(elem.tag))
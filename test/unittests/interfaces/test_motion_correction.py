@@ -0,0 +1,291 @@
+import os
+import os.path as op
+import tempfile
+import shutil
+from unittest import TestCase
+import numpy as np
+import nibabel as nib
+import pydicom
+from pydicom.data import get_testdata_file
+from banana.utils.timeline import AcquisitionTimeline
+from banana.interfaces.motion_correction import (
+    CreateMocoSeries, MeanDisplacementCalculation, MotionMatsToStack,
+    batch_rmsdiff, batch_avscale, save_motion_mats_stack,
+    load_motion_mats_stack, read_motion_mats, bin_motion_mats,
+    motion_mats_prefix_sums, average_motion_mats, detect_motion_frames,
+    sweep_motion_framing, apply_flirt_mats)
+
+
+def random_rigid_mats(n, seed=0, max_rot=0.2, max_trans=10.0):
+    rng = np.random.RandomState(seed)
+    mats = np.tile(np.eye(4), (n, 1, 1))
+    for i in range(n):
+        rx, ry, rz = rng.uniform(-max_rot, max_rot, 3)
+        Rx = np.array([[1, 0, 0],
+                       [0, np.cos(rx), np.sin(rx)],
+                       [0, -np.sin(rx), np.cos(rx)]])
+        Ry = np.array([[np.cos(ry), 0, -np.sin(ry)],
+                       [0, 1, 0],
+                       [np.sin(ry), 0, np.cos(ry)]])
+        Rz = np.array([[np.cos(rz), np.sin(rz), 0],
+                       [-np.sin(rz), np.cos(rz), 0],
+                       [0, 0, 1]])
+        mats[i, :3, :3] = Rx.dot(Ry).dot(Rz)
+        mats[i, :3, 3] = rng.uniform(-max_trans, max_trans, 3)
+    return mats
+
+
+class TestRigidMotionKernel(TestCase):
+
+    cog = np.array([90.5, 108.2, 72.9])
+
+    def setUp(self):
+        self.mats = random_rigid_mats(50)
+        self.scalar = MeanDisplacementCalculation()
+
+    def test_rmsdiff_reference(self):
+        ref = [self.scalar.rmsdiff(self.cog, m, np.eye(4)) for m in self.mats]
+        self.assertTrue(np.allclose(batch_rmsdiff(self.cog, self.mats), ref))
+
+    def test_rmsdiff_consecutive(self):
+        ref = [self.scalar.rmsdiff(self.cog, self.mats[i], self.mats[i + 1])
+               for i in range(len(self.mats) - 1)]
+        batch = batch_rmsdiff(self.cog, T1=self.mats[:-1], T2=self.mats[1:])
+        self.assertTrue(np.allclose(batch, ref))
+
+    def test_avscale(self):
+        ref = [self.scalar.avscale(m, self.cog) for m in self.mats]
+        self.assertTrue(np.allclose(batch_avscale(self.mats, self.cog), ref))
+
+    def test_avscale_singular(self):
+        # Rotation of 90 degrees around y makes the Euler decomposition
+        # singular
+        mat = np.eye(4)
+        mat[:3, :3] = [[0, 0, -1], [0, 1, 0], [1, 0, 0]]
+        ref = self.scalar.avscale(mat, self.cog)
+        self.assertTrue(np.allclose(batch_avscale(mat[np.newaxis], self.cog),
+                                    [ref]))
+
+
+class TestMotionMatsStack(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.mats = random_rigid_mats(5)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_save_load(self):
+        fname = save_motion_mats_stack(
+            op.join(self.tmp_dir, 'mats.npy'), self.mats,
+            volume_names=['vol{}'.format(i) for i in range(5)],
+            start_times=['120000.000000'] * 5)
+        mats, sidecar = load_motion_mats_stack(fname)
+        self.assertTrue(np.array_equal(mats, self.mats))
+        self.assertEqual(sidecar['volume_names'][-1], 'vol4')
+        self.assertTrue(np.array_equal(read_motion_mats(fname), self.mats))
+
+    def test_legacy_conversion(self):
+        legacy_dir = op.join(self.tmp_dir, 'motion_mats')
+        os.mkdir(legacy_dir)
+        for i, mat in enumerate(self.mats):
+            np.savetxt(op.join(legacy_dir, 'MAT_{:04}_motion_mat.mat'
+                               .format(i)), mat)
+            np.savetxt(op.join(legacy_dir, 'MAT_{:04}_motion_mat_inv.mat'
+                               .format(i)), np.linalg.inv(mat))
+        cwd = os.getcwd()
+        os.chdir(self.tmp_dir)
+        try:
+            result = MotionMatsToStack(in_dir=legacy_dir).run()
+        finally:
+            os.chdir(cwd)
+        mats, sidecar = load_motion_mats_stack(result.outputs.out_file)
+        self.assertTrue(np.allclose(mats, self.mats))
+        self.assertEqual(sidecar['volume_names'][0], 'MAT_0000_motion_mat')
+
+
+class TestFixedBinningEngine(TestCase):
+
+    def setUp(self):
+        self.mats = random_rigid_mats(40, seed=1)
+        rng = np.random.RandomState(1)
+        self.vol_times = np.cumsum(rng.uniform(0.5, 20, 40))
+
+    def interp(self, t):
+        if t <= self.vol_times[0]:
+            return 0, self.mats[0]
+        for i in range(len(self.vol_times) - 1):
+            t0, t1 = self.vol_times[i], self.vol_times[i + 1]
+            if t0 <= t < t1:
+                w = (t - t0) / (t1 - t0)
+                return i, (1 - w) * self.mats[i] + w * self.mats[i + 1]
+        return len(self.mats) - 2, self.mats[-1]
+
+    def test_bins(self):
+        edges = np.arange(-10, self.vol_times[-1] + 30, 3.7)
+        bin_mats = bin_motion_mats(self.mats, self.vol_times, edges)
+        self.assertEqual(len(bin_mats), len(edges) - 1)
+        for k in range(len(edges) - 1):
+            i0, start = self.interp(edges[k])
+            i1, end = self.interp(edges[k + 1])
+            inner = list(self.mats[i0 + 2:i1])
+            ref = np.mean([start] + inner + [end], axis=0)
+            self.assertTrue(np.allclose(bin_mats[k], ref))
+
+
+class TestFrameAveraging(TestCase):
+
+    def test_average_skips_identity(self):
+        mats = random_rigid_mats(20, seed=2)
+        mats[[0, 3, 4, 11]] = np.eye(4)
+        index = motion_mats_prefix_sums(mats)
+        starts = [0, 3, 3, 5, 0]
+        ends = [3, 5, 12, 20, 20]
+        average_mats = average_motion_mats(index, starts, ends)
+        for avg, v1, v2 in zip(average_mats, starts, ends):
+            not_idt = [m for m in mats[v1:v2] if not (m == np.eye(4)).all()]
+            ref = np.mean(not_idt, axis=0) if not_idt else np.eye(4)
+            self.assertTrue(np.allclose(avg, ref))
+        self.assertTrue(np.array_equal(
+            average_motion_mats(index, [3], [5])[0], np.eye(4)))
+
+
+class TestMotionFramingSweep(TestCase):
+
+    def setUp(self):
+        # Two steps in the mean displacement, at volumes 10 and 25
+        self.md = np.concatenate((np.ones(10), np.ones(15) * 4,
+                                  np.ones(15) * 1.5))
+        self.md_consec = np.abs(np.diff(self.md))
+        self.scan_duration = np.ones(40) * 3.0
+
+    def test_detect(self):
+        self.assertEqual(
+            detect_motion_frames(self.md, self.md_consec, self.scan_duration,
+                                 2.0, 20.0), [0, 10, 25, 40])
+
+    def test_sweep(self):
+        results = sweep_motion_framing(
+            self.md, self.md_consec, self.scan_duration, [1.0, 2.0, 5.0],
+            [20.0, 40.0])
+        self.assertEqual(len(results), 6)
+        for result in results:
+            self.assertEqual(
+                result['frame_vol_numbers'],
+                detect_motion_frames(
+                    self.md, self.md_consec, self.scan_duration,
+                    result['motion_threshold'],
+                    result['temporal_threshold']))
+            self.assertEqual(result['n_frames'],
+                             len(result['frame_vol_numbers']) - 1)
+        self.assertEqual(results[-1]['frame_vol_numbers'], [0, 40])
+        self.assertEqual(results[2]['frame_start_secs'], [0.0, 30.0, 75.0,
+                                                          120.0])
+
+
+class TestApplyFlirtMats(TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(3)
+        self.data = rng.randint(0, 100, (10, 12, 8)).astype(np.int16)
+        self.img = nib.Nifti1Image(self.data, np.diag([2.0, 2.0, 3.0, 1.0]))
+
+    def test_translation(self):
+        # FLIRT coordinates are in mm and, as the affine has a positive
+        # determinant, the x axis is flipped
+        mat = np.eye(4)
+        mat[:3, 3] = [4.0, -2.0, 3.0]
+        resampled = list(apply_flirt_mats(self.img, mat[np.newaxis]))[0]
+        self.assertTrue(np.array_equal(resampled[:-2, :-1, 1:],
+                                       self.data[2:, 1:, :-1]))
+        self.assertTrue((resampled[-2:] == 0).all())
+
+    def test_identity(self):
+        resampled = list(apply_flirt_mats(
+            self.img, np.tile(np.eye(4), (3, 1, 1)), order=1,
+            num_threads=2))
+        self.assertEqual(len(resampled), 3)
+        for data in resampled:
+            self.assertTrue(np.array_equal(data, self.data))
+
+
+class TestCreateMocoSeries(TestCase):
+
+    start_times = ['111500.000000', '111530.500000', '111610.000000',
+                   '111700.250000', '111715.000000']
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        template = pydicom.read_file(get_testdata_file('MR_small.dcm'))
+        template.add_new(0x00190010, 'LO', 'SIEMENS MR HEADER')
+        template.add_new(0x00191025, 'FD', [0.0, 0.0, 0.0])
+        template.add_new(0x00191026, 'FD', [0.0, 0.0, 0.0])
+        self.template = op.join(self.tmp_dir, 'template.IMA')
+        template.save_as(self.template)
+        rng = np.random.RandomState(0)
+        self.motion_par = op.join(self.tmp_dir, 'motion_par.txt')
+        np.savetxt(self.motion_par, np.concatenate(
+            (rng.uniform(-0.1, 0.1, (4, 3)), rng.uniform(-5, 5, (4, 3))),
+            axis=1))
+        self.start_times_file = op.join(self.tmp_dir, 'start_times.txt')
+        np.savetxt(self.start_times_file, self.start_times, fmt='%s')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def per_instance(self, out_dir):
+        "The previous implementation, re-reading the template per instance"
+        motion_par = np.loadtxt(self.motion_par)
+        timeline = AcquisitionTimeline.from_start_times(
+            np.loadtxt(self.start_times_file, dtype=str))
+        start_times = timeline.to_clock_times(timeline.starts)
+        new_uid = pydicom.uid.generate_uid()
+        for i in range(len(start_times)):
+            mp = motion_par[i]
+            moco = [-mp[4], mp[3], -mp[5], -mp[1] * 180 / np.pi,
+                    mp[0] * 180 / np.pi, -mp[2] * 180 / np.pi]
+            hd = pydicom.read_file(self.template)
+            for n in range(3):
+                hd[0x19, 0x1025].value[n] = moco[n]
+            for n in range(3):
+                hd[0x19, 0x1026].value[n] = moco[n + 3]
+            hd.AcquisitionTime = start_times[i]
+            hd.InstanceNumber = pydicom.valuerep.IS(i + 1)
+            hd.AcquisitionNumber = pydicom.valuerep.IS(i + 1)
+            hd.SeriesInstanceUID = new_uid
+            hd.SeriesDescription = 'MoCoSeries'
+            hd.SeriesNumber = '150'
+            hd.save_as(op.join(out_dir, '{}.IMA'.format(str(i).zfill(6))))
+
+    def test_matches_per_instance(self):
+        ref_dir = op.join(self.tmp_dir, 'ref')
+        os.mkdir(ref_dir)
+        self.per_instance(ref_dir)
+        work_dir = op.join(self.tmp_dir, 'work')
+        os.mkdir(work_dir)
+        cwd = os.getcwd()
+        os.chdir(work_dir)
+        try:
+            out_dir = CreateMocoSeries(
+                moco_template=self.template, motion_par=self.motion_par,
+                start_times=self.start_times_file,
+                num_threads=3).run().outputs.modified_moco
+        finally:
+            os.chdir(cwd)
+        fnames = sorted(os.listdir(ref_dir))
+        self.assertEqual(sorted(os.listdir(out_dir)), fnames)
+        self.assertEqual(len(fnames), 4)
+        uids = set()
+        for fname in fnames:
+            ref = pydicom.read_file(op.join(ref_dir, fname))
+            dcm = pydicom.read_file(op.join(out_dir, fname))
+            # The series UID is generated afresh on each run
+            uids.add(dcm.SeriesInstanceUID)
+            del ref.SeriesInstanceUID, dcm.SeriesInstanceUID
+            self.assertEqual(list(dcm.keys()), list(ref.keys()))
+            for elem in ref:
+                self.assertEqual(dcm[elem.tag].value, elem.value,
+                                 str(elem.tag))
+            self.assertEqual(dcm.PixelData, ref.PixelData)
+        self.assertEqual(len(uids), 1)
@@ -0,0 +1,362 @@
+import os
+import tempfile
+import shutil
+from unittest import TestCase
+import numpy as np
+import nibabel as nib
+from banana.interfaces.motion_correction import save_motion_mats_stack
+from banana.interfaces.pet import (
+    PetImageMotionCorrectionBatch, StaticPETImageGeneration,
+    SinogramPCAMotionDetection, RegionalStatistics, SUVRCalculation,
+    GraphicalKineticAnalysis, PETFovCropping, dual_regression,
+    remove_global_trend)
+from banana.exceptions import BananaUsageError
+from banana.utils.timeline import IntervalTimeline
+
+
+class TestPetImageMotionCorrectionBatch(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmp_dir)
+        rng = np.random.RandomState(4)
+        self.frames = []
+        self.pet_images = []
+        for i in range(3):
+            data = rng.rand(12, 10, 8).astype(np.float32)
+            fname = os.path.abspath('frame_{}.nii.gz'.format(i))
+            nib.save(nib.Nifti1Image(data, np.diag([2.0, 2.0, 2.0, 1.0])),
+                     fname)
+            self.frames.append(data)
+            self.pet_images.append(fname)
+        # The head moved by one voxel along y during the second frame
+        mats = np.tile(np.eye(4), (3, 1, 1))
+        mats[1, 1, 3] = 2.0
+        save_motion_mats_stack('mats.npy', mats)
+        np.savetxt('pet2ref.mat', np.eye(4))
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp_dir)
+
+    def test_batch(self):
+        result = PetImageMotionCorrectionBatch(
+            pet_images=self.pet_images, motion_mats='mats.npy',
+            pet2ref_mat='pet2ref.mat', corr_factors=[1.0, 2.0, 0.5],
+            num_processes=2).run()
+        mc = [nib.load(f).get_fdata() for f in result.outputs.pet_mc_image]
+        no_mc = [nib.load(f).get_fdata()
+                 for f in result.outputs.pet_no_mc_image]
+        for frame, corr, img in zip(self.frames, [1.0, 2.0, 0.5], no_mc):
+            self.assertTrue(np.allclose(img, frame * corr))
+        self.assertTrue(np.allclose(mc[0], self.frames[0]))
+        self.assertTrue(np.allclose(mc[1][:, :-1], self.frames[1][:, 1:] * 2))
+
+
+class TestStaticPETImageGeneration(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmp_dir)
+        rng = np.random.RandomState(5)
+        self.frames = rng.rand(4, 6, 5, 4).astype(np.float32)
+        self.images = []
+        for i, data in enumerate(self.frames):
+            fname = os.path.abspath('frame_{}.nii.gz'.format(i))
+            nib.save(nib.Nifti1Image(data, np.eye(4)), fname)
+            self.images.append(fname)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp_dir)
+
+    def test_weighted_sum(self):
+        weights = [60.0, 60.0, 120.0, 300.0]
+        result = StaticPETImageGeneration(
+            pet_mc_images=self.images, pet_no_mc_images=self.images[::-1],
+            frame_weights=weights).run()
+        for fname, frames in ((result.outputs.static_mc, self.frames),
+                              (result.outputs.static_no_mc,
+                               self.frames[::-1])):
+            ref = np.tensordot(weights, frames, axes=1)
+            self.assertTrue(np.allclose(nib.load(fname).get_fdata(), ref,
+                                        rtol=1e-5))
+
+
+class TestSinogramPCAMotionDetection(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmp_dir)
+        os.mkdir('sinograms')
+        rng = np.random.RandomState(5)
+        source = rng.uniform(0, 5, (20, 3, 30))
+        for i in range(30):
+            if i == 18:
+                source = np.roll(source, 2, axis=2)
+            np.save('sinograms/Frame{:05d}_ssrb.npy'.format(i),
+                    rng.poisson(source * 40).astype(np.float32))
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp_dir)
+
+    def test_detection(self):
+        outputs = SinogramPCAMotionDetection(
+            sinogram_folder='sinograms', temporal_len=2.0, time_offset=10.0,
+            pet_start_time='235950.000000', method='incremental',
+            batch_size=8).run().outputs
+        surrogate = IntervalTimeline.load(outputs.surrogate_rc)
+        self.assertEqual(surrogate.study_start_time, '235950.000000')
+        self.assertEqual(len(surrogate), 30)
+        self.assertEqual(surrogate.starts[18], 46.0)
+        self.assertEqual(list(np.loadtxt(outputs.motion_event_times,
+                                         dtype=str, ndmin=1)),
+                         ['000036.000000'])
+
+
+class TestDualRegression(TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(6)
+        self.data = rng.rand(9, 8, 7, 10).astype(np.float32)
+        self.img = nib.Nifti1Image(self.data, np.eye(4))
+        self.maps = rng.randn(9, 8, 7, 3).astype(np.float32)
+        self.mask = np.zeros((9, 8, 7), dtype=bool)
+        self.mask[2:7, 1:6, 1:6] = True
+
+    def reference(self, reg_map):
+        ts = self.data[self.mask].astype(float)
+        timecourse = ts.T.dot(reg_map[self.mask])
+        sm = ts.dot(timecourse)
+        return timecourse, (sm - sm.mean()) / sm.std()
+
+    def test_multiple_maps(self):
+        timecourses, spatial_maps = dual_regression(
+            self.img, self.maps, mask=self.mask, slab_size=2)
+        self.assertEqual(spatial_maps.shape, (9, 8, 7, 3))
+        self.assertTrue((spatial_maps[~self.mask] == 0).all())
+        for i in range(3):
+            timecourse, sm = self.reference(self.maps[..., i])
+            self.assertTrue(np.allclose(timecourses[:, i], timecourse,
+                                        rtol=1e-4))
+            self.assertTrue(np.allclose(spatial_maps[self.mask][:, i], sm,
+                                        atol=1e-4))
+
+    def test_compressed_path(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'volume.nii.gz')
+            nib.save(self.img, path)
+            from_path = dual_regression(path, self.maps, mask=self.mask,
+                                        slab_size=2)
+            # Nothing is left next to the image
+            self.assertEqual(os.listdir(tmp_dir), ['volume.nii.gz'])
+        finally:
+            shutil.rmtree(tmp_dir)
+        in_memory = dual_regression(self.img, self.maps, mask=self.mask,
+                                    slab_size=2)
+        for a, b in zip(from_path, in_memory):
+            self.assertTrue(np.allclose(a, b))
+
+
+class TestGlobalTrendRemoval(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        rng = np.random.RandomState(7)
+        trend = np.linspace(0, 5, 30) ** 1.5
+        self.data = (rng.rand(9, 8, 7, 1) * 10 * trend +
+                     rng.randn(9, 8, 7, 30)).astype(np.float32)
+        self.mask = np.zeros((9, 8, 7), dtype=bool)
+        self.mask[2:7, 1:6, 1:6] = True
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_masked_removal(self):
+        out_path = os.path.join(self.tmp_dir, 'detrended.nii')
+        remove_global_trend(nib.Nifti1Image(self.data, np.eye(4)), out_path,
+                            mask=self.mask, slab_size=2)
+        detrended = nib.load(out_path).get_fdata()
+        self.assertTrue(np.array_equal(detrended[~self.mask],
+                                       self.data[~self.mask]))
+        # Reference: the leading right singular vector of the centred time
+        # series
+        ts = self.data[self.mask].astype(float)
+        _, _, vt = np.linalg.svd(ts - ts.mean(axis=0), full_matrices=False)
+        ref = ts - np.outer(ts.dot(vt[0]), vt[0])
+        self.assertTrue(np.allclose(detrended[self.mask], ref, atol=1e-3))
+
+
+class TestRegionalStatistics(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        rng = np.random.RandomState(8)
+        self.data = rng.rand(9, 8, 7, 5).astype(np.float32)
+        self.labels = rng.randint(0, 4, size=(9, 8, 7)).astype(np.int16)
+        self.reference = np.zeros((9, 8, 7), dtype=np.uint8)
+        self.reference[:3] = 1
+        self.files = {}
+        for name, array in (('volume', self.data), ('labels', self.labels),
+                            ('reference', self.reference)):
+            self.files[name] = os.path.join(self.tmp_dir,
+                                            name + '.nii.gz')
+            nib.save(nib.Nifti1Image(array, np.eye(4)), self.files[name])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_table(self):
+        out_file = os.path.join(self.tmp_dir, 'stats.csv')
+        RegionalStatistics(
+            volume=self.files['volume'], label_image=self.files['labels'],
+            reference_mask=self.files['reference'], out_file=out_file).run()
+        table = np.genfromtxt(out_file, delimiter=',', names=True)
+        self.assertEqual(len(table), 3 * 5)
+        reference_means = self.data[self.reference > 0].mean(axis=0)
+        for row in table:
+            values = self.data[self.labels == row['label']][
+                :, int(row['frame'])]
+            self.assertEqual(row['voxels'], len(values))
+            self.assertAlmostEqual(row['mean'], values.mean(), places=5)
+            self.assertAlmostEqual(row['sum'], values.sum(), places=3)
+            self.assertAlmostEqual(row['std'], values.std(), places=5)
+            self.assertAlmostEqual(
+                row['ratio'],
+                values.mean() / reference_means[int(row['frame'])],
+                places=5)
+
+
+class TestSUVRCalculation(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.data = np.random.RandomState(11).rand(9, 8, 7).astype(
+            np.float32)
+        self.volume = os.path.join(self.tmp_dir, 'volume.nii.gz')
+        nib.save(nib.Nifti1Image(self.data, np.eye(4)), self.volume)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def run_suvr(self, mask):
+        mask_file = os.path.join(self.tmp_dir, 'mask.nii.gz')
+        nib.save(nib.Nifti1Image(mask, np.eye(4)), mask_file)
+        cwd = os.getcwd()
+        os.chdir(self.tmp_dir)
+        try:
+            return SUVRCalculation(volume=self.volume,
+                                   base_mask=mask_file).run()
+        finally:
+            os.chdir(cwd)
+
+    def test_suvr(self):
+        mask = np.zeros(self.data.shape, dtype=np.uint8)
+        mask[2:5, 3:6, 1:4] = 1
+        result = self.run_suvr(mask)
+        suvr = nib.load(result.outputs.SUVR_file).get_fdata()
+        self.assertTrue(np.allclose(
+            suvr, self.data / self.data[mask > 0].mean(), rtol=1e-5))
+
+    def test_empty_mask(self):
+        with self.assertRaises(BananaUsageError):
+            self.run_suvr(np.zeros(self.data.shape, dtype=np.uint8))
+
+
+class TestGraphicalKineticAnalysis(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.volume = os.path.join(self.tmp_dir, 'volumes.nii.gz')
+        nib.save(nib.Nifti1Image(np.ones((4, 4, 3, 6), dtype=np.float32),
+                                 np.eye(4)), self.volume)
+        self.input_function = os.path.join(self.tmp_dir, 'input.txt')
+        np.savetxt(self.input_function, np.ones(6))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_mismatching_frame_times(self):
+        # E.g. the frames of the acquisition instead of the reconstruction
+        frame_times = os.path.join(self.tmp_dir, 'frame_times.txt')
+        np.savetxt(frame_times, [[0.0, 3600.0]])
+        cwd = os.getcwd()
+        os.chdir(self.tmp_dir)
+        try:
+            with self.assertRaises(BananaUsageError):
+                GraphicalKineticAnalysis(
+                    volume=self.volume, frame_times=frame_times,
+                    input_function=self.input_function).run()
+        finally:
+            os.chdir(cwd)
+
+
+class TestPETFovCropping(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        rng = np.random.RandomState(10)
+        self.affine = np.array([[-2., 0, 0, 170], [0, 2, 0, -150],
+                                [0, 0, 2, -120], [0, 0, 0, 1]])
+        self.frames = [rng.rand(20, 18, 16).astype(np.float32)
+                       for _ in range(3)]
+        self.frame_files = []
+        for i, frame in enumerate(self.frames):
+            fname = os.path.join(self.tmp_dir, 'frame{}.nii.gz'.format(i))
+            nib.save(nib.Nifti1Image(frame, self.affine), fname)
+            self.frame_files.append(fname)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_frames(self):
+        cwd = os.getcwd()
+        os.chdir(self.tmp_dir)
+        try:
+            result = PETFovCropping(
+                pet_images=self.frame_files, x_min=2, x_size=10, y_min=3,
+                y_size=12, z_min=4, z_size=8, num_threads=2).run()
+        finally:
+            os.chdir(cwd)
+        cropped_files = result.outputs.pet_cropped_images
+        self.assertEqual(len(cropped_files), 3)
+        for frame, cropped_file in zip(self.frames, cropped_files):
+            cropped = nib.load(cropped_file)
+            self.assertTrue(np.array_equal(cropped.get_fdata(),
+                                           frame[2:12, 3:15, 4:12]))
+            self.assertTrue(np.allclose(cropped.affine[:3, 3],
+                                        [166, -144, -112]))
+
+    def test_crop_before_merge(self):
+        # The frames are cropped before they are merged in the dynamic branch
+        # of MotionDetectionMixin.motion_correction_pipeline, where the merged
+        # series used to be cropped. Merging is done here with nibabel in
+        # place of 'fslmerge -t' (which also keeps the first frame's header)
+        crop_params = dict(x_min=2, x_size=10, y_min=3, y_size=12, z_min=4,
+                           z_size=8)
+        merged_file = os.path.join(self.tmp_dir, 'merged.nii.gz')
+        nib.save(nib.concat_images(self.frame_files), merged_file)
+        cwd = os.getcwd()
+        os.chdir(self.tmp_dir)
+        try:
+            merged_then_cropped = nib.load(PETFovCropping(
+                pet_image=merged_file, **crop_params).run().outputs
+                .pet_cropped)
+            cropped_frames = PETFovCropping(
+                pet_images=self.frame_files, num_threads=2,
+                **crop_params).run().outputs.pet_cropped_images
+        finally:
+            os.chdir(cwd)
+        cropped_then_merged = nib.concat_images(cropped_frames)
+        self.assertEqual(cropped_then_merged.shape, (10, 12, 8, 3))
+        self.assertEqual(cropped_then_merged.shape,
+                         merged_then_cropped.shape)
+        self.assertTrue(np.allclose(cropped_then_merged.affine,
+                                    merged_then_cropped.affine))
+        self.assertTrue(np.array_equal(cropped_then_merged.get_fdata(),
+                                       merged_then_cropped.get_fdata()))
@@ -0,0 +1,76 @@
+import os
+import tempfile
+import shutil
+from unittest import TestCase
+import numpy as np
+import nibabel as nib
+from banana.interfaces.sklearn import FastICA
+
+
+class TestFastICA(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        rng = np.random.RandomState(0)
+        shape = (12, 12, 10)
+        n_vols = 40
+        self.maps = np.zeros(shape + (2,))
+        self.maps[2:6, 2:6, 2:6, 0] = 1
+        self.maps[7:11, 6:10, 4:8, 1] = 1
+        timecourses = np.stack([np.sin(np.linspace(0, 6, n_vols)),
+                                np.linspace(-1, 1, n_vols) ** 2], axis=1)
+        data = self.maps.dot(timecourses.T) + 0.05 * rng.randn(
+            *(shape + (n_vols,)))
+        self.volume = os.path.join(self.tmp_dir, 'volume.nii.gz')
+        nib.save(nib.Nifti1Image(data.astype(np.float32), np.eye(4)),
+                 self.volume)
+        self.mask = np.zeros(shape, dtype=np.uint8)
+        self.mask[1:12, 1:11, 1:9] = 1
+        self.mask_file = os.path.join(self.tmp_dir, 'mask.nii.gz')
+        nib.save(nib.Nifti1Image(self.mask, np.eye(4)), self.mask_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def run_ica(self, work_dir='.', **inputs):
+        work_dir = os.path.join(self.tmp_dir, work_dir)
+        if not os.path.exists(work_dir):
+            os.mkdir(work_dir)
+        cwd = os.getcwd()
+        os.chdir(work_dir)
+        try:
+            return FastICA(volume=self.volume, n_components=2,
+                           brain_mask=self.mask_file, random_seed=0,
+                           **inputs).run()
+        finally:
+            os.chdir(cwd)
+
+    def test_masked_temporal_ica(self):
+        result = self.run_ica(ica_type='temporal', n_restarts=2)
+        zscores = nib.load(result.outputs.ica_decomposition).get_fdata()
+        self.assertEqual(zscores.shape, self.maps.shape)
+        self.assertTrue((zscores[self.mask == 0] == 0).all())
+        mask = self.mask > 0
+        corr = np.corrcoef(zscores[mask].T, self.maps[mask].T)[:2, 2:]
+        # Each component matches one of the maps (with a positive sign)
+        self.assertTrue(np.allclose(np.sort(corr.max(axis=0)), 1, atol=0.05))
+        stability = np.loadtxt(result.outputs.stability)
+        self.assertTrue((stability > 0.95).all())
+
+    def test_masked_spatial_ica(self):
+        result = self.run_ica(ica_type='spatial', n_restarts=2)
+        zscores = nib.load(result.outputs.ica_decomposition).get_fdata()
+        self.assertEqual(zscores.shape, self.maps.shape)
+        self.assertTrue((zscores[self.mask == 0] == 0).all())
+        mask = self.mask > 0
+        corr = np.corrcoef(zscores[mask].T, self.maps[mask].T)[:2, 2:]
+        self.assertTrue((corr.max(axis=0) > 0.9).all())
+        timecourses = nib.load(result.outputs.ica_timeseries).get_fdata()
+        self.assertEqual(timecourses.shape, (40, 2))
+        # The maps projected back from the PCA-reduced space match those of
+        # the unreduced data
+        unreduced = self.run_ica('unreduced', ica_type='spatial',
+                                 n_pca_components=0)
+        self.assertTrue(np.allclose(
+            nib.load(unreduced.outputs.ica_decomposition).get_fdata(),
+            zscores, atol=1e-3))
@@ -0,0 +1,37 @@
+from unittest import TestCase
+from pydicom.data import get_testdata_file
+from banana.utils.csa import parse_ascconv, read_ascconv
+
+
+ASCCONV_SAMPLE = '''<XProtocol>
+{
+  <Name> "PhoenixMetaProtocol"
+  <ParamLong."TotalScanTimeSec">  { 12  }
+}
+### ASCCONV BEGIN @Checksum=mk:0x1a2b ###
+ulVersion                                = 0x14b44b6
+tSequenceFileName                        = ""%SiemensSeq%\\ep2d_diff""
+alTR[0]                                  = 6600000
+alTE[0]                                  = 93000
+lContrasts                               = 1
+sSliceArray.asSlice[0].dInPlaneRot       = -3.1415926	# comment
+sDiffusion.lDiffDirections               = 64
+lTotalScanTimeSec                        = 450
+### ASCCONV END ###'''
+
+
+class TestAscconv(TestCase):
+
+    def test_parse(self):
+        ascconv = parse_ascconv(ASCCONV_SAMPLE)
+        self.assertEqual(ascconv['ulVersion'], 0x14b44b6)
+        self.assertEqual(ascconv['tSequenceFileName'],
+                         '%SiemensSeq%\\ep2d_diff')
+        self.assertEqual(ascconv['alTR[0]'], 6600000)
+        self.assertEqual(ascconv['sSliceArray.asSlice[0].dInPlaneRot'],
+                         -3.1415926)
+        self.assertEqual(ascconv['lTotalScanTimeSec'], 450)
+        self.assertEqual(len(ascconv), 8)
+
+    def test_non_siemens(self):
+        self.assertEqual(read_ascconv(get_testdata_file('MR_small.dcm')), {})
@@ -0,0 +1,71 @@
+import os
+import os.path as op
+import tempfile
+import shutil
+import time
+from unittest import TestCase
+import pydicom
+from pydicom.data import get_testdata_file
+from banana.utils.dicom_index import DicomHeaderIndex, read_header_fields
+from banana.interfaces.dicom import DicomHeaderInfoExtraction
+
+
+class TestDicomHeaderIndex(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.dicom_dir = op.join(self.tmp_dir, 'series')
+        os.mkdir(self.dicom_dir)
+        self.paths = []
+        for i in range(4):
+            path = op.join(self.dicom_dir, '{:03d}.dcm'.format(i))
+            dcm = pydicom.read_file(get_testdata_file('MR_small.dcm'))
+            dcm.AcquisitionTime = '1200{:02d}.000000'.format(i)
+            dcm.save_as(path)
+            self.paths.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_incremental_update(self):
+        index = DicomHeaderIndex.for_directory(
+            self.dicom_dir, cache_dir=self.tmp_dir, num_processes=2)
+        self.assertEqual(index.update(self.paths), 4)
+        self.assertEqual(index.update(self.paths), 0)
+        # Modify one of the files
+        time.sleep(0.01)
+        dcm = pydicom.read_file(self.paths[2])
+        dcm.SeriesDescription = 'modified'
+        dcm.save_as(self.paths[2])
+        index.close()
+        with DicomHeaderIndex.for_directory(
+                self.dicom_dir, cache_dir=self.tmp_dir) as index:
+            headers = index.headers(self.paths)
+            self.assertEqual(headers[2]['SeriesDescription'], 'modified')
+            self.assertEqual(headers[0], read_header_fields(self.paths[0]))
+            self.assertEqual(index.update(self.paths), 0)
+        # The source directory is left untouched
+        self.assertEqual(sorted(os.listdir(self.dicom_dir)),
+                         [op.basename(p) for p in self.paths])
+
+    def test_fallback(self):
+        # The parent of the database is a file so it can't be created
+        with DicomHeaderIndex(op.join(self.paths[0], 'index.sqlite')) as index:
+            self.assertFalse(index.persistent)
+            self.assertEqual(index.headers(self.paths),
+                             [read_header_fields(p) for p in self.paths])
+
+    def test_header_info_extraction(self):
+        cwd = os.getcwd()
+        os.chdir(self.tmp_dir)
+        try:
+            direct = DicomHeaderInfoExtraction(
+                dicom_folder=self.dicom_dir).run().outputs
+            indexed = DicomHeaderInfoExtraction(
+                dicom_folder=self.dicom_dir,
+                header_index=op.join(self.tmp_dir, 'index.sqlite')
+            ).run().outputs
+        finally:
+            os.chdir(cwd)
+        for name in ('start_time', 'echo_times', 'voxel_sizes', 'H', 'B0'):
+            self.assertEqual(getattr(direct, name), getattr(indexed, name))
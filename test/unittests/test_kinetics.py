@@ -0,0 +1,88 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+import numpy as np
+import nibabel as nib
+from scipy.signal import fftconvolve
+from banana.utils.kinetics import kinetic_maps
+
+
+def plasma_input(t):
+    "Plasma input function (kBq/ml) at times t (min)"
+    return 50 * t * np.exp(-2 * t) + 2 * np.exp(-0.05 * t) * (
+        1 - np.exp(-5 * t))
+
+
+def compartment_model_tac(t, K1, k2, k3):
+    """
+    Tissue time-activity curve of the irreversible two-tissue compartment
+    model (one-tissue compartment model if k3 == 0) sampled on the uniform
+    time grid t
+    """
+    dt = t[1] - t[0]
+    impulse_response = (K1 * k3 / (k2 + k3) +
+                        K1 * k2 / (k2 + k3) * np.exp(-(k2 + k3) * t))
+    return fftconvolve(plasma_input(t), impulse_response)[:len(t)] * dt
+
+
+class TestKineticMaps(TestCase):
+
+    def setUp(self):
+        # Frame durations (min) of a 90 min acquisition
+        durations = np.array([0.25] * 8 + [1] * 8 + [2] * 5 + [5] * 14)
+        starts = np.concatenate(([0], np.cumsum(durations)[:-1]))
+        self.frame_times = np.stack((starts, durations), axis=1)
+        t = np.arange(0, durations.sum(), 0.005)
+        frame_index = np.searchsorted(starts, t, side='right') - 1
+
+        def frame_average(curve):
+            return (np.bincount(frame_index, weights=curve) /
+                    np.bincount(frame_index))
+
+        self.input_function = frame_average(plasma_input(t))
+        rng = np.random.RandomState(9)
+        shape = (6, 5, 4)
+        # Irreversible (2TCi) voxels in the first half of the x axis and
+        # reversible (1TC) voxels in the second
+        self.K1 = rng.uniform(0.05, 0.5, shape)
+        self.k2 = rng.uniform(0.05, 0.3, shape)
+        self.k3 = rng.uniform(0.02, 0.1, shape)
+        self.k3[3:] = 0
+        data = np.zeros(shape + (len(durations),), dtype=np.float32)
+        for ijk in np.ndindex(*shape):
+            data[ijk] = frame_average(compartment_model_tac(
+                t, self.K1[ijk], self.k2[ijk], self.k3[ijk]))
+        self.img = nib.Nifti1Image(data, np.eye(4))
+
+    def test_phantom(self):
+        maps = kinetic_maps(self.img, self.input_function, self.frame_times,
+                            start_time=30, slab_size=1, num_threads=2)
+        ki = self.K1 * self.k3 / (self.k2 + self.k3)
+        self.assertTrue(np.allclose(maps.patlak_slope[:3], ki[:3],
+                                    rtol=0.02))
+        vt = self.K1 / self.k2
+        self.assertTrue(np.allclose(maps.logan_slope[3:], vt[3:], rtol=0.02))
+
+    def test_mask(self):
+        mask = np.zeros(self.img.shape[:3], dtype=bool)
+        mask[:, :, 1] = True
+        maps = kinetic_maps(self.img, self.input_function, self.frame_times,
+                            mask=mask, start_time=30)
+        for m in maps:
+            self.assertTrue((m[~mask] == 0).all())
+            self.assertTrue((m[mask] != 0).all())
+
+    def test_compressed_path(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'dynamic.nii.gz')
+            nib.save(self.img, path)
+            maps = kinetic_maps(path, self.input_function, self.frame_times,
+                                start_time=30, slab_size=2)
+        finally:
+            shutil.rmtree(tmp_dir)
+        ref = kinetic_maps(self.img, self.input_function, self.frame_times,
+                           start_time=30)
+        for m, r in zip(maps, ref):
+            self.assertTrue(np.allclose(m, r))
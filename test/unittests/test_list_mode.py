@@ -0,0 +1,128 @@
+import os
+import os.path as op
+import tempfile
+import shutil
+from unittest import TestCase
+import numpy as np
+import pydicom
+from pydicom.data import get_testdata_file
+from banana.utils.list_mode import (
+    read_list_mode_header, simulate_list_mode, unlist_list_mode)
+from banana.interfaces.dicom import PetTimeInfo
+from banana.interfaces.pet import ListModeUnlisting
+
+
+INTERFILE_HEADER = '''!INTERFILE:=
+%comment:=SMS-MI header
+!originating system:=2008
+%study time (hh:mm:ss GMT+00:00):=01:15:00
+!PET data type:=list
+image duration (sec):=3600
+%image relative start time (sec):=0
+!END OF INTERFILE:=
+'''
+
+
+def make_list_mode(directory, header=INTERFILE_HEADER, write_data=True):
+    dcm = pydicom.read_file(get_testdata_file('MR_small.dcm'))
+    dcm.AcquisitionTime = '111500.000000'
+    dcm.add_new(0x00290010, 'LO', 'SIEMENS MI')
+    dcm.add_new(0x00291010, 'OB', header.encode())
+    basename = op.join(directory, 'PET.ptd')
+    dcm.save_as(basename + '.dcm')
+    if write_data:
+        with open(basename + '.bf', 'wb') as f:
+            f.write(b'\0' * 64)
+    return basename + '.bf'
+
+
+class TestListModeHeader(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.list_mode = make_list_mode(self.tmp_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_read(self):
+        header = read_list_mode_header(self.list_mode)
+        self.assertEqual(header.start_time, '111500.000000')
+        self.assertEqual(header.duration, 3600)
+        self.assertTrue(np.array_equal(header.frames, [[0.0, 3600.0]]))
+        self.assertEqual(header.fields['pet data type'], 'list')
+        self.assertIs(read_list_mode_header(self.list_mode), header)
+
+    def test_pet_time_info(self):
+        cwd = os.getcwd()
+        os.chdir(self.tmp_dir)
+        try:
+            outputs = PetTimeInfo(pet_data_dir=self.tmp_dir).run().outputs
+        finally:
+            os.chdir(cwd)
+        self.assertEqual(outputs.pet_start_time, '111500.000000')
+        self.assertEqual(outputs.pet_end_time, '121500.000000')
+        self.assertEqual(outputs.pet_duration, 3600)
+
+
+class TestListModeUnlisting(TestCase):
+
+    sinogram_size = 500
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.list_mode = op.join(self.tmp_dir, 'PET.ptd.bf')
+        self.times, self.addresses, self.prompt = simulate_list_mode(
+            self.list_mode, 1200, rate=25.0,
+            sinogram_size=self.sinogram_size)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def expected(self, start, end, delays=False):
+        selected = (self.times >= start) & (self.times < end)
+        counts = np.bincount(self.addresses[selected & self.prompt],
+                             minlength=self.sinogram_size)
+        if delays:
+            counts = np.concatenate((counts, np.bincount(
+                self.addresses[selected & ~self.prompt],
+                minlength=self.sinogram_size)))
+        return counts
+
+    def test_unlist(self):
+        # Small chunks so that frames span multiple chunks (and vice versa)
+        for delays in (False, True):
+            sinograms = unlist_list_mode(
+                self.list_mode, [0.0, 0.4, 0.8, 1.1], 0.4,
+                out_dir=self.tmp_dir, sinogram_size=self.sinogram_size,
+                delays=delays, chunk_size=1001, num_threads=3)
+            for (start, end), sinogram in zip(
+                    [(0, 400), (400, 800), (800, 1200), (1100, 1500)],
+                    sinograms):
+                self.assertTrue(np.array_equal(
+                    np.fromfile(sinogram, dtype='<i2'),
+                    self.expected(start, end, delays=delays)))
+            # The accumulators of the frames are removed once written
+            self.assertFalse([f for f in os.listdir(self.tmp_dir)
+                              if f.endswith('.counts')])
+
+    def test_interface_skips_frames_after_end(self):
+        # The header gives a duration of 1 s (for 1.2 s of simulated events),
+        # so only the frames starting at 0, 0.4 and 0.8 s are unlisted
+        make_list_mode(self.tmp_dir, INTERFILE_HEADER.replace(
+            'image duration (sec):=3600', 'image duration (sec):=1'),
+            write_data=False)
+        cwd = os.getcwd()
+        os.chdir(self.tmp_dir)
+        try:
+            outputs = ListModeUnlisting(
+                list_mode=self.list_mode, num_frames=5, temporal_len=0.4,
+                sinogram_size=self.sinogram_size, chunk_size=1001,
+                num_threads=2).run().outputs
+        finally:
+            os.chdir(cwd)
+        self.assertEqual(len(outputs.pet_sinograms), 3)
+        for (start, end), sinogram in zip([(0, 400), (400, 800), (800, 1200)],
+                                          outputs.pet_sinograms):
+            self.assertTrue(np.array_equal(np.fromfile(sinogram, dtype='<i2'),
+                                           self.expected(start, end)))
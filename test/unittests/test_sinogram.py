@@ -0,0 +1,112 @@
+import os.path as op
+import tempfile
+import shutil
+from unittest import TestCase
+import numpy as np
+from banana.utils.sinogram import (
+    ssrb, ssrb_files, MMR_SEGMENTS, sinogram_pca, detect_motion_events)
+
+
+def naive_ssrb(sinograms, num_segments_to_combine, view_mash):
+    # Rebins sinogram by sinogram, using the absolute axial position
+    # ((ring1 + ring2) in half-ring units) of each sinogram
+    starts = np.cumsum([0] + [s for _, s in MMR_SEGMENTS])
+    segments = dict((num, (start, size)) for (num, size), start
+                    in zip(MMR_SEGMENTS, starts))
+    half = num_segments_to_combine // 2
+    n_groups = (5 - half) // num_segments_to_combine
+    rebinned = []
+    for group in [0] + [g for n in range(1, n_groups + 1) for g in (n, -n)]:
+        centre = group * num_segments_to_combine
+        size = segments[centre][1]
+        out = np.zeros((size, sinograms.shape[1] // view_mash,
+                        sinograms.shape[2]))
+        for num in range(centre - half, centre + half + 1):
+            start, in_size = segments[num]
+            for z in range(in_size):
+                z_out = z + (size - in_size) // 2
+                if 0 <= z_out < size:
+                    out[z_out] += sinograms[start + z].reshape(
+                        -1, view_mash, sinograms.shape[2]).sum(axis=1)
+        rebinned.append(out)
+    return np.concatenate(rebinned)
+
+
+class TestSSRB(TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.sinograms = rng.randint(
+            0, 10, (sum(s for _, s in MMR_SEGMENTS), 12, 5)).astype(np.int16)
+
+    def test_ssrb(self):
+        for num_segments, view_mash in ((1, 4), (3, 2), (5, 12)):
+            rebinned, segments = ssrb(
+                self.sinograms, num_segments_to_combine=num_segments,
+                view_mash=view_mash)
+            self.assertEqual(sum(s for _, s in segments), len(rebinned))
+            self.assertTrue(np.allclose(rebinned, naive_ssrb(
+                self.sinograms, num_segments, view_mash)))
+
+    def test_stack(self):
+        stack = np.stack((self.sinograms, self.sinograms * 2))
+        rebinned, _ = ssrb(stack, num_segments_to_combine=3, view_mash=3)
+        single, _ = ssrb(self.sinograms, num_segments_to_combine=3,
+                         view_mash=3)
+        self.assertTrue(np.allclose(rebinned[1], single * 2))
+
+    def test_files(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            delays = self.sinograms[::-1].copy()
+            files = []
+            for name, data in (('prompts', self.sinograms),
+                               ('with_delays',
+                                np.stack((self.sinograms, delays)))):
+                files.append(op.join(tmp_dir, name + '.s'))
+                data.astype('<i2').tofile(files[-1])
+            out_files = ssrb_files(files, tmp_dir,
+                                   shape=self.sinograms.shape, view_mash=3)
+            single, _ = ssrb(self.sinograms, view_mash=3)
+            self.assertTrue(np.allclose(np.load(out_files[0]), single))
+            with_delays = np.load(out_files[1])
+            self.assertEqual(with_delays.shape, (2,) + single.shape)
+            self.assertTrue(np.allclose(with_delays[0], single))
+            self.assertTrue(np.allclose(with_delays[1],
+                                        ssrb(delays, view_mash=3)[0]))
+            # Truncated file
+            truncated = op.join(tmp_dir, 'truncated.s')
+            self.sinograms.astype('<i2').tofile(truncated)
+            with open(truncated, 'r+b') as f:
+                f.truncate(100)
+            with self.assertRaises(ValueError):
+                ssrb_files([truncated], tmp_dir,
+                           shape=self.sinograms.shape)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+def moving_frames(n_still=25, n_moved=15, seed=0):
+    "Poisson sinograms of a slowly decaying source that moves once"
+    rng = np.random.RandomState(seed)
+    source = rng.uniform(0, 5, (20, 3, 30))
+    moved = np.roll(source, 2, axis=2)
+    return ([rng.poisson(source * 40 * (1 - 0.005 * i)).astype(np.float32)
+             for i in range(n_still)] +
+            [rng.poisson(moved * 40).astype(np.float32)
+             for i in range(n_moved)])
+
+
+class TestSinogramPCA(TestCase):
+
+    def test_methods(self):
+        frames = moving_frames()
+        gram_scores, gram_explained = sinogram_pca(frames, method='gram',
+                                                   block_size=333)
+        ipca_scores, ipca_explained = sinogram_pca(
+            frames, method='incremental', batch_size=7)
+        self.assertTrue(np.allclose(gram_scores[:, 0], ipca_scores[:, 0],
+                                    atol=1e-5))
+        self.assertAlmostEqual(gram_explained[0], ipca_explained[0],
+                               places=4)
+        self.assertEqual(list(detect_motion_events(gram_scores[:, 0])), [25])
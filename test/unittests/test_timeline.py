@@ -0,0 +1,84 @@
+import os.path as op
+import tempfile
+import shutil
+from unittest import TestCase
+import numpy as np
+from banana.utils.timeline import (
+    IntervalTimeline, AcquisitionTimeline, parse_hhmmss, format_hhmmss)
+
+
+class TestIntervalTimeline(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.timeline = IntervalTimeline(
+            [0.0, 2.5, 3.5, 10.0], [2.0, 3.5, 5.0, 12.0],
+            [[1.0, -1.0], [2.0, -2.0], [3.0, -3.0], [4.0, -4.0]],
+            study_start_time='101010.500000')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_expand(self):
+        times, values, active = self.timeline.expand(0.5)
+        self.assertEqual(len(times), 24)
+        # Idle periods are forward filled from the previous interval
+        self.assertTrue(np.array_equal(
+            values[:, 0],
+            [1] * 5 + [2] * 2 + [3] * 13 + [4] * 4))
+        self.assertTrue(np.array_equal(np.where(~active)[0],
+                                       [4, 10, 11, 12, 13, 14, 15, 16, 17,
+                                        18, 19]))
+
+    def test_idle_periods(self):
+        self.assertTrue(np.array_equal(self.timeline.idle_periods(),
+                                       [[2.0, 2.5], [5.0, 10.0]]))
+
+    def test_save_load(self):
+        path = op.join(self.tmp_dir, 'timeline.txt')
+        self.timeline.save(path)
+        loaded = IntervalTimeline.load(path)
+        self.assertEqual(loaded.study_start_time, '101010.500000')
+        self.assertTrue(np.array_equal(loaded.values, self.timeline.values))
+        self.assertTrue(np.array_equal(loaded.ends, self.timeline.ends))
+
+
+class TestAcquisitionTimeline(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        # Session crossing midnight
+        self.timeline = AcquisitionTimeline.from_start_times(
+            ['235900.000000', '235950.000000', '000010.500000',
+             '000100.000000'], labels=['a', 'b', 'c'])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_parse_format(self):
+        secs = parse_hhmmss(['101010.5', '235959.999999', 120000])
+        self.assertTrue(np.allclose(secs, [36610.5, 86399.999999, 43200]))
+        self.assertEqual(format_hhmmss(secs)[:2],
+                         ['101010.500000', '235959.999999'])
+        self.assertEqual(format_hhmmss(86401.0), '000001.000000')
+
+    def test_midnight(self):
+        self.assertTrue(np.allclose(self.timeline.bounds,
+                                    [0.0, 50.0, 70.5, 120.0]))
+        self.assertAlmostEqual(self.timeline.to_seconds('000200'), 180.0)
+        self.assertEqual(self.timeline.to_clock_times(self.timeline.bounds),
+                         ['235900.000000', '235950.000000', '000010.500000',
+                          '000100.000000'])
+
+    def test_lookup(self):
+        indices, inside = self.timeline.lookup([-1.0, 5.0, 60.0, 200.0])
+        self.assertEqual(indices.tolist(), [-1, 0, 1, 2])
+        self.assertEqual(inside.tolist(), [False, True, True, False])
+
+    def test_save_load(self):
+        path = op.join(self.tmp_dir, 'timeline.json')
+        self.timeline.save(path)
+        loaded = AcquisitionTimeline.load(path)
+        self.assertEqual(loaded.session_start, self.timeline.session_start)
+        self.assertEqual(loaded.labels, ['a', 'b', 'c'])
+        self.assertTrue(np.array_equal(loaded.ends, self.timeline.ends))